@@ -13,30 +13,95 @@ enjoyment.
 
 As a demonstration of scalability, the requests can be done with
 multithreading. So in other use cases, or if the future number of
-cat facts becomes much greater than 1000, we can hit the same API 
-endpoint multiple times simultaneously to get more facts.
+cat facts becomes much greater than 1000, the API's pages are
+fetched by multiple threads simultaneously to get more facts.
 """
 
 from urllib.request import urlopen # Requests would be better but it's not in standard lib
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import queue
 import json
 import string
 import re
-from threading import Thread 
+import sys
+import argparse
+import asyncio
+import bisect
+import cProfile
+import hashlib
+import io
+import logging
+import math
+import mmap
+import os
+import pstats
+import random
+import struct
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from multiprocessing import Pool
+from threading import Thread, BoundedSemaphore, Event, Lock, local
 import psycopg2 # PostgreSQL driver
 import psycopg2.extras
+import psycopg2.pool
 
 API_ENDPOINT = "https://catfact.ninja/facts?limit=1000" 
-MAX_SIZE = 1 # This is the max number of tasks that can be put in the multithreaded queue.
-             # Since we can get 1000 cat facts at once and there's less than 500 in the API
-             # database, we only need to make one request.
-REQ_THREAD_COUNT = 1 # Max number of threads to spawn to run queue. Because of the above ^ 
-                     # explanation, this also only needs to be set to 1 right now.
+REQ_THREAD_COUNT = 4 # Max number of threads fetching pages at once. The API returns its 
+                     # (currently <500) facts 1000 per page, so right now only one page is fetched.
+REQ_TIMEOUT_SECONDS = 10 # Timeout of each request to the API
+REQ_RETRIES = 4 # Times a failed request is retried before giving up on that page
+REQ_BACKOFF_SECONDS = 0.5 # Base wait before a retry; doubles after every failed attempt
+REQ_MAX_BACKOFF_SECONDS = 30 # Longest wait before a retry
 
 DB_NAME = 'catfacts'
 DB_TABLE_NAME = "defaulttable"
+DB_MODEL_TABLE_NAME = DB_TABLE_NAME + "_model" # Topics model the facts table was last classified with
+DB_VERSION_TABLE_NAME = DB_TABLE_NAME + "_version" # Counter bumped by every write to the facts table
+DB_NOTIFY_CHANNEL = DB_TABLE_NAME + "_changed" # Channel NOTIFYed with the new version on every write
 DB_USER = 'johnny'
 DB_HOST = 'localhost'
+DB_POOL_MIN_CONN = 1 # Connections opened up front by the connection pool
+DB_POOL_MAX_CONN = 10 # Most connections open at once; callers past this wait for a free one
+
+WRITE_BATCH_SIZE = 5000 # Number of rows sent to the db per write (and held in memory when streaming)
+BULK_WRITE_METHOD = "copy" # "copy" for COPY FROM STDIN, "values" for multi-row INSERTs
+FETCH_ITERSIZE = 2000 # Rows pulled from the db per round trip when streaming all facts
+MAX_PAGE_SIZE = 10000 # Most rows returned by one page of fetch_page
+SEARCH_LIMIT = 20 # Results returned by a search when no limit is given (at most MAX_PAGE_SIZE)
+SEARCH_MAX_CANDIDATES = 10000 # Most matching facts ranked per search, so a very common word can't
+                              # make a search rank (and read) a large part of the table
+CACHE_MAX_SIZE = 256 # Most topic queries kept in the fetch cache (least recently used are evicted)
+CACHE_TTL_SECONDS = None # Seconds a cached topic query stays valid. None keeps it until the facts table changes.
+CACHE_VERSION_CHECK_SECONDS = 1 # Most seconds cached topic queries are served without checking the facts table's
+                                # version, which writes from any process bump (see bump_version). 0 checks it
+                                # before every cached query.
+TOKENIZE_BATCH_SIZE = 1000 # Number of facts normalized together by tokenize_facts
+CLASSIFY_PROCESS_COUNT = 1 # Number of worker processes to classify facts with. 1 classifies in the
+                           # main process; raise it for corpora much larger than the API's.
+CLASSIFY_CHUNKS_PER_PROCESS = 4 # Facts are split into this many chunks per worker process, so 
+                                # slower chunks don't leave the other workers idle
+
+TOPIC_MODEL_PATH = None # JSON or YAML file to load the topics model from. None uses weighted_topic_vals below.
+MODEL_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                               'cat_facts_tree') # Where compiled topics models are kept, by content hash.
+                                                 # None compiles the model every time.
+COMPILED_MODEL_FORMAT = 3 # Bumped whenever the compiled model changes shape, so old cache files are ignored
+TOKEN_STEMMER = "inflections" # Name of the STEMMERS entry tokens are folded with before lookup. None to match
+                              # tokens exactly, like determine_facts_hierarchy does.
+STEM_CACHE_SIZE = 100000 # Most distinct raw tokens whose stems (and topic matches) are remembered
+
+LOG_LEVEL = "INFO" # Level the command line (and the API) log at; DEBUG adds per-batch and per-query lines
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1, 2.5, 5, 10, 30) # Upper bounds (seconds) of the latency histogram buckets
+PROFILE_TOP_FUNCTIONS = 25 # Functions logged (by cumulative time) at the end of a profiled run
+
+log = logging.getLogger("cat_facts_tree")
 
 """
 Below, we will store words (topics) with associated values that 
@@ -60,9 +125,10 @@ To keep things simpler, information about cat breeds / types are completely
 ignored, rather than giving each cat breed its own hierarchy of facts. 
 
 Topic words are normalized before checking within the Cat_Facts_Tree class,
-to remove punctuation, spaces, capitalization, etc. In the future, we should
-apply stemming / lemmatization functions instead of having to repeat plurals and
-variations of word forms.
+to remove punctuation, spaces, capitalization, etc. The classifier also
+stems tokens and matches (see stem_inflections), so forms of a word that
+aren't listed match too. The lists keep the forms they've always had, so
+matching without a stemmer (TOKEN_STEMMER = None) finds what it always did.
 """
 cat_matches = ['animal', 'animals', 'pet', 'pets', 'feline', 'felines', 'cats', 'kitten',
                 'kittens', 'kitty']
@@ -180,6 +246,964 @@ weighted_topic_vals = {
     },
 }
 
+def load_topic_model(path: str):
+    """
+    Loads a topics model (same shape as weighted_topic_vals) from a JSON
+    file, or a YAML file if PyYAML is installed.
+    """
+    with open(path, encoding='utf-8') as model_file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is needed to load YAML topic models (pip install pyyaml)")
+            cat_topics_model = yaml.safe_load(model_file)
+        else:
+            cat_topics_model = json.load(model_file)
+    if not isinstance(cat_topics_model, dict):
+        raise ValueError("Topics model in " + path + " must map topics to their weight, parents, and matches")
+    for topic, vals in cat_topics_model.items():
+        if not isinstance(vals, dict) or 'weight' not in vals:
+            raise ValueError("Topic " + str(topic) + " in " + path + " has no weight")
+    return cat_topics_model
+
+
+@lru_cache(maxsize=None)
+def _load_default_topic_model(path: str):
+    return load_topic_model(path)
+
+
+def default_topic_model():
+    """
+    Returns the topics model used when none is given: the one in
+    TOPIC_MODEL_PATH (loaded once), or weighted_topic_vals.
+    """
+    if TOPIC_MODEL_PATH is None:
+        return weighted_topic_vals
+    return _load_default_topic_model(TOPIC_MODEL_PATH)
+
+
+# Built once, instead of on every normalize_text call. Hyphens are in string.punctuation,
+# so "well-fed" becomes "wellfed" rather than two tokens.
+NORMALIZE_TABLE = str.maketrans({key: None for key in string.punctuation})
+# Curly quotes aren't in string.punctuation. They're removed after strip(), which is the
+# order normalize_text has always done it in (so "“ cats" becomes " cats", not "cats").
+QUOTES_TABLE = str.maketrans({key: None for key in "’“"})
+
+
+def normalize_text(text: str):
+    """
+    Cleans up text (lower-cases and strips punctuation), in one translate
+    pass plus a second one only for non-ASCII text, which is the only
+    text that can have curly quotes.
+    """
+    normalized_text = text.translate(NORMALIZE_TABLE).lower().strip()
+    if not normalized_text.isascii():
+        normalized_text = normalized_text.translate(QUOTES_TABLE)
+    return normalized_text
+
+
+def tokenize(text: str):
+    """
+    Normalizes text and splits it into words.
+    """
+    return normalize_text(text).split(' ')
+
+
+def tokenize_facts(facts: list):
+    """
+    Tokenizes a list of facts at once. ASCII facts are joined and normalized
+    as one string, so translate() and lower() run once per batch instead of
+    once per fact. Gives the same tokens as calling tokenize on each fact.
+    """
+    joined = "\n".join(facts)
+    if not joined.isascii() or joined.count("\n") != len(facts) - 1:
+        # Curly quotes need the second pass, and facts with newlines can't be split back apart
+        return [tokenize(fact) for fact in facts]
+    normalized = joined.translate(NORMALIZE_TABLE).lower()
+    return [part.strip().split(' ') for part in normalized.split("\n")]
+
+
+# Forms the suffix rules of stem_inflections can't get to, mapped to their stems
+IRREGULAR_FORMS = {'ran': 'run', 'bit': 'bite', 'caught': 'catch', 'bred': 'breed',
+                   'grown': 'grow', 'feet': 'foot'}
+
+
+def _is_consonant(word: str, i: int):
+    if word[i] in "aeiou":
+        return False
+    if word[i] == 'y':
+        # y is a vowel after a consonant ("cry"), and a consonant otherwise ("yawn")
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(word: str):
+    """
+    Counts the vowel-consonant sequences in a word (Porter's m).
+    """
+    measure, previous_vowel = 0, False
+    for i in range(len(word)):
+        consonant = _is_consonant(word, i)
+        if consonant and previous_vowel:
+            measure += 1
+        previous_vowel = not consonant
+    return measure
+
+
+def _has_vowel(word: str):
+    return any(not _is_consonant(word, i) for i in range(len(word)))
+
+
+def _ends_cvc(word: str):
+    return (len(word) >= 3 and _is_consonant(word, -3 % len(word)) and not _is_consonant(word, len(word) - 2)
+            and _is_consonant(word, len(word) - 1) and word[-1] not in "wxy")
+
+
+def stem_inflections(token: str):
+    """
+    Folds plurals and -ed / -ing forms of a token into one stem, with the
+    rules of step 1 of the Porter stemmer (plus -ches, -shes, and -xes
+    plurals, and IRREGULAR_FORMS), so "hunts", "hunted", and
+    "hunting" all become "hunt", and "cats" becomes "cat".
+    Stems aren't always words ("kitty" becomes "kitti"), but a word and
+    its inflections get the same one.
+    """
+    if token in IRREGULAR_FORMS:
+        return IRREGULAR_FORMS[token]
+    if len(token) <= 2:
+        return token
+    if token.endswith("sses") or token.endswith("ies"):
+        token = token[:-2]
+    elif token.endswith(("ches", "shes", "xes")):
+        token = token[:-2] # "catches" -> "catch", where Porter leaves "catche"
+    elif token.endswith("s") and not token.endswith("ss"):
+        token = token[:-1]
+    stripped = False
+    if token.endswith("eed"):
+        if _measure(token[:-3]) > 0:
+            token = token[:-1]
+    elif token.endswith("ed") and _has_vowel(token[:-2]):
+        token, stripped = token[:-2], True
+    elif token.endswith("ing") and _has_vowel(token[:-3]):
+        token, stripped = token[:-3], True
+    if stripped:
+        if token.endswith(("at", "bl", "iz")):
+            token += "e"
+        elif (len(token) >= 2 and token[-1] == token[-2] and _is_consonant(token, len(token) - 1)
+                and token[-1] not in "lsz"):
+            token = token[:-1] # "running" -> "runn" -> "run"
+        elif _measure(token) == 1 and _ends_cvc(token):
+            token += "e" # "sized" -> "siz" -> "size"
+    if token.endswith("y") and _has_vowel(token[:-1]):
+        token = token[:-1] + "i"
+    return token
+
+
+# Token stemmers by name (see TOKEN_STEMMER). Any function of one token that
+# returns its canonical form can be added.
+STEMMERS = {"inflections": stem_inflections}
+
+
+def get_stemmer(name: str=None):
+    """
+    Returns the stemmer in STEMMERS called name, memoized for the last
+    STEM_CACHE_SIZE distinct tokens, or None if name is None.
+    """
+    if name is None:
+        return None
+    if name not in _memoized_stemmers:
+        if name not in STEMMERS:
+            raise ValueError("Unknown stemmer: " + str(name))
+        _memoized_stemmers[name] = lru_cache(maxsize=STEM_CACHE_SIZE)(STEMMERS[name])
+    return _memoized_stemmers[name]
+
+_memoized_stemmers = {}
+
+
+def iter_batches(iterable: object, batch_size: int):
+    """
+    Groups items from any iterable into lists of at most batch_size items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_tree_nodes(tree_dicts: dict):
+    """
+    Yields every node in tree_dicts, in order: root nodes are stored as
+    a single dict, and topics as a list of fact nodes.
+    """
+    for node in tree_dicts.values():
+        if type(node) is list:
+            yield from node
+        else:
+            yield node
+
+
+def copy_escape(value: object):
+    """
+    Escapes a value for PostgreSQL's COPY text format. Lists are
+    written as text[] array literals.
+    """
+    if isinstance(value, list):
+        value = "{" + ",".join(['"' + val.replace("\\", "\\\\").replace('"', '\\"') + '"'
+                                for val in value]) + "}"
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def topic_ancestors(topic: str, parents: list=None, cat_topics_model: dict=None):
+    """
+    Returns the ancestors of a topic from the root down, from the topics
+    model if it's there, or else from the parents saved with a node.
+    (Those come out of a set(), so their order is arbitrary.)
+    """
+    if cat_topics_model is None:
+        cat_topics_model = default_topic_model()
+    vals = cat_topics_model.get(topic)
+    if vals is not None and 'parents' in vals:
+        return vals['parents']
+    if parents:
+        # Root labels first; the rest can't be ordered without the model
+        return sorted(parents, key=lambda parent: not parent.endswith("_root"))
+    return []
+
+
+def node_path(node: dict, cat_topics_model: dict=None):
+    """
+    Returns the materialized path of a node: its topic's ancestors from the
+    root down, then the topic. Root nodes' path is just their root label.
+    """
+    if node.get('parents') is None:
+        return [str(node['topic']) + "_root"]
+    return list(topic_ancestors(node['topic'], node['parents'], cat_topics_model)) + [str(node['topic'])]
+
+
+# Columns of a facts table row, in the order node_to_row gives them
+ROW_COLUMNS = ("Depth", "Topic", "Parents", "Fact", "Path", "Fingerprint", "Tokens")
+# Columns rows are read back with by fetches, pages, subtrees, and streams. Fingerprint, Tokens,
+# and Search are only for finding facts in the db, so they're left out of responses.
+FACT_COLUMNS = "ID, Depth, Topic, Parents, Fact, Path"
+
+
+def fact_fingerprint(fact: str):
+    """
+    Returns the hex sha1 of a fact, which its row is identified by in the
+    db, so the same fact is only ever stored once.
+    """
+    return hashlib.sha1(fact.encode('utf-8')).hexdigest()
+
+
+def node_fingerprint(node: dict):
+    """
+    Returns the fingerprint of a node (see fact_fingerprint). Root nodes
+    have no fact, and are identified by their topic instead.
+    """
+    if node.get('parents') is None:
+        # The NUL bytes keep a root from colliding with a fact of the same text
+        return fact_fingerprint("\0root\0" + str(node['topic']))
+    return fact_fingerprint(str(node['fact']))
+
+
+def node_tokens(node: dict, stem: object=None):
+    """
+    Returns the distinct tokens of a node's fact, folded by the stem
+    function if there is one, and sorted (none for root nodes). Saved with
+    every row as the token -> fact index, so facts with a given token can
+    be found without reading the whole table.
+    """
+    if node.get('parents') is None:
+        return []
+    tokens = tokenize(str(node['fact']))
+    if stem is not None:
+        tokens = [stem(token) for token in tokens]
+    return sorted(set(tokens))
+
+
+# Search column of the facts table: the row's Tokens as a tsvector, so facts are searched with the
+# same normalization (and stemming) they're classified with. Tokens can have an empty string, which
+# isn't a lexeme.
+SEARCH_VECTOR = "array_to_tsvector(array_remove(Tokens, ''))"
+
+
+def search_tsquery(text: str, stem: object=None, match_all: bool=True):
+    """
+    Turns search text into a tsquery for the Search column: the text is
+    tokenized and stemmed like facts are (see node_tokens), and the tokens
+    are quoted so PostgreSQL uses them as they are. With match_all, facts
+    need every token (&); otherwise any of them (|).
+
+    Returns None if the text has no tokens.
+    """
+    tokens = [token for token in tokenize(text) if token]
+    if stem is not None:
+        tokens = [stem(token) for token in tokens]
+    lexemes = ["'" + token.replace("\\", "\\\\").replace("'", "''") + "'" for token in dict.fromkeys(tokens)]
+    if not lexemes:
+        return None
+    return (" & " if match_all else " | ").join(lexemes)
+
+
+def model_version(cat_topics_model: dict, stemmer: str=None):
+    """
+    Returns a hex sha1 of a topics model and the stemmer its tokens are
+    folded with, which changes whenever any topic's weight, parents, or
+    matches do.
+    """
+    key = cat_topics_model if stemmer is None else [cat_topics_model, stemmer]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def node_to_row(node: dict, stem: object=None):
+    """
+    Flattens a node into the column values of a db row (without the ID,
+    which the db generates), joining parents into a comma separated
+    string ("none" for root nodes). Tokens are folded by the stem function
+    of the classifier the node came from (see node_tokens).
+    """
+    parents = node.get('parents')
+    if parents is None:
+        parents = "none"
+    else:
+        parents = ", ".join(parents)
+    return (str(node['depth']), str(node['topic']), parents, str(node['fact']), node_path(node),
+            node_fingerprint(node), node_tokens(node, stem))
+
+
+class Cat_Facts_Tree_Metrics():
+    """
+    Thread-safe counters and latency histograms for the hot paths (fetch,
+    normalize, classify, persist, and query stages), rendered in the
+    Prometheus text format by the API's /metrics route.
+
+    Series are keyed by metric name and labels, like
+    cat_facts_stage_seconds{stage="classify"}. Stages are timed per batch
+    or per query, never per fact, so keeping count costs next to nothing.
+    Only this process is counted: classification worker processes (see
+    classify_facts_parallel) keep their own.
+    """
+
+    HELP = {
+        'cat_facts_stage_seconds': "Time spent in each stage, per call (a batch, page, or query)",
+        'cat_facts_stage_items_total': "Items (facts, rows, or pages) handled by each stage",
+        'cat_facts_fetch_requests_total': "Requests made to the cat facts API, including retries",
+        'cat_facts_fetch_retries_total': "Cat facts API requests that failed and were retried",
+        'cat_facts_fetch_failed_pages_total': "Cat facts API pages that still failed after retrying",
+        'cat_facts_http_request_seconds': "Time spent serving each API request, by route",
+        'cat_facts_http_requests_total': "API requests served, by route and status",
+    }
+
+    def __init__(self, buckets: tuple=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [count per bucket (last is +Inf), sum, count]
+        return
+
+    def inc(self, name: str, value: float=1, **labels):
+        """
+        Adds value to a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records one duration in a histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        return
+
+    def record_stage(self, stage: str, seconds: float, items: int):
+        """
+        Records one call of a stage: how long it took, and how many items
+        it handled.
+        """
+        self.observe('cat_facts_stage_seconds', seconds, stage=stage)
+        self.inc('cat_facts_stage_items_total', items, stage=stage)
+        return
+
+    @contextmanager
+    def time_stage(self, stage: str, items: int=1):
+        """
+        Times the block as one call of a stage (see record_stage).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, items)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+        return
+
+    @staticmethod
+    def format_labels(labels: tuple):
+        if not labels:
+            return ""
+        return "{" + ",".join([name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"')
+                               .replace("\n", "\\n") + '"' for name, value in labels]) + "}"
+
+    def render(self, gauges: list=()):
+        """
+        Returns every counter and histogram in the Prometheus text exposition
+        format, plus gauges: (name, help, labels dict, value) tuples of values
+        owned elsewhere (like pool and cache stats).
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(value[0]), value[1], value[2]])
+                                for key, value in self.histograms.items())
+        lines = []
+        described = set()
+
+        def describe(name: str, kind: str, help_text: str=None):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP " + name + " " + (help_text or self.HELP.get(name, name)))
+                lines.append("# TYPE " + name + " " + kind)
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(name + self.format_labels(labels) + " " + repr(value))
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                lines.append(name + "_bucket" + self.format_labels(labels + (('le', bound),)) + " " + str(cumulative))
+            lines.append(name + "_sum" + self.format_labels(labels) + " " + repr(total))
+            lines.append(name + "_count" + self.format_labels(labels) + " " + str(count))
+        for name, help_text, labels, value in gauges:
+            describe(name, "gauge", help_text)
+            lines.append(name + self.format_labels(tuple(sorted(labels.items()))) + " " + repr(value))
+        return "\n".join(lines) + "\n"
+
+# Metrics of this process, shared by every Cat_Facts_Tree, fetcher, and records instance
+metrics = Cat_Facts_Tree_Metrics()
+
+
+@contextmanager
+def profiled(path: str=None):
+    """
+    Runs the block under cProfile if path is given, then saves the stats
+    to path (for pstats / snakeviz) and logs the functions with the most
+    cumulative time. Without a path it does nothing, so profiling can be
+    switched on per run (see --profile).
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        log.info("Profile saved to %s\n%s", path, out.getvalue())
+
+
+class Cat_Facts_Tree_Classifier():
+    """
+    Compiled form of a weighted topics model. Instead of walking every
+    topic and every word in its matches for each token of a fact, the model
+    is inverted once into a dict of token -> (topic, depth, parents), so
+    classifying a fact costs one dict lookup per token.
+
+    With a stemmer (the name of one in STEMMERS), match words and tokens
+    are both folded to their stems, so "hunting" matches "hunt" without
+    being listed. Tokens are looked up through a memo of raw token ->
+    match, so each distinct token is only stemmed once (until the memo
+    holds STEM_CACHE_SIZE tokens, when it starts over).
+
+    Without a stemmer, the results are the same as
+    Cat_Facts_Tree.determine_facts_hierarchy: the first token of a fact
+    that matches anything decides the node, and when a token matches
+    several topics, the topic that comes last in the model wins (sibling
+    nodes replace each other in the nested loop, so "cute" ends up under
+    health rather than appearance).
+    """
+    def __init__(self, cat_topics_model: dict, index: dict=None, stemmer: str=None):
+        self.cat_topics_model = cat_topics_model
+        self.stemmer = stemmer
+        self.stem = get_stemmer(stemmer)
+        self.version = model_version(cat_topics_model, stemmer)
+        self.index = self.compile(cat_topics_model, self.stem) if index is None else index
+        self.lookup = {} # Raw token -> match (or None), filled in by lookup_token
+        return
+
+    @classmethod
+    def load(cls, cat_topics_model: dict, cache_dir: str=MODEL_CACHE_DIR, stemmer: str=None):
+        """
+        Returns a classifier for the topics model, reading its compiled
+        index from cache_dir if this exact model (by model_version) was
+        compiled before, or else compiling it and saving it there.
+        The cache is best effort: unreadable, malformed, or unwritable files
+        just mean the model gets compiled. Cache files are plain JSON (see
+        encode_index), so nothing in them is ever executed.
+        """
+        if cache_dir is None:
+            return cls(cat_topics_model, stemmer=stemmer)
+        version = model_version(cat_topics_model, stemmer)
+        path = os.path.join(cache_dir, version + "-" + str(COMPILED_MODEL_FORMAT) + ".json")
+        try:
+            with open(path, encoding='utf-8') as cache_file:
+                index = cls.decode_index(json.load(cache_file), cat_topics_model)
+        except (OSError, ValueError):
+            index = None
+        if index is not None:
+            return cls(cat_topics_model, index, stemmer)
+        classifier = cls(cat_topics_model, stemmer=stemmer)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written under a temporary name and renamed, so other processes
+            # never read a half written file
+            tmp_path = path + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(cls.encode_index(classifier.index), cache_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+        return classifier
+
+    def __reduce__(self):
+        # Worker processes get the model and load its compiled index from
+        # the cache, instead of unpickling a copy of the index
+        return (self.__class__.load, (self.cat_topics_model, MODEL_CACHE_DIR, self.stemmer))
+
+    @staticmethod
+    def encode_index(index: dict):
+        """
+        Turns a compiled index into JSON-able data for the model cache:
+        a list of the distinct (topic, depth, parents) matches, and each
+        token's position in it.
+        """
+        positions = {}
+        matches = []
+        tokens = {}
+        for token, match in index.items():
+            if match not in positions:
+                positions[match] = len(matches)
+                matches.append([match[0], match[1], list(match[2])])
+            tokens[token] = positions[match]
+        return {'matches': matches, 'tokens': tokens}
+
+    @staticmethod
+    def decode_index(data: object, cat_topics_model: dict):
+        """
+        Turns data from encode_index back into a compiled index of the topics
+        model. Raises ValueError if it isn't shaped like encode_index's, or
+        its parents aren't the model's.
+        """
+        if (not isinstance(data, dict) or not isinstance(data.get('matches'), list)
+                or not isinstance(data.get('tokens'), dict)):
+            raise ValueError("Not a compiled topics model")
+        matches = []
+        for match in data['matches']:
+            if (not isinstance(match, list) or len(match) != 3 or not isinstance(match[0], str)
+                    or not isinstance(match[1], (int, float)) or isinstance(match[1], bool)
+                    or not isinstance(match[2], list) or not all(isinstance(parent, str) for parent in match[2])):
+                raise ValueError("Malformed match in compiled topics model: " + repr(match)[:100])
+            parents = tuple(match[2])
+            if len(parents) > 1:
+                # Parents come out of a set(), whose order changes from process to
+                # process (and with the order items are added), so it's redone
+                # from the model's list, like compile does, to match
+                # determine_facts_hierarchy
+                vals = cat_topics_model.get(match[0])
+                if not isinstance(vals, dict) or set(vals.get('parents', ())) != set(parents):
+                    raise ValueError("Compiled topics model doesn't match parents of " + match[0])
+                parents = tuple(set(vals['parents']))
+            matches.append((match[0], match[1], parents))
+        index = {}
+        for token, position in data['tokens'].items():
+            if not isinstance(position, int) or isinstance(position, bool) or not 0 <= position < len(matches):
+                raise ValueError("Malformed token in compiled topics model: " + repr(token)[:100])
+            index[token] = matches[position]
+        return index
+
+    @staticmethod
+    def compile(cat_topics_model: dict, stem: object=None):
+        """
+        Inverts the topics model into a token -> (topic, depth, parents) dict,
+        with tokens folded by the stem function if there is one.
+        Every token of a topic shares one tuple, which keeps the index small.
+        """
+        if stem is None:
+            stem = str
+        index = {}
+        for _topic, vals in cat_topics_model.items():
+            # Later topics overwrite earlier ones, same as the nested loop
+            if 'matches' in vals:
+                if 'parents' in vals:
+                    # Keep the set() ordering determine_facts_hierarchy produces
+                    parents = tuple(set(vals['parents']))
+                else:
+                    parents = (_topic,)
+                match = (_topic, vals['weight'], parents)
+                for match_word in vals['matches']:
+                    index[stem(match_word)] = match
+            # A token equal to the topic name is checked before its matches,
+            # so it takes precedence within the same topic
+            index[stem(_topic)] = (_topic, vals['weight'], (_topic + "_root",))
+        return index
+
+    def lookup_token(self, token: str):
+        """
+        Returns the match of a raw token (folding it first if there's a
+        stemmer), and remembers it in the lookup memo.
+        """
+        match = self.index.get(token if self.stem is None else self.stem(token))
+        if len(self.lookup) >= STEM_CACHE_SIZE:
+            self.lookup.clear()
+        self.lookup[token] = match
+        return match
+
+    def classify(self, fact: str, tokens: list):
+        """
+        Returns the node (topic, depth, parents, fact) for a tokenized fact,
+        or None if no token is in the topics model.
+        """
+        lookup = self.lookup
+        for token in tokens:
+            try:
+                match = lookup[token]
+            except KeyError:
+                match = self.lookup_token(token)
+            if match is not None:
+                topic, depth, parents = match
+                return {'topic': topic, 'depth': depth,
+                        'parents': list(parents), 'fact': fact}
+        return None
+
+    def classify_text(self, fact: str):
+        """
+        Normalizes and tokenizes a fact, then classifies it (see classify).
+        """
+        return self.classify(fact, tokenize(fact))
+
+    def classify_batch(self, facts: list):
+        """
+        Classifies a list of facts, tokenizing them together (see
+        tokenize_facts). Returns a node or None for each fact.
+        """
+        classify = self.classify
+        start = time.perf_counter()
+        token_lists = tokenize_facts(facts)
+        tokenized = time.perf_counter()
+        results = [classify(fact, tokens) for fact, tokens in zip(facts, token_lists)]
+        metrics.record_stage('normalize', tokenized - start, len(facts))
+        metrics.record_stage('classify', time.perf_counter() - tokenized, len(facts))
+        return results
+
+    def iter_nodes(self, facts: object):
+        """
+        Classifies facts pulled from any iterable, TOKENIZE_BATCH_SIZE at a
+        time (see classify_batch), and yields node records as soon as their
+        batch is classified (see Cat_Facts_Tree.iter_fact_nodes).
+        """
+        seen_topics = set()
+        for batch in iter_batches(facts, TOKENIZE_BATCH_SIZE):
+            for fact_results in self.classify_batch(batch):
+                if fact_results is None:
+                    continue
+                topic = fact_results['topic']
+                if topic not in seen_topics:
+                    seen_topics.add(topic)
+                    if fact_results['depth'] == 1:
+                        yield {'topic': str(topic), 'depth': 0, 'parents': None, 'fact': None}
+                yield fact_results
+
+    def changed_tokens(self, other: object):
+        """
+        Returns the set of tokens that classify differently under another
+        classifier: tokens either one matches that the other doesn't, or
+        matches to a different topic, depth, or parents.
+        A fact can only be classified differently if it has one of them.
+        """
+        changed = set()
+        for token in self.index.keys() | other.index.keys():
+            match, other_match = self.index.get(token), other.index.get(token)
+            if match is None or other_match is None:
+                changed.add(token)
+            elif (match[0] != other_match[0] or match[1] != other_match[1]
+                    or set(match[2]) != set(other_match[2])):
+                changed.add(token)
+        return changed
+
+    def build_tree(self, facts: object):
+        """
+        Classifies facts into a tree_dicts dictionary, without printing.
+        """
+        tree_dicts = {}
+        for batch in iter_batches(facts, TOKENIZE_BATCH_SIZE):
+            for fact_results in self.classify_batch(batch):
+                if fact_results is not None:
+                    Cat_Facts_Tree.add_to_tree(tree_dicts, fact_results)
+        return tree_dicts
+
+
+# Compiled classifier of a classification worker process, set once by the pool initializer
+_worker_classifier = None
+
+def _init_classify_worker(classifier: object):
+    global _worker_classifier
+    _worker_classifier = classifier
+    return
+
+def _classify_chunk(facts: list):
+    return _worker_classifier.build_tree(facts)
+
+
+class Cat_Facts_Fetcher():
+    """
+    Fetches every page of facts from the Cat Fact API. The first page tells
+    us last_page, and the rest are fetched by a bounded pool of threads; if
+    the API doesn't give last_page, pages are followed one at a time through
+    next_page_url.
+
+    Each request has a timeout, and failed requests (connection errors,
+    timeouts, 429s and 5xxs) are retried with exponential backoff and
+    jitter. Facts are deduplicated by a hash of their text, since pages can
+    overlap if the API changes while we're paging through it.
+    """
+    def __init__(self, api_endpoint: str=API_ENDPOINT, workers: int=REQ_THREAD_COUNT,
+                 timeout: float=REQ_TIMEOUT_SECONDS, retries: int=REQ_RETRIES,
+                 backoff: float=REQ_BACKOFF_SECONDS, max_backoff: float=REQ_MAX_BACKOFF_SECONDS):
+        self.api_endpoint = api_endpoint
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.seen = set() # Hashes of facts already yielded
+        self.stats_lock = Lock()
+        self.stats = {'pages': 0, 'requests': 0, 'retries': 0, 'failed_pages': 0,
+                      'facts': 0, 'duplicates': 0}
+        return
+
+    def page_url(self, page: int):
+        """
+        Returns the API endpoint URL for a page number.
+        """
+        parts = urlsplit(self.api_endpoint)
+        query = [(key, val) for key, val in parse_qsl(parts.query) if key != 'page']
+        query.append(('page', str(page)))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def fetch_json(self, url: str):
+        """
+        Gets a JSON response, retrying failed requests with exponential
+        backoff (with full jitter, so workers don't retry in lockstep).
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.get_json(url)
+            except Exception as err:
+                delay = self.retry_delay(url, err, attempt)
+                attempt += 1
+                time.sleep(delay)
+
+    async def fetch_json_async(self, url: str, semaphore: object, executor: object):
+        """
+        asyncio version of fetch_json. The request runs in executor (there's
+        no async HTTP client in the standard lib) while holding semaphore,
+        and the backoff between retries is awaited without holding it.
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    return await loop.run_in_executor(executor, self.get_json, url)
+            except Exception as err:
+                delay = self.retry_delay(url, err, attempt)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def get_json(self, url: str):
+        """
+        Makes one request, with a timeout, and parses the JSON response.
+        """
+        with self.stats_lock:
+            self.stats['requests'] += 1
+        metrics.inc('cat_facts_fetch_requests_total')
+        with metrics.time_stage('fetch'):
+            with urlopen(url, timeout=self.timeout) as response:
+                return json.loads(response.read())
+
+    def retry_delay(self, url: str, err: Exception, attempt: int):
+        """
+        Returns how long to wait before retrying a failed request, or re-raises
+        err if it can't be retried (4xx other than 429, or out of retries).
+        """
+        retryable = not isinstance(err, HTTPError) or err.code == 429 or err.code >= 500
+        if not retryable or attempt >= self.retries:
+            raise err
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        with self.stats_lock:
+            self.stats['retries'] += 1
+        metrics.inc('cat_facts_fetch_retries_total')
+        log.warning("Retrying url=%s delay=%.2fs attempt=%d error=%s", url, delay, attempt + 1, err)
+        return delay
+
+    def new_facts(self, data: dict):
+        """
+        Returns the facts in a page that haven't been seen yet.
+        """
+        facts = []
+        duplicates = 0
+        for item in data['data']:
+            fact = item['fact']
+            digest = hashlib.sha1(fact.encode('utf-8')).digest()
+            if digest in self.seen:
+                duplicates += 1
+                continue
+            self.seen.add(digest)
+            facts.append(fact)
+        with self.stats_lock:
+            self.stats['pages'] += 1
+            self.stats['facts'] += len(facts)
+            self.stats['duplicates'] += duplicates
+        return facts
+
+    def iter_facts(self):
+        """
+        Yields every (unique) fact from every page, as pages come in.
+        Workers only fetch up to 2 * workers pages ahead of the caller, so
+        a slow consumer (like db writes when streaming) keeps memory bounded.
+
+        Raises OSError at the end if any page still failed after retrying,
+        so a partial ingest isn't mistaken for a complete one.
+        """
+        first = self.fetch_json(self.page_url(1))
+        yield from self.new_facts(first)
+        last_page = first.get('last_page')
+        if last_page is None:
+            next_url = first.get('next_page_url')
+            while next_url:
+                data = self.fetch_json(next_url)
+                yield from self.new_facts(data)
+                next_url = data.get('next_page_url')
+            return
+        pages = queue.Queue()
+        for page in range(2, int(last_page) + 1):
+            pages.put(page)
+        if pages.empty():
+            return
+        results = queue.Queue(maxsize=self.workers * 2) # Bounded, so fetching can't run far ahead
+        stop = Event() # Set if the generator is closed early, so blocked workers give up
+        failed = []
+        for i in range(min(self.workers, pages.qsize())):
+            # Daemon threads, so an abandoned generator doesn't keep the program alive
+            worker = Thread(target=self.fetch_pages, args=(pages, results, stop), daemon=True)
+            worker.start()
+        try:
+            for i in range(int(last_page) - 1):
+                page, data, err = results.get()
+                if err is not None:
+                    log.error("Failed to fetch page=%d error=%s", page, err)
+                    failed.append(page)
+                    continue
+                yield from self.new_facts(data)
+        finally:
+            stop.set()
+        if failed:
+            with self.stats_lock:
+                self.stats['failed_pages'] += len(failed)
+            metrics.inc('cat_facts_fetch_failed_pages_total', len(failed))
+            raise OSError("Couldn't fetch pages " + str(sorted(failed)) + " from " + self.api_endpoint)
+
+    async def produce_pages_async(self, pages: object):
+        """
+        asyncio version of iter_facts. Fetches up to self.workers pages at
+        once and puts each page's (unique) facts on the pages asyncio.Queue
+        as soon as it arrives, then None when every page is done.
+
+        Raises OSError at the end if any page still failed after retrying.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+        executor = ThreadPoolExecutor(self.workers)
+        failed = []
+
+        async def fetch_page(page: int):
+            try:
+                data = await self.fetch_json_async(self.page_url(page), semaphore, executor)
+            except Exception as err:
+                log.error("Failed to fetch page=%d error=%s", page, err)
+                failed.append(page)
+                return
+            await pages.put(self.new_facts(data))
+
+        try:
+            first = await self.fetch_json_async(self.page_url(1), semaphore, executor)
+            await pages.put(self.new_facts(first))
+            last_page = first.get('last_page')
+            if last_page is None:
+                next_url = first.get('next_page_url')
+                while next_url:
+                    data = await self.fetch_json_async(next_url, semaphore, executor)
+                    await pages.put(self.new_facts(data))
+                    next_url = data.get('next_page_url')
+            else:
+                await asyncio.gather(*[fetch_page(page) for page in range(2, int(last_page) + 1)])
+        finally:
+            executor.shutdown(wait=False)
+            await pages.put(None)
+        if failed:
+            with self.stats_lock:
+                self.stats['failed_pages'] += len(failed)
+            metrics.inc('cat_facts_fetch_failed_pages_total', len(failed))
+            raise OSError("Couldn't fetch pages " + str(sorted(failed)) + " from " + self.api_endpoint)
+        return
+
+    def fetch_pages(self, pages: object, results: object, stop: object):
+        """
+        Worker thread: fetches page numbers off the pages queue until it's
+        empty, putting (page, data, error) on the results queue. Waits for
+        room on the results queue, until stop is set.
+        """
+        while not stop.is_set():
+            try:
+                page = pages.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (page, self.fetch_json(self.page_url(page)), None)
+            except Exception as err:
+                result = (page, None, err)
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+
 # Main class
 class Cat_Facts_Tree():
     """
@@ -187,37 +1211,29 @@ class Cat_Facts_Tree():
     roots, we will use a dictionary that stores references to multiple
     trees. So technically it could called Cat_Facts_Trees.
 
-    In the future it would be better to create an actual Tree class
-    with class methods / properties, and to store the fact hierarchies
-    in that, but for now we can make do with a list of dictionaries with 
-    properties of name, depth, and parents. 
+    Classification produces a list of dictionaries with properties of
+    name, depth, and parents (tree_dicts), which is what gets saved into
+    the db. To traverse the hierarchies, build a Cat_Facts_Forest from it.
     """
-    def __init__(self):
+    def __init__(self, cat_topics_model: dict=None):
         self.cftr = Cat_Facts_Tree_Records()
+        self.cat_topics_model = default_topic_model() if cat_topics_model is None else cat_topics_model
+        self.classifier = None # Compiled topics model, loaded on first use
         return
 
-    def save_to_db_clean(self, tree_data: dict):
+    def save_to_db_clean(self, tree_data: dict, batch_size: int=WRITE_BATCH_SIZE, quiet: bool=False):
         """
         Erases existing table and saves the final tree data into the database wrapper.
         """
-        self.cftr.save_to_db_clean(tree_data)
+        self.cftr.save_to_db_clean(tree_data, batch_size, quiet, self.get_classifier())
         return
 
-    def normalize_text(self, text: str):
+    @staticmethod
+    def normalize_text(text: str):
         """ 
         Cleans up text (lower-cases and strips punctuation).
         """
-        table = str.maketrans({key: None for key in string.punctuation})
-        normalized_text = text.translate(table)
-        normalized_text = normalized_text.lower().strip()
-        normalized_text = normalized_text.replace("’", "")
-        normalized_text = normalized_text.replace("'", "")
-        normalized_text = normalized_text.replace('"', "")
-        normalized_text = normalized_text.replace(")", "")
-        normalized_text = normalized_text.replace("(", "")
-        normalized_text = normalized_text.replace("“", "")
-        # print("Normalized: ", normalized_text)
-        return normalized_text
+        return normalize_text(text)
 
     def determine_facts_hierarchy(self, facts: list, cat_topics_model: dict):
         """
@@ -306,226 +1322,1897 @@ class Cat_Facts_Tree():
                 #     # print("\tPutting fact in misc: ", greatest_weight, " : ", fact)
                 #     found = True
             if found:
-                if topic in tree_dicts:
-                    # print("\n\nAppending fact to topic vals: ", topic, " - ", fact_results, vals)
-                    vals = tree_dicts[topic]
-                    vals.append(fact_results)
-                    tree_dicts[topic] = vals
-                else:
-                    # We are adding a fact to a new topic for the first time
-                    # Check to see if that fact has a depth of 1, and if so, we should create
-                    # a root node to house the new hierachy.
-                    vals = []
-                    if fact_results['depth'] is 1:
-                        # print("CREATE ROOT NODE: ", fact_results)
-                        # The root node acts as a label, so it contains no fact payload / info
-                        # Because it is a label, differentiate the node keyby appending '_root',
-                        # so we know it's the start of a new hierarchy.
-                        _root = {'topic': str(fact_results['topic']),
-                                'depth': 0, 'parents': None, 'fact': None}
-                        tree_dicts[topic + '_root'] = _root
-                    vals.append(fact_results)
-                    tree_dicts[topic] = vals
-        print("\n\nPrinting final tree results from classification of cat facts..\n\n")
-        for each in tree_dicts.keys():
-            print("\nNodes for topic: ", each)
-            node = tree_dicts[each]
-            if len(node) > 1 and type(node) is list:
-                for _each in tree_dicts[each]:
-                    print("\t", _each)
-            else:
-                print("\t(ROOT) ", tree_dicts[each])
+                self.add_to_tree(tree_dicts, fact_results)
+        self.print_tree(tree_dicts)
         return tree_dicts
 
-    def fetch_from_queue(self, queue: object, results: list):
+    def classify_facts(self, facts: list, classifier: object=None, verbose: bool=True):
         """
-        Makes request to each URL found in queue. 
+        Same as determine_facts_hierarchy, but classifies through a compiled
+        Cat_Facts_Tree_Classifier, so each token costs one dict lookup instead
+        of a scan over every topic and its matches.
         """
-        while not queue.empty():
-            task = queue.get()
-            # Putting a try / except here slows the requests down, but 
-            # prevents them from being a single point of failure
-            try:
-                data = json.loads(urlopen(task).read())
-                # Now that our API endpoint returns a list of facts,
-                # we iterate through that
-                for item in data['data']:
-                    results.append(item['fact'])
-            except Exception as err:
-                print(err)
-            queue.task_done()
-        return results
+        if classifier is None:
+            classifier = self.get_classifier()
+        tree_dicts = classifier.build_tree(facts)
+        if verbose:
+            self.print_tree(tree_dicts)
+        return tree_dicts
 
-    def make_queue(self, api_endpoint:str=API_ENDPOINT, max_size:int=MAX_SIZE):
+    def classify_facts_parallel(self, facts: list, classifier: object=None,
+                                processes: int=CLASSIFY_PROCESS_COUNT, chunk_size: int=None,
+                                verbose: bool=True):
         """
-        Creates a queue to hit an API endpoint X amount of times.
+        Same as classify_facts, but splits the facts into chunks and classifies
+        them across a pool of worker processes. The compiled classifier is sent
+        to each worker once when the pool starts, not with every chunk.
+
+        Each chunk comes back as its own tree_dicts, and they're merged in
+        chunk order, so the result (root nodes, and the order of facts in each
+        topic) is identical to classifying everything in one process.
         """
-        q = queue.Queue(maxsize=max_size)
-        # load up the queue with 100 requests to same URL,
-        # since the endpoint only returns one random fact
-        # at a time. Tthis could easily be extended to
-        # make requests to a list of different URLs.
-        for i in range(0, max_size):
-            q.put(api_endpoint)
-        return q
+        if classifier is None:
+            classifier = self.get_classifier()
+        if processes <= 1:
+            return self.classify_facts(facts, classifier, verbose)
+        if chunk_size is None:
+            chunk_size = max(1, math.ceil(len(facts) / (processes * CLASSIFY_CHUNKS_PER_PROCESS)))
+        chunks = (facts[i:i + chunk_size] for i in range(0, len(facts), chunk_size))
+        with Pool(processes, initializer=_init_classify_worker, initargs=(classifier,)) as pool:
+            # imap hands back results in the order the chunks were submitted
+            tree_dicts = self.merge_trees(pool.imap(_classify_chunk, chunks))
+        if verbose:
+            self.print_tree(tree_dicts)
+        return tree_dicts
 
-    def make_cat_facts_tree(self):
+    @staticmethod
+    def merge_trees(trees: object):
+        """
+        Merges tree_dicts classified from consecutive chunks of facts into one,
+        in order. Topics keep the position of their first fact, and a root node
+        is only kept from the first chunk that created it.
+        """
+        merged = {}
+        for tree_dicts in trees:
+            for key, node in tree_dicts.items():
+                if type(node) is list:
+                    if key in merged:
+                        merged[key].extend(node)
+                    else:
+                        merged[key] = node
+                elif key not in merged:
+                    merged[key] = node
+        return merged
+
+    def iter_fact_nodes(self, facts: object, classifier: object=None):
+        """
+        Streaming version of classify_facts. Pulls facts from any iterable
+        one at a time and yields node records as soon as they're classified,
+        instead of building tree_dicts in memory.
+
+        A root node is yielded right before the first fact of a new depth 1
+        topic, so the records come out in the same shape as tree_dicts.
+        Only the set of topics seen so far is kept around.
+        """
+        if classifier is None:
+            classifier = self.get_classifier()
+        return classifier.iter_nodes(facts)
+
+    def get_classifier(self, cat_topics_model: dict=None):
+        """
+        Returns the compiled classifier for the topics model, loading it
+        (see Cat_Facts_Tree_Classifier.load) the first time it's needed.
+        """
+        if cat_topics_model is not None:
+            return Cat_Facts_Tree_Classifier.load(cat_topics_model, stemmer=TOKEN_STEMMER)
+        if self.classifier is None:
+            self.classifier = Cat_Facts_Tree_Classifier.load(self.cat_topics_model, stemmer=TOKEN_STEMMER)
+        return self.classifier
+
+    @staticmethod
+    def add_to_tree(tree_dicts: dict, fact_results: dict):
+        """
+        Adds a classified fact (node) to its topic in tree_dicts, creating the
+        root node of a new hierarchy if needed.
+        """
+        topic = fact_results['topic']
+        if topic in tree_dicts:
+            tree_dicts[topic].append(fact_results)
+        else:
+            # We are adding a fact to a new topic for the first time
+            # Check to see if that fact has a depth of 1, and if so, we should create
+            # a root node to house the new hierachy.
+            if fact_results['depth'] == 1:
+                # The root node acts as a label, so it contains no fact payload / info
+                # Because it is a label, differentiate the node keyby appending '_root',
+                # so we know it's the start of a new hierarchy.
+                _root = {'topic': str(topic),
+                        'depth': 0, 'parents': None, 'fact': None}
+                tree_dicts[topic + '_root'] = _root
+            tree_dicts[topic] = [fact_results]
+        return tree_dicts
+
+    def print_tree(self, tree_dicts: dict):
+        """
+        Logs every node in tree_dicts, grouped by topic, at DEBUG level.
+        Nothing is formatted unless DEBUG logging is on, since that's one
+        line per fact.
+        """
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        log.debug("Final tree results from classification of cat facts:")
+        for each in tree_dicts.keys():
+            log.debug("Nodes for topic=%s", each)
+            node = tree_dicts[each]
+            if len(node) > 1 and type(node) is list:
+                for _each in tree_dicts[each]:
+                    log.debug("\t%s", _each)
+            else:
+                log.debug("\t(ROOT) %s", tree_dicts[each])
+        return
+
+    def make_cat_facts_tree(self, processes: int=CLASSIFY_PROCESS_COUNT, threads: int=REQ_THREAD_COUNT):
         """
         Main function to classify cat facts into a hierarchical data structure. 
-        Uses multithreading to do tasks in a queue.
-        """
-        results = [] # Facts can come in in any order
-        facts_queue = self.make_queue(API_ENDPOINT, MAX_SIZE)
-        print("\nMaking ", MAX_SIZE, " requests to ", API_ENDPOINT+"\n")
-        for i in range(REQ_THREAD_COUNT):
-            worker = Thread(target=self.fetch_from_queue, args=(facts_queue, results))
-            worker.setDaemon(True)  # Setting threads as "daemon" allows main program to 
-                                    # exit eventually even if these dont finish 
-                                    # correctly. 
-                                    # (https://www.shanelynn.ie/using-python-threading-for-multiple-results-queue/)
-            print("Starting worker ", i, worker)
-            worker.start()
-        facts_queue.join()
-        print("\n\nFinished getting ", len(results), " results. Now building tree hierarchy using weighted bag-of-words model..\n\n")
-        tree_results = self.determine_facts_hierarchy(results, weighted_topic_vals)
-        print("\n\nFinished getting tree hierarchy of cat facts. Now saving into db..")
+        Fetches pages of the API with multiple threads (see Cat_Facts_Fetcher),
+        and classifies with multiple processes if processes > 1.
+        """
+        fetcher = Cat_Facts_Fetcher(API_ENDPOINT, threads)
+        log.info("Fetching pages from endpoint=%s threads=%d", API_ENDPOINT, threads)
+        results = list(fetcher.iter_facts()) # Facts can come in in any order
+        log.info("Fetched facts=%d, building tree hierarchy with the weighted bag-of-words model", len(results))
+        tree_results = self.classify_facts_parallel(results, self.get_classifier(), processes)
+        log.info("Built tree hierarchy of cat facts")
         return tree_results
 
+    async def make_cat_facts_tree_async(self, concurrency: int=REQ_THREAD_COUNT,
+                                        api_endpoint: str=API_ENDPOINT, verbose: bool=True):
+        """
+        asyncio version of make_cat_facts_tree. Up to concurrency pages are
+        fetched at once, and each page is classified as soon as it comes off
+        the queue, so classifying overlaps with waiting on the API instead
+        of starting after every page is in.
+        """
+        fetcher = Cat_Facts_Fetcher(api_endpoint, concurrency)
+        if verbose:
+            log.info("Fetching pages from endpoint=%s concurrency=%d", api_endpoint, concurrency)
+        pages = asyncio.Queue(maxsize=concurrency * 2) # Bounded, so fetching can't run far ahead
+        producer = asyncio.create_task(fetcher.produce_pages_async(pages))
+        classifier = self.get_classifier()
+        tree_dicts = {}
+        while True:
+            facts = await pages.get()
+            if facts is None:
+                break
+            for fact_results in classifier.classify_batch(facts):
+                if fact_results is not None:
+                    self.add_to_tree(tree_dicts, fact_results)
+        await producer # Raises if any page failed
+        if verbose:
+            self.print_tree(tree_dicts)
+        return tree_dicts
+
+    def make_cat_facts_tree_stream(self, facts: object=None, batch_size: int=WRITE_BATCH_SIZE,
+                                   quiet: bool=False):
+        """
+        Streaming version of make_cat_facts_tree followed by save_to_db_clean.
+        Facts are pulled from an iterator (the API by default), classified as
+        they arrive, and written to the db in batches of batch_size nodes, so
+        memory stays constant no matter how many facts there are.
+
+        Returns the number of records saved.
+        """
+        if facts is None:
+            log.info("Streaming pages from endpoint=%s threads=%d", API_ENDPOINT, REQ_THREAD_COUNT)
+            facts = Cat_Facts_Fetcher(API_ENDPOINT, REQ_THREAD_COUNT).iter_facts()
+        classifier = self.get_classifier()
+        nodes = self.iter_fact_nodes(facts, classifier)
+        return self.cftr.save_stream_to_db_clean(nodes, batch_size, quiet, classifier)
+
+    def make_cat_facts_tree_incremental(self, facts: object=None, batch_size: int=WRITE_BATCH_SIZE,
+                                        quiet: bool=False):
+        """
+        Incremental version of make_cat_facts_tree_stream. Instead of
+        rebuilding the table, only facts that aren't in the db yet are
+        classified and saved, and if the topics model changed since the last
+        run, only the saved facts it affects are re-classified (see
+        Cat_Facts_Tree_Records.save_incremental).
+
+        Returns counts of the facts skipped, saved, re-classified, and removed.
+        """
+        if facts is None:
+            log.info("Streaming pages from endpoint=%s threads=%d", API_ENDPOINT, REQ_THREAD_COUNT)
+            facts = Cat_Facts_Fetcher(API_ENDPOINT, REQ_THREAD_COUNT).iter_facts()
+        return self.cftr.save_incremental(facts, self.get_classifier(), batch_size, quiet)
+
+
+# Binary tree files (see write_tree_file and Cat_Facts_Tree_File). All integers are little endian.
+TREE_FILE_MAGIC = b"CATTREE\0"
+TREE_FILE_FORMAT = 2 # Bumped whenever the layout changes; readers refuse other versions
+# magic, format, flags (unused), topic count, node count, parent id count, then the offsets of the
+# topic table, parent ids, node records, and string heap, the heap's size, and the offset and length
+# in the heap of the classifier's topics model and stemmer (as JSON; length 0 if there's none)
+TREE_FILE_HEADER = struct.Struct("<8sHHIIIQQQQQQI4x")
+# Topic: name offset and length in the heap, then its first node and how many nodes it has
+TREE_FILE_TOPIC = struct.Struct("<QIII4x")
+# Node: topic id, depth, flags, offset and count of its parents in the parent ids, then its fact's
+# offset and length in the heap
+TREE_FILE_NODE = struct.Struct("<IHHIH2xQI4x")
+TREE_FILE_ROOT = 1 # Node flag: a root node (no parents)
+TREE_FILE_NO_FACT = 2 # Node flag: the node has no fact
+
+
+def write_tree_file(path: str, nodes: object, classifier: object=None):
+    """
+    Writes nodes (like iter_tree_nodes of classify_facts' tree_dicts) to a
+    binary tree file that Cat_Facts_Tree_File can mmap:
+
+    header | topic table | parent ids | node records | string heap
+
+    Topic names are interned once in the topic table, and each distinct
+    parents list once in the parent ids (as topic ids). Node records are
+    fixed width, grouped by topic (topics in the order they first appear,
+    which is tree_dicts' order), so a topic's nodes are one contiguous
+    slice. Facts and topic names are packed UTF-8 in the heap, along with
+    the topics model and stemmer of the classifier the nodes came from,
+    if it's given, so they can be saved with the nodes when they're
+    imported.
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see half of one. Returns the number of nodes written.
+    """
+    topic_ids = {}
+    topic_names = []
+
+    def intern_topic(name: str):
+        topic_id = topic_ids.get(name)
+        if topic_id is None:
+            topic_id = topic_ids[name] = len(topic_names)
+            topic_names.append(name)
+        return topic_id
+
+    topic_nodes = {} # Topic id -> its nodes, in order
+    for node in nodes:
+        topic_nodes.setdefault(intern_topic(str(node['topic'])), []).append(node)
+    heap = io.BytesIO()
+    parent_lists = {} # Parent topic ids -> offset in parent_ids
+    parent_ids = []
+    records = bytearray()
+    node_ranges = {}
+    node_count = 0
+    for topic_id, topic_node_list in topic_nodes.items():
+        node_ranges[topic_id] = (node_count, len(topic_node_list))
+        for node in topic_node_list:
+            flags = 0
+            parents_offset = parents_count = 0
+            if node['parents'] is None:
+                flags |= TREE_FILE_ROOT
+            else:
+                parents = tuple([intern_topic(str(parent)) for parent in node['parents']])
+                parents_offset = parent_lists.get(parents)
+                if parents_offset is None:
+                    parents_offset = parent_lists[parents] = len(parent_ids)
+                    parent_ids.extend(parents)
+                parents_count = len(parents)
+            fact_offset = fact_length = 0
+            if node['fact'] is None:
+                flags |= TREE_FILE_NO_FACT
+            else:
+                fact = str(node['fact']).encode('utf-8')
+                fact_offset, fact_length = heap.tell(), len(fact)
+                heap.write(fact)
+            records += TREE_FILE_NODE.pack(topic_id, int(node['depth']), flags, parents_offset, parents_count,
+                                           fact_offset, fact_length)
+            node_count += 1
+    topic_table = bytearray()
+    for topic_id, name in enumerate(topic_names):
+        encoded = name.encode('utf-8')
+        first_node, count = node_ranges.get(topic_id, (0, 0))
+        topic_table += TREE_FILE_TOPIC.pack(heap.tell(), len(encoded), first_node, count)
+        heap.write(encoded)
+    model_offset = model_length = 0
+    if classifier is not None:
+        encoded = json.dumps({'model': classifier.cat_topics_model, 'stemmer': classifier.stemmer}).encode('utf-8')
+        model_offset, model_length = heap.tell(), len(encoded)
+        heap.write(encoded)
+    parent_bytes = struct.pack("<" + str(len(parent_ids)) + "I", *parent_ids)
+    topics_offset = TREE_FILE_HEADER.size
+    parents_offset = topics_offset + len(topic_table)
+    nodes_offset = parents_offset + len(parent_bytes)
+    heap_offset = nodes_offset + len(records)
+    header = TREE_FILE_HEADER.pack(TREE_FILE_MAGIC, TREE_FILE_FORMAT, 0, len(topic_names), node_count,
+                                   len(parent_ids), topics_offset, parents_offset, nodes_offset, heap_offset,
+                                   heap.tell(), model_offset, model_length)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, 'wb') as tree_file:
+        for section in (header, topic_table, parent_bytes, records, heap.getbuffer()):
+            tree_file.write(section)
+    os.replace(tmp_path, path)
+    return node_count
+
+
+class Cat_Facts_Tree_File():
+    """
+    Reads a binary tree file (see write_tree_file) through mmap, so opening
+    one costs the same no matter how many facts it has, and only the pages
+    that are read are loaded (and shared between processes reading the
+    same file).
+
+    Only topic names are decoded up front. Node records are unpacked, and
+    facts decoded, as they're read; fact_bytes gives a fact without
+    copying it at all.
+
+    If the file was written with a classifier, its topics model and
+    stemmer are in model and stemmer (model is None otherwise).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as tree_file:
+            self.mmap = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        if len(self.buffer) < TREE_FILE_HEADER.size:
+            self.close()
+            raise ValueError(path + " is too short to be a cat facts tree file")
+        magic, file_format = struct.unpack_from("<8sH", self.buffer)
+        if magic != TREE_FILE_MAGIC:
+            self.close()
+            raise ValueError(path + " is not a cat facts tree file")
+        if file_format != TREE_FILE_FORMAT:
+            self.close()
+            raise ValueError(path + " is tree file format " + str(file_format) + ", expected "
+                             + str(TREE_FILE_FORMAT))
+        (magic, file_format, flags, self.topic_count, self.node_count, parent_id_count, self.topics_offset,
+         self.parents_offset, self.nodes_offset, self.heap_offset, heap_size, model_offset,
+         model_length) = TREE_FILE_HEADER.unpack_from(self.buffer)
+        sections = [(self.topics_offset, self.topic_count * TREE_FILE_TOPIC.size),
+                    (self.parents_offset, parent_id_count * 4),
+                    (self.nodes_offset, self.node_count * TREE_FILE_NODE.size),
+                    (self.heap_offset, heap_size)]
+        if (any(offset + size > len(self.buffer) for offset, size in sections)
+                or model_offset + model_length > heap_size):
+            self.close()
+            raise ValueError(path + " is truncated")
+        self.records = self.buffer[self.nodes_offset:self.nodes_offset + self.node_count * TREE_FILE_NODE.size]
+        self.topic_names = [] # Topic id -> name
+        self.topic_ids = {} # Name -> topic id
+        self.topic_ranges = [] # Topic id -> (first node, node count)
+        for topic_id, (name_offset, name_length, first_node, count) in enumerate(TREE_FILE_TOPIC.iter_unpack(
+                self.buffer[self.topics_offset:self.topics_offset + self.topic_count * TREE_FILE_TOPIC.size])):
+            name = sys.intern(self.heap_string(name_offset, name_length))
+            self.topic_names.append(name)
+            self.topic_ids[name] = topic_id
+            self.topic_ranges.append((first_node, count))
+        # Parents lists are interned, so there are only a few of these
+        self.parent_names = [self.topic_names[parent_id] for (parent_id,) in struct.iter_unpack(
+            "<I", self.buffer[self.parents_offset:self.parents_offset + parent_id_count * 4])]
+        self.model = self.stemmer = None
+        if model_length:
+            saved = json.loads(self.heap_string(model_offset, model_length))
+            self.model, self.stemmer = saved['model'], saved['stemmer']
+        return
+
+    def heap_string(self, offset: int, length: int):
+        start = self.heap_offset + offset
+        return str(self.buffer[start:start + length], 'utf-8')
+
+    def fact_bytes(self, index: int):
+        """
+        Returns the UTF-8 fact of a node as a memoryview into the file
+        (no copy), or None if it has none.
+        """
+        topic_id, depth, flags, parents_offset, parents_count, fact_offset, fact_length = \
+            TREE_FILE_NODE.unpack_from(self.records, index * TREE_FILE_NODE.size)
+        if flags & TREE_FILE_NO_FACT:
+            return None
+        start = self.heap_offset + fact_offset
+        return self.buffer[start:start + fact_length]
+
+    def make_node(self, record: tuple):
+        topic_id, depth, flags, parents_offset, parents_count, fact_offset, fact_length = record
+        parents = None
+        if not flags & TREE_FILE_ROOT:
+            parents = self.parent_names[parents_offset:parents_offset + parents_count]
+        fact = None
+        if not flags & TREE_FILE_NO_FACT:
+            fact = self.heap_string(fact_offset, fact_length)
+        return {'topic': self.topic_names[topic_id], 'depth': depth, 'parents': parents, 'fact': fact}
+
+    def node(self, index: int):
+        """
+        Returns one node, in the same shape as tree_dicts' nodes.
+        """
+        if not 0 <= index < self.node_count:
+            raise IndexError("Node " + str(index) + " is out of range")
+        return self.make_node(TREE_FILE_NODE.unpack_from(self.records, index * TREE_FILE_NODE.size))
+
+    def iter_nodes(self, start: int=0, stop: int=None):
+        """
+        Yields nodes start to stop (every node by default), in file order.
+        """
+        stop = self.node_count if stop is None else min(stop, self.node_count)
+        # make_node, inlined: this is the loop that loads whole files
+        file_map, heap_offset = self.mmap, self.heap_offset
+        topic_names, parent_names = self.topic_names, self.parent_names
+        records = self.records[start * TREE_FILE_NODE.size:stop * TREE_FILE_NODE.size]
+        for topic_id, depth, flags, parents_offset, parents_count, fact_offset, fact_length in \
+                TREE_FILE_NODE.iter_unpack(records):
+            if flags:
+                parents = None if flags & TREE_FILE_ROOT else \
+                    parent_names[parents_offset:parents_offset + parents_count]
+                fact = None if flags & TREE_FILE_NO_FACT else \
+                    file_map[heap_offset + fact_offset:heap_offset + fact_offset + fact_length].decode('utf-8')
+            else:
+                parents = parent_names[parents_offset:parents_offset + parents_count]
+                fact = file_map[heap_offset + fact_offset:heap_offset + fact_offset + fact_length].decode('utf-8')
+            yield {'topic': topic_names[topic_id], 'depth': depth, 'parents': parents, 'fact': fact}
+
+    def topic_nodes(self, topic: str):
+        """
+        Yields the nodes of one topic (its root node first, if it has one),
+        reading only that topic's slice of the node records.
+        """
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            return iter(())
+        first_node, count = self.topic_ranges[topic_id]
+        return self.iter_nodes(first_node, first_node + count)
+
+    def to_tree_dicts(self):
+        """
+        Rebuilds the tree_dicts the file was written from.
+        """
+        tree_dicts = {}
+        for node in self.iter_nodes():
+            if node['parents'] is None and node['depth'] == 0:
+                tree_dicts[node['topic'] + '_root'] = node
+            else:
+                tree_dicts.setdefault(node['topic'], []).append(node)
+        return tree_dicts
+
+    def __len__(self):
+        return self.node_count
+
+    def close(self):
+        """
+        Unmaps the file. Memoryviews from fact_bytes have to be released first.
+        """
+        for view in ('records', 'buffer'):
+            if getattr(self, view, None) is not None:
+                getattr(self, view).release()
+                setattr(self, view, None)
+        self.mmap.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return
+
+
+class Cat_Facts_Forest():
+    """
+    The fact hierarchies as an actual tree structure (a forest, since there's
+    one tree per root topic), built from tree_dicts or from db rows.
+
+    Topics are the inner nodes: each topic has one parent topic (root labels
+    like "cat_root" have none), a depth, and child topics. Facts are leaves
+    under their topic. Everything is stored in flat arrays indexed by topic
+    id or fact index, with topic names interned once, instead of a dict per
+    node with its parents repeated as a comma separated string.
+
+    Parent order comes from the topics model, whose parents lists go from
+    the root down (the parents saved with each fact come out of a set(), so
+    their order is arbitrary).
+    """
+    def __init__(self, cat_topics_model: dict=None):
+        self.cat_topics_model = default_topic_model() if cat_topics_model is None else cat_topics_model
+        self.topic_names = [] # Topic id -> name
+        self.topic_ids = {} # Name -> topic id
+        self.topic_parent = array('i') # Topic id -> parent topic id, -1 for roots
+        self.topic_depth = array('i') # Topic id -> depth
+        self.topic_children = [] # Topic id -> list of child topic ids
+        self.topic_facts = [] # Topic id -> array of fact indexes, in the order they were added
+        self.fact_topic = array('i') # Fact index -> topic id
+        self.fact_ids = array('q') # Fact index -> db ID (-1 if it didn't come from the db)
+        self.fact_text = [] # Fact index -> fact
+        return
+
+    @classmethod
+    def from_tree_dicts(cls, tree_dicts: dict, cat_topics_model: dict=None):
+        """
+        Builds a forest from the output of Cat_Facts_Tree.classify_facts.
+        """
+        forest = cls(cat_topics_model)
+        for node in iter_tree_nodes(tree_dicts):
+            forest.add_node(node)
+        return forest
+
+    @classmethod
+    def from_rows(cls, rows: object, cat_topics_model: dict=None):
+        """
+        Builds a forest from db rows (see Cat_Facts_Tree_Records.iter_all),
+        where parents are comma separated strings.
+        """
+        forest = cls(cat_topics_model)
+        for row in rows:
+            parents = row['parents']
+            if parents is None or parents == "none":
+                parents = None
+            else:
+                parents = parents.split(", ")
+            forest.add_node({'topic': row['topic'], 'depth': row['depth'], 'parents': parents,
+                             'fact': row['fact']}, row.get('id', -1))
+        return forest
+
+    def add_topic(self, topic: str, ancestors: list):
+        """
+        Adds a topic (and any of its ancestors that are missing) and returns
+        its id. ancestors go from the root down to the topic's parent.
+        """
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is not None:
+            return topic_id
+        parent_id = -1
+        if ancestors:
+            parent_id = self.add_topic(ancestors[-1], ancestors[:-1])
+        topic = sys.intern(topic)
+        topic_id = len(self.topic_names)
+        self.topic_names.append(topic)
+        self.topic_ids[topic] = topic_id
+        self.topic_parent.append(parent_id)
+        self.topic_depth.append(len(ancestors))
+        self.topic_children.append([])
+        self.topic_facts.append(array('i'))
+        if parent_id != -1:
+            self.topic_children[parent_id].append(topic_id)
+        return topic_id
+
+    def add_node(self, node: dict, db_id: int=-1):
+        """
+        Adds a node from tree_dicts. Root nodes (depth 0, no fact) only add
+        their root label topic; fact nodes are added under their topic.
+        """
+        topic = node['topic']
+        if node['depth'] == 0 and node['parents'] is None:
+            self.add_topic(topic + "_root", [])
+            return
+        topic_id = self.add_topic(topic, topic_ancestors(topic, node['parents'], self.cat_topics_model))
+        self.topic_facts[topic_id].append(len(self.fact_text))
+        self.fact_topic.append(topic_id)
+        self.fact_ids.append(db_id)
+        self.fact_text.append(node['fact'])
+        return
+
+    def parent(self, topic: str):
+        """
+        Returns the parent topic of a topic, or None for a root.
+        """
+        parent_id = self.topic_parent[self.topic_ids[topic]]
+        return None if parent_id == -1 else self.topic_names[parent_id]
+
+    def ancestors(self, topic: str):
+        """
+        Returns the ancestors of a topic in the forest, from the root down.
+        """
+        ancestors = []
+        parent_id = self.topic_parent[self.topic_ids[topic]]
+        while parent_id != -1:
+            ancestors.append(self.topic_names[parent_id])
+            parent_id = self.topic_parent[parent_id]
+        ancestors.reverse()
+        return ancestors
+
+    def roots(self):
+        """
+        Returns the root topic of each tree in the forest.
+        """
+        return [self.topic_names[i] for i in range(len(self.topic_names)) if self.topic_parent[i] == -1]
+
+    def iter_subtree(self, topic: str, max_depth: int=None):
+        """
+        Yields the topic and every topic under it, depth first, as
+        (topic, depth) pairs. max_depth limits how many levels below
+        topic are visited (0 is just the topic itself).
+        """
+        start_id = self.topic_ids.get(topic)
+        if start_id is None:
+            return
+        stack = [(start_id, 0)]
+        while stack:
+            topic_id, level = stack.pop()
+            yield self.topic_names[topic_id], self.topic_depth[topic_id]
+            if max_depth is None or level < max_depth:
+                children = self.topic_children[topic_id]
+                for child_id in reversed(children):
+                    stack.append((child_id, level + 1))
+
+    def iter_facts(self, topic: str, max_depth: int=None):
+        """
+        Yields the fact records of a topic and every topic under it (see
+        iter_subtree), in the same shape as the db rows.
+        """
+        for name, depth in self.iter_subtree(topic, max_depth):
+            yield from self.topic_rows(name)
+
+    def topic_rows(self, topic: str):
+        """
+        Returns the fact records of one topic, in the same shape as the db rows.
+        """
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            return []
+        depth = self.topic_depth[topic_id]
+        parents = ", ".join(self.ancestors(topic)) or "none"
+        rows = []
+        for index in self.topic_facts[topic_id]:
+            rows.append({'id': self.fact_ids[index], 'depth': depth, 'topic': topic,
+                         'parents': parents, 'fact': self.fact_text[index]})
+        return rows
+
+    def fetch(self, topics: list, max_depth: int=None):
+        """
+        Gets the facts of each topic and all the topics under it, grouped by
+        topic, like Cat_Facts_Tree_Records.fetch but including descendants.
+        """
+        results = {}
+        for topic in topics:
+            for name, depth in self.iter_subtree(topic, max_depth):
+                if name not in results:
+                    results[name] = self.topic_rows(name)
+        return results
+
+    def count(self, topic: str):
+        """
+        Returns the number of facts directly in a topic.
+        """
+        topic_id = self.topic_ids.get(topic)
+        return 0 if topic_id is None else len(self.topic_facts[topic_id])
+
+    def counts(self, include_descendants: bool=False):
+        """
+        Returns the number of facts per topic, optionally counting the facts
+        of every topic under it too.
+        """
+        totals = [len(facts) for facts in self.topic_facts]
+        if include_descendants:
+            # Parents are always added before their children, so going through
+            # the ids backwards adds every subtree's total before its parent's
+            for topic_id in range(len(totals) - 1, -1, -1):
+                parent_id = self.topic_parent[topic_id]
+                if parent_id != -1:
+                    totals[parent_id] += totals[topic_id]
+        return dict(zip(self.topic_names, totals))
+
+    def __len__(self):
+        return len(self.fact_text)
+
+
+def snapshot_json(value: object):
+    """
+    Serializes a value to JSON bytes the same way Flask's jsonify does
+    (sorted keys, compact, ASCII only), so snapshot responses are byte for
+    byte what the db-backed routes return.
+    """
+    return json.dumps(value, separators=(",", ":"), sort_keys=True, default=str).encode('ascii')
+
+
+class Cat_Facts_Tree_Snapshot():
+    """
+    Immutable in-memory copy of the facts table, for serving reads without
+    the db. Everything a read route can return is serialized once, when the
+    snapshot is built: each row, each topic's rows, the whole table, every
+    subtree, and the forest's topics, so a request only joins bytes that
+    already exist.
+
+    A snapshot is never changed after it's built (subtree responses are
+    only serialized the first time they're asked for, since there's one
+    per topic and max_depth, but they're derived from the same rows). When
+    the table changes (see Cat_Facts_Tree_Records.bump_version), a new one
+    is built and swapped in by replacing the reference to it, so requests
+    in flight keep reading the one they started with.
+
+    Rows are held as JSON (plus a forest of just the topics and facts),
+    which is roughly three times the size of the table's text.
+    """
+    def __init__(self, rows: list, version: int=None, cat_topics_model: dict=None):
+        self.version = version
+        rows = sorted(rows, key=lambda row: row['id'])
+        self.row_ids = array('q', [row['id'] for row in rows]) # Row index -> db ID, for keyset pages
+        self.row_json = [snapshot_json(row) for row in rows] # Row index -> row as JSON
+        topic_rows = {} # Topic -> its row indexes, ordered by ID
+        path_rows = {} # Topic -> (row index, levels below it) of every row under it, ordered by ID
+        max_levels = 0
+        for index, row in enumerate(rows):
+            topic_rows.setdefault(row['topic'], []).append(index)
+            path = row['path']
+            for position, topic in enumerate(path):
+                levels = len(path) - 1 - position
+                max_levels = max(max_levels, levels)
+                path_rows.setdefault(topic, []).append((index, levels))
+        self.key_json = {topic: snapshot_json(topic) for topic in topic_rows.keys() | path_rows.keys()}
+        self.topic_json = {topic: self.join_rows(indexes) for topic, indexes in topic_rows.items()}
+        self.all_json = b'{"all":' + self.join_rows(range(len(rows))) + b'}\n'
+        self.row_topics = [row['topic'] for row in rows]
+        self.path_rows = path_rows
+        self.max_levels = max_levels # Most levels any row is below a topic; a deeper max_depth is the same as None
+        self.subtree_json = {} # (topic, max_depth) -> get_cat_facts_subtree response, as it's asked for
+        # Responses of descendant queries and topic_counts come from the forest
+        self.forest = Cat_Facts_Forest.from_rows(rows, cat_topics_model)
+        self.forest_topic_json = {name: snapshot_json(self.forest.topic_rows(name))
+                                  for name in self.forest.topic_names}
+        self.counts_json = snapshot_json({'facts': self.forest.counts(),
+                                          'subtree_facts': self.forest.counts(True)}) + b"\n"
+        return
+
+    def join_rows(self, indexes: object):
+        """
+        Returns the rows at indexes as a JSON list, from their JSON.
+        """
+        row_json = self.row_json
+        return b"[" + b",".join([row_json[index] for index in indexes]) + b"]"
+
+    def join_object(self, items: object):
+        """
+        Returns a JSON object (ending in a newline, like jsonify) from
+        (topic, value JSON) pairs, with the topics sorted like jsonify
+        sorts keys.
+        """
+        key_json = self.key_json
+        return b"{" + b",".join([(key_json.get(topic) or snapshot_json(topic)) + b":" + value
+                                 for topic, value in sorted(items)]) + b"}\n"
+
+    def fetch_json(self, topics: list):
+        """
+        Same response as Cat_Facts_Tree_Records.fetch(topics), as JSON.
+        """
+        return self.join_object((topic, self.topic_json.get(topic, b"[]")) for topic in set(topics))
+
+    def fetch_page_json(self, limit: int, after_id: int=0):
+        """
+        Same response as a page of Cat_Facts_Tree_Records.fetch_page, as JSON.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        start = bisect.bisect_right(self.row_ids, after_id)
+        end = min(start + limit, len(self.row_ids))
+        next_after_id = b"null"
+        if end - start == limit:
+            next_after_id = str(self.row_ids[end - 1]).encode('ascii')
+        return b'{"all":' + self.join_rows(range(start, end)) + b',"next_after_id":' + next_after_id + b'}\n'
+
+    def fetch_subtree_json(self, topic: str, max_depth: int=None):
+        """
+        Same response as Cat_Facts_Tree_Records.fetch_subtree, as JSON.
+        """
+        if topic not in self.path_rows:
+            return b"{}\n"
+        if max_depth is not None:
+            if max_depth < 0:
+                return b"{}\n"
+            if max_depth >= self.max_levels:
+                max_depth = None
+        key = (topic, max_depth)
+        subtree = self.subtree_json.get(key)
+        if subtree is None:
+            grouped = {}
+            for index, levels in self.path_rows[topic]:
+                if max_depth is None or levels <= max_depth:
+                    grouped.setdefault(self.row_topics[index], []).append(index)
+            # Two requests building the same one at once build the same bytes
+            subtree = self.subtree_json.setdefault(key, self.join_object(
+                (name, self.join_rows(indexes)) for name, indexes in grouped.items()))
+        return subtree
+
+    def fetch_descendants_json(self, topics: list, max_depth: int=None):
+        """
+        Same response as Cat_Facts_Forest.fetch, as JSON.
+        """
+        names = {}
+        for topic in topics:
+            for name, depth in self.forest.iter_subtree(topic, max_depth):
+                names[name] = self.forest_topic_json[name]
+        return self.join_object(names.items())
+
+    def iter_ndjson(self, chunk_rows: int):
+        """
+        Yields every row as NDJSON, chunk_rows lines at a time.
+        """
+        row_json = self.row_json
+        for start in range(0, len(row_json), chunk_rows):
+            yield b"\n".join(row_json[start:start + chunk_rows]) + b"\n"
+
+
+def copy_results(value: object):
+    """
+    Copies query results (dicts, lists, and tuples of rows), down to the
+    values in each row, so callers can change what they're given.
+    """
+    if isinstance(value, dict):
+        return {key: copy_results(each) for key, each in value.items()}
+    if isinstance(value, list):
+        return [copy_results(each) for each in value]
+    if isinstance(value, tuple):
+        return tuple(copy_results(each) for each in value)
+    return value
+
+
+class Cat_Facts_Tree_Cache():
+    """
+    Thread-safe LRU cache with an optional TTL, for topic query results.
+    Values are copied going in and coming out (see copy_results), so no
+    caller shares rows with the cache or with another caller.
+
+    Every clear() bumps a generation number. A caller that read from the db
+    passes the generation it saw before the query to put(), so results read
+    before a write can't be cached after it.
+
+    The cache also remembers the facts table version its results are from
+    (see sync_version), so writes made by other processes clear it too,
+    at most version_check_seconds after they commit.
+    """
+    def __init__(self, max_size: int=CACHE_MAX_SIZE, ttl: float=CACHE_TTL_SECONDS,
+                 version_check_seconds: float=CACHE_VERSION_CHECK_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_check_seconds = version_check_seconds
+        self.entries = OrderedDict() # key -> (time stored, value), oldest use first
+        self.lock = Lock()
+        self.generation = 0
+        self.version = None # Facts table version last seen, None until it's checked
+        self.version_checked = None # time.monotonic() of the last version check
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        return
+
+    def get(self, key: object):
+        """
+        Returns the cached value for key, or None if it isn't cached or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            value = entry[1]
+        return copy_results(value)
+
+    def put(self, key: object, value: object, generation: int):
+        """
+        Caches value for key, unless the cache was cleared since generation.
+        """
+        value = copy_results(value)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return
+
+    def clear(self):
+        """
+        Drops every cached value. Called whenever the facts table changes.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.stats['invalidations'] += 1
+            # The version the write left isn't known until it's checked again
+            self.version = None
+            self.version_checked = None
+        return
+
+    def version_check_due(self):
+        """
+        Returns whether the facts table's version should be checked before
+        serving from the cache.
+        """
+        checked = self.version_checked
+        return checked is None or time.monotonic() - checked >= self.version_check_seconds
+
+    def sync_version(self, version: int):
+        """
+        Records the facts table's current version, clearing the cache if it
+        changed since the last check (a write from any process).
+        """
+        with self.lock:
+            if self.version is not None and self.version != version:
+                self.entries.clear()
+                self.generation += 1
+                self.stats['invalidations'] += 1
+            self.version = version
+            self.version_checked = time.monotonic()
+        return
+
+    def get_stats(self):
+        """
+        Returns hit / miss / eviction counters, and the current size.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.entries)
+        stats['max_size'] = self.max_size
+        stats['ttl'] = self.ttl
+        stats['version'] = self.version
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
 
 # Helper class to call PostgreSQL queries
 class Cat_Facts_Tree_Records():
     """
     Wraps around PostgreSQL for persistent cat facts storage. Can save,
     fetch, and create new cat facts. 
+
+    Connections come from a thread-safe pool of min_conn to max_conn
+    connections. A thread can check one out for a whole unit of work (like
+    an API request) with checkout / checkin; otherwise each method checks
+    one out for as long as it runs.
+
+    Topic fetches are cached (see Cat_Facts_Tree_Cache). The cache is
+    cleared by every write made through this class, and by writes from
+    other processes once check_version sees the table's version change.
+
+    Nothing connects to the db until the first connection is checked out.
     """
-    def __init__(self):
-        conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, host=DB_HOST)
-        
-        self.conn = conn
+    def __init__(self, min_conn: int=DB_POOL_MIN_CONN, max_conn: int=DB_POOL_MAX_CONN,
+                 cache_size: int=CACHE_MAX_SIZE, cache_ttl: float=CACHE_TTL_SECONDS,
+                 version_check_seconds: float=CACHE_VERSION_CHECK_SECONDS):
+        self.pool = None # Opened by get_pool on first use
+        self.pool_lock = Lock()
+        # ThreadedConnectionPool raises instead of waiting when it's exhausted,
+        # so the semaphore makes callers queue for a connection
+        self.slots = BoundedSemaphore(max_conn)
+        self.local = local() # The connection checked out by the current thread
+        self.stats_lock = Lock()
+        self.stats = {'min_conn': min_conn, 'max_conn': max_conn, 'in_use': 0, 'peak_in_use': 0,
+                      'waiting': 0, 'checkouts': 0, 'total_wait_seconds': 0.0,
+                      'max_wait_seconds': 0.0}
+        self.cache = Cat_Facts_Tree_Cache(cache_size, cache_ttl, version_check_seconds)
+        self.saved_model = (None, None) # (table version, saved model), see table_model
+        return
+
+    def get_pool(self):
+        """
+        Returns the connection pool, opening it (and its first min_conn
+        connections) the first time it's needed.
+        """
+        if self.pool is None:
+            with self.pool_lock:
+                if self.pool is None:
+                    self.pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.stats['min_conn'], self.stats['max_conn'], dbname=DB_NAME, user=DB_USER,
+                        host=DB_HOST)
+        return self.pool
+
+    def checkout(self):
+        """
+        Checks a connection out of the pool for the current thread, waiting
+        for one to be returned if all max_conn are in use.
+        """
+        if getattr(self.local, 'conn', None) is not None:
+            return self.local.conn
+        with self.stats_lock:
+            self.stats['waiting'] += 1
+        start = time.perf_counter()
+        self.slots.acquire()
+        waited = time.perf_counter() - start
+        try:
+            conn = self.get_pool().getconn()
+        except Exception:
+            self.slots.release()
+            with self.stats_lock:
+                self.stats['waiting'] -= 1
+            raise
+        with self.stats_lock:
+            stats = self.stats
+            stats['waiting'] -= 1
+            stats['in_use'] += 1
+            stats['peak_in_use'] = max(stats['peak_in_use'], stats['in_use'])
+            stats['checkouts'] += 1
+            stats['total_wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+        self.local.conn = conn
+        return conn
+
+    def checkin(self):
+        """
+        Returns the current thread's connection to the pool. Any transaction
+        left open on it is rolled back first.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        try:
+            if not conn.closed:
+                conn.rollback()
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+            self.slots.release()
+            with self.stats_lock:
+                self.stats['in_use'] -= 1
         return
 
-    def save_to_db_clean(self, data: dict):
+    @contextmanager
+    def connection(self):
         """
-        Saves cat facts into db.
+        Gives the connection already checked out by this thread, or checks
+        one out until the with block ends.
         """
-        cur = self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+        if getattr(self.local, 'conn', None) is not None:
+            yield self.local.conn
+            return
+        conn = self.checkout()
         try:
-            query = "DROP TABLE " + DB_TABLE_NAME
-            print("Clearing old records from db: ", DB_NAME, " for user: ", DB_USER, " at host: ",
-                    DB_HOST)
-            cur.execute(query)
-        except Exception as e:
-            print(e)
-            cur.execute("ROLLBACK")
-            pass
+            yield conn
+        finally:
+            self.checkin()
+
+    def pool_stats(self):
+        """
+        Returns connection pool usage: connections in use, threads waiting,
+        utilization (in use / max_conn), and time spent waiting for a connection.
+        """
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['utilization'] = stats['in_use'] / stats['max_conn']
+        if stats['checkouts']:
+            stats['avg_wait_seconds'] = stats['total_wait_seconds'] / stats['checkouts']
+        else:
+            stats['avg_wait_seconds'] = 0.0
+        return stats
+
+    def close(self):
+        """
+        Closes every connection in the pool. The pool is opened again if
+        it's used after this.
+        """
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+        return
+
+    def save_to_db_clean(self, data: dict, batch_size: int=WRITE_BATCH_SIZE, quiet: bool=False,
+                         classifier: object=None):
+        """
+        Saves cat facts into db, replacing whatever was there before.
+
+        The rows are bulk loaded into a new table, which is swapped in for
+        the old one (see replace_table).
+        """
+        return self.replace_table(iter_tree_nodes(data), batch_size, quiet, classifier=classifier)
+
+    def save_stream_to_db_clean(self, nodes: object, batch_size: int=WRITE_BATCH_SIZE, quiet: bool=False,
+                                classifier: object=None):
+        """
+        Erases existing table and saves nodes pulled from an iterable (see
+        Cat_Facts_Tree.iter_fact_nodes) in batches of batch_size, so only
+        one batch is held in memory at a time.
+
+        Returns the number of records saved.
+        """
+        return self.replace_table(nodes, batch_size, quiet, classifier=classifier)
+
+    def create_table(self, cur: object, table_name: str):
+        """
+        Creates an empty facts table. IDs are generated by the db, in the
+        order rows are inserted.
+        """
         query = """
-        CREATE TABLE """ + DB_TABLE_NAME + """ (
-            ID int NOT NULL,
+        CREATE TABLE """ + table_name + """ (
+            ID int GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
             Depth int NOT NULL,
             Topic varchar(255),
             Parents varchar(255),
-            Fact text
+            Fact text,
+            Path text[],
+            Fingerprint char(40) NOT NULL,
+            Tokens text[] NOT NULL,
+            Search tsvector GENERATED ALWAYS AS (""" + SEARCH_VECTOR + """) STORED
             );
             """
-        print("Creating table: ", DB_TABLE_NAME, " in", DB_NAME,
-                " for user: ", DB_USER, " at host: ", DB_HOST)
         cur.execute(query)
-        print("\nSaving records into db: ", DB_NAME, " for user: ", DB_USER, " at host: ",
-                DB_HOST+"\n")
-        index = 0
-        for each in data.keys():
-            node = data[each]
-            if len(node) > 1 and type(node) is list:
-                for _each in data[each]:
-                    if 'parents' in _each:
-                        if _each['parents'] is None:
-                            _each['parents'] = "none"
-                        else:
-                            val = ", ".join(_each['parents'])
-                            _each['parents'] = val
-                    else:
-                        _each['parents'] = "none"
-                    cur.execute("INSERT INTO " + DB_TABLE_NAME + " (ID, Depth, Topic, Parents, Fact) VALUES (%s, %s, %s, %s, %s)",
-                                (str(index), str(_each['depth']), str(_each['topic']), str(_each['parents']), str(_each['fact'])))
-                    index += 1 # PostgreSQL has no auto-increment so make simple IDs here
-                    print("\tSaved record: ", _each)
-            else:
-                # The node is a root node
-                node['parents'] = "none"
-                cur.execute("INSERT INTO " + DB_TABLE_NAME + " (ID, Depth, Topic, Parents, Fact) VALUES (%s, %s, %s, %s, %s)",
-                                (str(index), str(node['depth']), str(node['topic']), str(node['parents']), str(node['fact'])))
-                index += 1 # PostgreSQL has no auto-increment so make simple IDs here
-                print("\tSaved record as ROOT NODE: ", node)
-        print("\n\nTotal number of records saved: ", str(index) + "\n")
-        self.conn.commit()
-        cur.close()
         return
 
-    def create(self, values: list):
+    def create_indexes(self, cur: object, table_name: str):
+        """
+        Indexes a facts table for topic and depth lookups. Topic is indexed
+        together with ID, so a topic's rows come back in order without a sort.
+        Path gets a GIN index, so "every row under a topic" (Path @> {topic})
+        is one index lookup, and so does Tokens, for "every fact with any of
+        these tokens" (Tokens && {tokens}).
+        Fingerprint is unique, which is what upserts conflict on, and Search
+        gets a GIN index for full-text search (see search).
         """
-        Creates and savesa new cat fact or list of cat facts in db.
+        cur.execute("CREATE INDEX " + table_name + "_topic_idx ON " + table_name + " (Topic, ID)")
+        cur.execute("CREATE INDEX " + table_name + "_depth_idx ON " + table_name + " (Depth)")
+        cur.execute("CREATE INDEX " + table_name + "_path_idx ON " + table_name + " USING GIN (Path)")
+        cur.execute("CREATE UNIQUE INDEX " + table_name + "_fingerprint_idx ON " + table_name
+                    + " (Fingerprint)")
+        cur.execute("CREATE INDEX " + table_name + "_tokens_idx ON " + table_name + " USING GIN (Tokens)")
+        cur.execute("CREATE INDEX " + table_name + "_search_idx ON " + table_name + " USING GIN (Search)")
+        return
 
-        Required keys: depth, topic, and fact.
+    def add_search_column(self, cur: object):
         """
-        # We get the last record in the table to get the ID for index
-        index = 0
-        query = "SELECT * FROM " + DB_TABLE_NAME + " ORDER BY ID DESC LIMIT 1"
-        cur = self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        cur.execute(query)
-        row = cur.fetchone()
-        index = row[0] + 1
-        results = []
-        for each in values:
-            if 'parents' in each:
-                if each['parents'] is None:
-                    each['parents'] = "none"
+        Adds the Search column and its index to a facts table saved before
+        they were added (the table is rewritten once). Doesn't commit.
+        """
+        cur.execute("ALTER TABLE " + DB_TABLE_NAME + " ADD COLUMN IF NOT EXISTS Search tsvector"
+                    " GENERATED ALWAYS AS (" + SEARCH_VECTOR + ") STORED")
+        cur.execute("CREATE INDEX IF NOT EXISTS " + DB_TABLE_NAME + "_search_idx ON " + DB_TABLE_NAME
+                    + " USING GIN (Search)")
+        return
+
+    def swap_table(self, cur: object, new_table: str):
+        """
+        Drops the facts table and renames new_table (and its primary key and
+        indexes) in its place. Must run in the same transaction that commits.
+        """
+        cur.execute("DROP TABLE IF EXISTS " + DB_TABLE_NAME)
+        cur.execute("ALTER TABLE " + new_table + " RENAME TO " + DB_TABLE_NAME)
+        cur.execute("ALTER TABLE " + DB_TABLE_NAME + " RENAME CONSTRAINT " + new_table + "_pkey TO "
+                    + DB_TABLE_NAME + "_pkey")
+        for index_name in ("_topic_idx", "_depth_idx", "_path_idx", "_fingerprint_idx", "_tokens_idx",
+                           "_search_idx"):
+            cur.execute("ALTER INDEX " + new_table + index_name + " RENAME TO " + DB_TABLE_NAME + index_name)
+        return
+
+    def replace_table(self, nodes: object, batch_size: int=WRITE_BATCH_SIZE, quiet: bool=False,
+                      method: str=BULK_WRITE_METHOD, classifier: object=None):
+        """
+        Bulk loads nodes into a new table under a temporary name, indexes it,
+        then drops the old table and renames the new one in its place, all in
+        one transaction.
+        Readers keep seeing the old table until the commit, and never see it
+        missing or half written.
+
+        Rows are sent batch_size at a time, with COPY FROM STDIN (method="copy")
+        or multi-row INSERTs through execute_values (method="values"). quiet
+        turns off the progress output. Repeats of a fact are dropped, keeping
+        the first one.
+
+        If the classifier the nodes came from is given, its topics model and
+        stemmer are saved in the same transaction, so later incremental saves
+        know what to re-classify (see save_incremental). Without it, tokens
+        are folded with TOKEN_STEMMER and any saved model is dropped, since
+        it can't be trusted to describe the new rows; the next incremental
+        save then re-classifies everything.
+
+        Returns the number of records saved.
+        """
+        new_table = DB_TABLE_NAME + "_new"
+        stem = get_stemmer(TOKEN_STEMMER) if classifier is None else classifier.stem
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("DROP TABLE IF EXISTS " + new_table)
+                self.create_table(cur, new_table)
+                if not quiet:
+                    log.info("Saving records into db=%s user=%s host=%s", DB_NAME, DB_USER, DB_HOST)
+                index = 0
+                for batch in iter_batches(nodes, batch_size):
+                    rows = []
+                    for node in batch:
+                        rows.append(node_to_row(node, stem))
+                        index += 1
+                    self.write_rows(cur, new_table, rows, method)
+                    if not quiet:
+                        log.debug("Saved batch records=%d total=%d", len(rows), index)
+                # Facts are unique by fingerprint, which the unique index can't
+                # be built without
+                cur.execute("DELETE FROM " + new_table + " a USING " + new_table + " b"
+                            " WHERE a.Fingerprint = b.Fingerprint AND a.ID > b.ID")
+                index -= cur.rowcount
+                if cur.rowcount and not quiet:
+                    log.info("Dropped repeated facts=%d", cur.rowcount)
+                # Indexing once after loading is much faster than updating
+                # the indexes on every row
+                self.create_indexes(cur, new_table)
+                self.swap_table(cur, new_table)
+                if classifier is not None:
+                    self.save_model(cur, classifier)
                 else:
-                    val = ", ".join(each['parents'])
-                    eeach['parents'] = val
+                    cur.execute("DROP TABLE IF EXISTS " + DB_MODEL_TABLE_NAME)
+                self.bump_version(cur)
+                conn.commit()
+                self.cache.clear()
+            except Exception:
+                # The old table is untouched if anything failed before the commit
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+            if not quiet:
+                log.info("Saved records total=%d", index)
+            return index
+
+    def write_rows(self, cur: object, table_name: str, rows: list, method: str=BULK_WRITE_METHOD):
+        """
+        Writes a batch of rows (see node_to_row) into a table in one round trip.
+        """
+        columns = " (" + ", ".join(ROW_COLUMNS) + ")"
+        if method not in ("copy", "values"):
+            raise ValueError("Unknown bulk write method: " + str(method))
+        with metrics.time_stage('persist', len(rows)):
+            if method == "copy":
+                buf = io.StringIO()
+                for row in rows:
+                    buf.write("\t".join([copy_escape(val) for val in row]) + "\n")
+                buf.seek(0)
+                cur.copy_expert("COPY " + table_name + columns + " FROM STDIN", buf)
             else:
-                each['parents'] = "none"
-            print("\nCreating new cat fact entry at ", index, each)
-            cur.execute("INSERT INTO " + DB_TABLE_NAME + " (ID, Depth, Topic, Parents, Fact) VALUES (%s, %s, %s, %s, %s)",
-                        (str(index), str(each['depth']), str(each['topic']), str(each['parents']), str(each['fact'])))
-        self.conn.commit()
+                psycopg2.extras.execute_values(cur, "INSERT INTO " + table_name + columns + " VALUES %s",
+                                               rows, page_size=len(rows))
+        return
+
+    def upsert_rows(self, cur: object, rows: list, returning: bool=False):
+        """
+        Inserts a batch of rows (see node_to_row) into the facts table in one
+        round trip. Rows whose fact is already saved update it instead.
+        Rows in one batch must all have different fingerprints.
+
+        With returning, gives back the (ID, Fingerprint) of every row,
+        inserted or updated.
+        """
+        columns = " (" + ", ".join(ROW_COLUMNS) + ")"
+        updates = ", ".join([column + " = EXCLUDED." + column for column in ROW_COLUMNS
+                             if column != "Fingerprint"])
+        query = ("INSERT INTO " + DB_TABLE_NAME + columns + " VALUES %s"
+                 " ON CONFLICT (Fingerprint) DO UPDATE SET " + updates)
+        if returning:
+            query += " RETURNING ID, Fingerprint"
+        with metrics.time_stage('persist', len(rows)):
+            return psycopg2.extras.execute_values(cur, query, rows, page_size=len(rows), fetch=returning)
+
+    def load_model(self, cur: object):
+        """
+        Returns the version, topics model, and stemmer the facts table was
+        last classified with, or None if there isn't one saved (or no facts
+        table yet).
+        """
+        cur.execute("SELECT to_regclass(%s), to_regclass(%s)", (DB_TABLE_NAME, DB_MODEL_TABLE_NAME))
+        if None in cur.fetchone():
+            return None
+        cur.execute("SELECT * FROM " + DB_MODEL_TABLE_NAME + " WHERE ID = 1")
+        row = cur.fetchone()
+        if row is None:
+            return None
+        columns = [column[0] for column in cur.description]
+        row = dict(zip(columns, row))
+        return {'version': row['version'], 'model': json.loads(row['model']),
+                'stemmer': row.get('stemmer')}
+
+    def save_model(self, cur: object, classifier: object):
+        """
+        Saves the topics model and stemmer of the classifier the facts
+        table is classified with, along with their version (see
+        model_version). Doesn't commit.
+        """
+        cur.execute("CREATE TABLE IF NOT EXISTS " + DB_MODEL_TABLE_NAME + """ (
+            ID int PRIMARY KEY,
+            Version char(40) NOT NULL,
+            Model text NOT NULL
+            )""")
+        # Tables saved before stemming was added don't have it
+        cur.execute("ALTER TABLE " + DB_MODEL_TABLE_NAME + " ADD COLUMN IF NOT EXISTS Stemmer text")
+        cur.execute("INSERT INTO " + DB_MODEL_TABLE_NAME + " (ID, Version, Model, Stemmer) VALUES (1, %s, %s, %s)"
+                    " ON CONFLICT (ID) DO UPDATE SET Version = EXCLUDED.Version, Model = EXCLUDED.Model,"
+                    " Stemmer = EXCLUDED.Stemmer",
+                    (classifier.version, json.dumps(classifier.cat_topics_model), classifier.stemmer))
+        return
+
+    def bump_version(self, cur: object):
+        """
+        Adds one to the facts table's version, and NOTIFYs DB_NOTIFY_CHANNEL
+        with the new one. Called by every write, in its transaction, so the
+        version only changes (and listeners only hear about it) when the
+        write commits. Doesn't commit.
+
+        Returns the new version.
+        """
+        cur.execute("CREATE TABLE IF NOT EXISTS " + DB_VERSION_TABLE_NAME + """ (
+            ID int PRIMARY KEY,
+            Version bigint NOT NULL
+            )""")
+        cur.execute("INSERT INTO " + DB_VERSION_TABLE_NAME + " (ID, Version) VALUES (1, 1)"
+                    " ON CONFLICT (ID) DO UPDATE SET Version = " + DB_VERSION_TABLE_NAME + ".Version + 1"
+                    " RETURNING Version")
+        version = cur.fetchone()[0]
+        cur.execute("SELECT pg_notify(%s, %s)", (DB_NOTIFY_CHANNEL, str(version)))
+        return version
+
+    def load_version(self, cur: object):
+        """
+        Returns the facts table's version (see bump_version), or 0 if it
+        was never written to since versions were added.
+        """
+        cur.execute("SELECT to_regclass(%s)", (DB_VERSION_TABLE_NAME,))
+        if cur.fetchone()[0] is None:
+            return 0
+        cur.execute("SELECT Version FROM " + DB_VERSION_TABLE_NAME + " WHERE ID = 1")
+        row = cur.fetchone()
+        return 0 if row is None else row[0]
+
+    def fetch_version(self):
+        """
+        Gets the facts table's version (see load_version).
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                return self.load_version(cur)
+            finally:
+                cur.close()
+
+    def check_version(self):
+        """
+        Returns the facts table's version. It's read from the db (clearing
+        the cache if it changed, see Cat_Facts_Tree_Cache.sync_version) at
+        most every version_check_seconds; in between, the last one read is
+        returned.
+        """
+        if not self.cache.version_check_due():
+            return self.cache.version
+        version = self.fetch_version()
+        self.cache.sync_version(version)
+        return version
+
+    def read_snapshot(self, itersize: int=FETCH_ITERSIZE, cat_topics_model: dict=None):
+        """
+        Builds a Cat_Facts_Tree_Snapshot of the whole facts table. The
+        version and the rows are read in one REPEATABLE READ transaction,
+        so the snapshot's version is the one its rows are from.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            rows_cur = conn.cursor(name="cat_facts_snapshot", cursor_factory = psycopg2.extras.RealDictCursor)
+            rows_cur.itersize = itersize
+            start = time.perf_counter()
+            try:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                version = self.load_version(cur)
+                rows_cur.execute("SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME + " ORDER BY ID")
+                rows = list(rows_cur)
+            finally:
+                rows_cur.close()
+                cur.close()
+                conn.rollback()
+            metrics.record_stage('query', time.perf_counter() - start, len(rows))
+        return Cat_Facts_Tree_Snapshot(rows, version, cat_topics_model)
+
+    def listen(self):
+        """
+        Opens a connection that LISTENs on DB_NOTIFY_CHANNEL, to hear about
+        writes from any process (see bump_version). It's opened outside the
+        pool, since it stays open for as long as it's listened on; wait
+        for it to be readable with select(), then poll() it and read its
+        notifies.
+        """
+        conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, host=DB_HOST)
+        conn.autocommit = True # Notifications are only delivered between transactions
+        cur = conn.cursor()
+        cur.execute("LISTEN " + DB_NOTIFY_CHANNEL)
         cur.close()
+        return conn
+
+    def save_incremental(self, facts: object, classifier: object, batch_size: int=WRITE_BATCH_SIZE,
+                         quiet: bool=False):
+        """
+        Saves cat facts into db without rebuilding the table, in one
+        transaction:
+
+        1. If the topics model changed since the table was classified, the
+           tokens that now classify differently are found (see
+           Cat_Facts_Tree_Classifier.changed_tokens), and only the saved
+           facts with one of those tokens are re-classified, through the
+           Tokens index. Facts that no longer match any topic are removed.
+        2. Facts pulled from the iterable are fingerprinted batch_size at a
+           time. Ones already in the table are skipped without classifying
+           them, and the rest are classified and upserted.
+
+        With no model saved yet (like on the first run), or a different
+        stemmer (which changes every row's Tokens), the whole table is rebuilt
+        with replace_table instead.
+
+        Returns counts of the facts skipped, saved, re-classified, and removed.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                saved_model = self.load_model(cur)
+            finally:
+                cur.close()
+            if saved_model is None or saved_model['stemmer'] != classifier.stemmer:
+                conn.rollback()
+                if not quiet:
+                    log.info("No facts table classified with stemmer=%s found, saving all facts",
+                             classifier.stemmer)
+                saved = self.replace_table(classifier.iter_nodes(facts), batch_size, quiet,
+                                           classifier=classifier)
+                return {'skipped': 0, 'saved': saved, 'reclassified': 0, 'removed': 0}
+            stats = {'skipped': 0, 'saved': 0, 'reclassified': 0, 'removed': 0}
+            cur = conn.cursor()
+            try:
+                self.add_search_column(cur)
+                if saved_model['version'] != classifier.version:
+                    changed = classifier.changed_tokens(
+                        Cat_Facts_Tree_Classifier(saved_model['model'], stemmer=saved_model['stemmer']))
+                    if not quiet:
+                        log.info("Topics model changed, re-classifying facts with affected tokens=%d",
+                                 len(changed))
+                    if changed:
+                        self.reclassify_rows(conn, cur, classifier, sorted(changed), batch_size, stats)
+                    self.save_model(cur, classifier)
+                roots = set()
+                for batch in iter_batches(facts, batch_size):
+                    fingerprints = [fact_fingerprint(fact) for fact in batch]
+                    cur.execute("SELECT Fingerprint FROM " + DB_TABLE_NAME + " WHERE Fingerprint = ANY(%s)",
+                                (fingerprints,))
+                    existing = {row[0] for row in cur.fetchall()}
+                    new_facts = []
+                    for fact, fingerprint in zip(batch, fingerprints):
+                        if fingerprint in existing:
+                            stats['skipped'] += 1
+                        else:
+                            existing.add(fingerprint) # Repeats within the batch
+                            new_facts.append(fact)
+                    nodes = [node for node in classifier.classify_batch(new_facts) if node is not None]
+                    rows = self.root_rows(cur, nodes, roots) + [node_to_row(node, classifier.stem) for node in nodes]
+                    if rows:
+                        self.upsert_rows(cur, rows)
+                    stats['saved'] += len(nodes)
+                    if not quiet:
+                        log.debug("Saved batch new_facts=%d already_saved=%d", len(nodes), stats['skipped'])
+                if stats['saved'] or stats['reclassified'] or stats['removed']:
+                    self.bump_version(cur)
+                conn.commit()
+                self.cache.clear()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+        if not quiet:
+            log.info("Incremental save skipped=%d saved=%d reclassified=%d removed=%d",
+                     stats['skipped'], stats['saved'], stats['reclassified'], stats['removed'])
+        return stats
+
+    def reclassify_rows(self, conn: object, cur: object, classifier: object, tokens: list,
+                        batch_size: int, stats: dict):
+        """
+        Re-classifies every saved fact that has any of tokens, updating the
+        rows whose node changed and deleting the ones that no longer match.
+        Doesn't commit.
+        """
+        rows = conn.cursor(name="cat_facts_reclassify")
+        rows.itersize = batch_size
+        roots = set()
+        try:
+            rows.execute("SELECT ID, Fact, Depth, Topic, Parents FROM " + DB_TABLE_NAME
+                         + " WHERE Tokens && %s::text[] AND Parents <> 'none'", (tokens,))
+            for batch in iter_batches(rows, batch_size):
+                updates, removed, nodes = [], [], []
+                results = classifier.classify_batch([row[1] for row in batch])
+                for row, node in zip(batch, results):
+                    if node is None:
+                        removed.append(row[0])
+                        continue
+                    new_row = node_to_row(node)
+                    if new_row[:3] != (str(row[2]), row[3], row[4]):
+                        updates.append((row[0], int(new_row[0]), new_row[1], new_row[2], new_row[4]))
+                        nodes.append(node)
+                if removed:
+                    cur.execute("DELETE FROM " + DB_TABLE_NAME + " WHERE ID = ANY(%s)", (removed,))
+                if updates:
+                    psycopg2.extras.execute_values(cur, "UPDATE " + DB_TABLE_NAME + " AS t SET"
+                                                   " Depth = v.depth, Topic = v.topic, Parents = v.parents,"
+                                                   " Path = v.path FROM (VALUES %s) AS v (id, depth, topic,"
+                                                   " parents, path) WHERE t.ID = v.id",
+                                                   updates, page_size=len(updates))
+                root_rows = self.root_rows(cur, nodes, roots)
+                if root_rows:
+                    self.upsert_rows(cur, root_rows)
+                stats['reclassified'] += len(updates)
+                stats['removed'] += len(removed)
+        finally:
+            rows.close()
+        # Root nodes of topics that lost all their facts
+        cur.execute("DELETE FROM " + DB_TABLE_NAME + " r WHERE r.Parents = 'none' AND NOT EXISTS"
+                    " (SELECT 1 FROM " + DB_TABLE_NAME + " f WHERE f.Topic = r.Topic AND f.Parents <> 'none')")
         return
 
+    def root_rows(self, cur: object, nodes: list, roots: set):
+        """
+        Returns rows for the root nodes of the depth 1 topics among nodes
+        that aren't in the table yet. roots holds the topics already
+        checked, and is added to.
+        """
+        topics = [node['topic'] for node in nodes if node['depth'] == 1 and node['topic'] not in roots]
+        if not topics:
+            return []
+        topics = list(dict.fromkeys(topics))
+        roots.update(topics)
+        cur.execute("SELECT Topic FROM " + DB_TABLE_NAME + " WHERE Topic = ANY(%s) AND Parents = 'none'",
+                    (topics,))
+        saved = {row[0] for row in cur.fetchall()}
+        return [node_to_row({'topic': topic, 'depth': 0, 'parents': None, 'fact': None})
+                for topic in topics if topic not in saved]
+
+    def create(self, values: list, classifier: object=None, batch_size: int=WRITE_BATCH_SIZE):
+        """
+        Creates and saves new cat facts in db, all in one transaction, with
+        one multi-row upsert per batch_size facts. A fact that's already
+        saved is updated, and keeps its ID.
+
+        Required keys: depth, topic, and fact (parents can be a list, or
+        comma separated the way they're stored).
+        If a classifier is given, values are raw facts instead (strings, or
+        dicts with just a fact), and their topics come from classifying them.
+        Without one, tokens are folded with the stemmer saved with the
+        table's topics model (see load_model), like the rows already there.
+
+        Returns the saved rows (with the IDs the db gave them) in the same
+        order as values, with None for facts no topic was found for.
+        """
+        if classifier is not None:
+            facts = [each if isinstance(each, str) else self.value_field(each, 'fact', index, str)
+                     for index, each in enumerate(values)]
+            nodes = classifier.classify_batch(facts)
+        else:
+            nodes = [self.value_to_node(each, index) for index, each in enumerate(values)]
+        log.info("Creating new cat fact entries=%d", len(nodes) - nodes.count(None))
+        ids = {}
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if classifier is not None:
+                    stem = classifier.stem
+                else:
+                    saved = self.load_model(cur)
+                    stem = get_stemmer(TOKEN_STEMMER if saved is None else saved['stemmer'])
+                rows = [None if node is None else node_to_row(node, stem) for node in nodes]
+                roots = set()
+                for batch in iter_batches([index for index, row in enumerate(rows) if row is not None],
+                                          batch_size):
+                    batch_rows = {}
+                    for row in self.root_rows(cur, [nodes[index] for index in batch], roots):
+                        batch_rows[row[5]] = row
+                    for index in batch:
+                        # One statement can't upsert the same fact twice, so the last repeat wins
+                        batch_rows[rows[index][5]] = rows[index]
+                    for row_id, fingerprint in self.upsert_rows(cur, list(batch_rows.values()), True):
+                        ids[fingerprint] = row_id
+                if ids:
+                    self.bump_version(cur)
+                conn.commit()
+                self.cache.clear()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+        return [None if row is None else
+                {'id': ids[row[5]], 'depth': int(row[0]), 'topic': row[1], 'parents': row[2], 'fact': row[3]}
+                for row in rows]
+
+    @staticmethod
+    def value_field(value: dict, key: str, index: int, types: object=None):
+        """
+        Gets a required key of a value passed to create, with an error that
+        says which value is missing it, or has it with a type not in types.
+        """
+        if not isinstance(value, dict) or key not in value:
+            raise ValueError("Cat fact " + str(index) + " has no " + key)
+        field = value[key]
+        if types is not None and (not isinstance(field, types) or isinstance(field, bool)):
+            raise ValueError("Cat fact " + str(index) + " has a " + key + " of the wrong type ("
+                             + type(field).__name__ + ")")
+        return field
+
+    @classmethod
+    def value_to_node(cls, value: dict, index: int):
+        """
+        Turns a value passed to create into a node. Raises ValueError if
+        it's missing a key, or has one of the wrong type.
+        """
+        depth = cls.value_field(value, 'depth', index, (int, str))
+        try:
+            depth = int(depth)
+        except ValueError:
+            raise ValueError("Cat fact " + str(index) + " has a depth that isn't an integer")
+        topic = cls.value_field(value, 'topic', index, str)
+        fact = cls.value_field(value, 'fact', index, str)
+        parents = value.get('parents')
+        if isinstance(parents, str):
+            # Parents can also be sent the way they're stored, comma separated
+            parents = None if parents == "none" else parents.split(", ")
+        elif parents is not None and (not isinstance(parents, list)
+                                      or not all(isinstance(parent, str) for parent in parents)):
+            raise ValueError("Cat fact " + str(index) + " has parents that aren't a string or a list of strings")
+        if parents is None and depth > 0:
+            # Without parents, a fact would be saved as a root node
+            parents = list(topic_ancestors(topic)) or None
+        return {'depth': depth, 'topic': topic, 'parents': parents, 'fact': fact}
+
     def fetch(self, keys: list=None):
         """
-        Gets cat facts by topics / keys from db.
+        Gets cat facts by topics / keys from db. All the topics are fetched
+        in one query on the topic index, and grouped by topic here.
+
+        Topic fetches are served from the cache when the same set of topics
+        (in any order) was fetched since the last write (see check_version).
         """
+        if keys is not None:
+            self.check_version()
+            cache_key = tuple(sorted(set(keys)))
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return {each: cached[each] for each in keys}
+            generation = self.cache.generation
         results = {}
-        cur = self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        if keys is None:
-            query = "SELECT * FROM " + DB_TABLE_NAME
-            print("\nFetching all data")
-            cur.execute(query)
-            rows = cur.fetchall()
-            results['all'] = rows
-        else:
-            for each in keys:
-                query = "SELECT * FROM " + DB_TABLE_NAME + " WHERE Topic = %s"
-                print("\nFetching data for keys: ", str(each))
-                cur.execute(query, (each,))
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            start = time.perf_counter()
+            if keys is None:
+                query = "SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME
+                log.debug("Fetching all data")
+                cur.execute(query)
                 rows = cur.fetchall()
-                results[each] = rows
-        cur.close()
-        print("Got results: ", len(results))
+                results['all'] = rows
+            else:
+                for each in keys:
+                    results[each] = []
+                query = "SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME + " WHERE Topic = ANY(%s) ORDER BY ID"
+                log.debug("Fetching data for keys=%s", keys)
+                cur.execute(query, (list(results),))
+                rows = cur.fetchall()
+                for row in rows:
+                    results[row['topic']].append(row)
+                self.cache.put(cache_key, results, generation)
+            metrics.record_stage('query', time.perf_counter() - start, len(rows))
+            cur.close()
+        log.debug("Got results=%d rows=%d", len(results), len(rows))
         return results
 
+    def fetch_subtree(self, topic: str, max_depth: int=None):
+        """
+        Gets the cat facts of a topic and every topic under it (like
+        positive_health and negative_health under health), grouped by
+        topic, with one query on the Path index. max_depth limits how many
+        levels below topic are included (0 is just the topic itself).
+        """
+        self.check_version()
+        cache_key = ('subtree', topic, max_depth)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        query = "SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME + " WHERE Path @> ARRAY[%s]::text[]"
+        args = [topic]
+        if max_depth is not None:
+            # Levels below topic = path length - topic's (1-based) position in the path
+            query += " AND cardinality(Path) <= array_position(Path, %s::text) + %s"
+            args.extend([topic, max_depth])
+        query += " ORDER BY ID"
+        results = {}
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            start = time.perf_counter()
+            cur.execute(query, args)
+            rows = cur.fetchall()
+            metrics.record_stage('query', time.perf_counter() - start, len(rows))
+            for row in rows:
+                results.setdefault(row['topic'], []).append(row)
+            cur.close()
+        self.cache.put(cache_key, results, generation)
+        return results
+
+    def fetch_page(self, limit: int, after_id: int=0):
+        """
+        Gets one page of all cat facts, ordered by ID, starting after the
+        row with ID after_id (keyset pagination, so every page is an index
+        range scan no matter how deep it is).
+
+        Returns the rows, and the after_id for the next page (None on the
+        last page).
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            start = time.perf_counter()
+            cur.execute("SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME + " WHERE ID > %s ORDER BY ID LIMIT %s",
+                        (after_id, limit))
+            rows = cur.fetchall()
+            metrics.record_stage('query', time.perf_counter() - start, len(rows))
+            cur.close()
+        next_after_id = None
+        if len(rows) == limit:
+            next_after_id = rows[-1]['id']
+        return rows, next_after_id
+
+    def search(self, text: str, topics: list=None, depth: int=None, limit: int=SEARCH_LIMIT,
+               match_all: bool=True):
+        """
+        Full-text searches the facts, through the GIN index on Search (see
+        search_tsquery for how text is matched). The text is stemmed with
+        the stemmer the table was saved with (see search_stemmer), so it
+        matches the saved tokens. Results can be limited to some topics,
+        and to one depth.
+
+        Matches are ranked with ts_rank (normalized by fact length, so a
+        shorter fact with the words ranks higher), best first. At most
+        SEARCH_MAX_CANDIDATES matches are ranked, so a search on a word
+        most facts have costs the same on a million facts as on a hundred
+        thousand. When more facts than that match, which ones get ranked
+        is up to the query plan, so the results are some of the best
+        matches, not necessarily the best; they're flagged as approximate.
+
+        Returns up to limit rows (id, depth, topic, parents, fact, and
+        rank), and whether they're approximate.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        version = self.check_version()
+        tsquery = search_tsquery(text, get_stemmer(self.search_stemmer(version)), match_all)
+        if tsquery is None:
+            return [], False
+        topics = None if topics is None else sorted(set(topics))
+        cache_key = ('search', tsquery, None if topics is None else tuple(topics), depth, limit)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        # One candidate past the cap is read, only to tell whether there were more
+        query = ("SELECT ID, Depth, Topic, Parents, Fact, ts_rank(Search, %(tsquery)s::tsquery, 1) AS Rank,"
+                 " count(*) OVER () AS Candidates"
+                 " FROM (SELECT * FROM " + DB_TABLE_NAME + " WHERE Search @@ %(tsquery)s::tsquery")
+        if topics is not None:
+            query += " AND Topic = ANY(%(topics)s)"
+        if depth is not None:
+            query += " AND Depth = %(depth)s"
+        query += " LIMIT %(candidates)s) candidates ORDER BY Rank DESC, ID LIMIT %(limit)s"
+        args = {'tsquery': tsquery, 'topics': topics, 'depth': depth, 'limit': limit,
+                'candidates': SEARCH_MAX_CANDIDATES + 1}
+        with self.connection() as conn:
+            cur = conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+            start = time.perf_counter()
+            cur.execute(query, args)
+            rows = cur.fetchall()
+            metrics.record_stage('query', time.perf_counter() - start, len(rows))
+            cur.close()
+        approximate = False
+        for row in rows:
+            approximate = row.pop('candidates') > SEARCH_MAX_CANDIDATES
+        self.cache.put(cache_key, (rows, approximate), generation)
+        return rows, approximate
+
+    def table_model(self, version: int=None):
+        """
+        Returns the topics model the facts table is classified with (see
+        load_model), or None if there's none saved. It's read once per table
+        version.
+        """
+        if version is None or self.saved_model[0] != version:
+            with self.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    saved = self.load_model(cur)
+                finally:
+                    cur.close()
+            self.saved_model = (version, saved)
+        return self.saved_model[1]
+
+    def search_stemmer(self, version: int=None):
+        """
+        Returns the name of the stemmer the facts table's tokens were folded
+        with (saved with its topics model, see save_model), or TOKEN_STEMMER
+        if there's no model saved.
+        """
+        saved = self.table_model(version)
+        return TOKEN_STEMMER if saved is None else saved['stemmer']
+
+    def iter_all(self, itersize: int=FETCH_ITERSIZE):
+        """
+        Yields every cat fact, ordered by ID, through a server-side cursor
+        that pulls itersize rows at a time, so neither the db client nor the
+        caller ever holds the whole table.
+
+        The connection stays checked out until the generator is exhausted
+        or closed.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor(name="cat_facts_iter_all", cursor_factory = psycopg2.extras.RealDictCursor)
+            cur.itersize = itersize
+            start = time.perf_counter()
+            count = 0
+            try:
+                cur.execute("SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME + " ORDER BY ID")
+                for row in cur:
+                    count += 1
+                    yield row
+            finally:
+                # Includes the time the caller spent on each row, like writing it out
+                metrics.record_stage('query', time.perf_counter() - start, count)
+                cur.close()
+                conn.rollback() # Named cursors live in a transaction; end it
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Classify cat facts into trees and save them into PostgreSQL.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Classify and save facts as they arrive, in constant memory")
+    parser.add_argument('--batch-size', type=int, default=WRITE_BATCH_SIZE,
+                        help="Number of rows per db write")
+    parser.add_argument('--quiet', action='store_true',
+                        help="Don't log progress while saving into the db")
+    parser.add_argument('--workers', type=int, default=CLASSIFY_PROCESS_COUNT,
+                        help="Number of processes to classify facts with")
+    parser.add_argument('--async', dest='async_ingest', action='store_true',
+                        help="Fetch with asyncio, classifying pages as they arrive")
+    parser.add_argument('--concurrency', type=int, default=REQ_THREAD_COUNT,
+                        help="Number of API pages fetched at once")
+    parser.add_argument('--model', default=TOPIC_MODEL_PATH,
+                        help="JSON or YAML file to load the topics model from")
+    parser.add_argument('--stemmer', default=TOKEN_STEMMER, choices=list(STEMMERS) + ['none'],
+                        help="How tokens are folded before matching them to topics ('none' to match them exactly)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only classify and save new facts, and re-classify the ones a model change affects")
+    parser.add_argument('--export', metavar='PATH',
+                        help="Write the classified tree to a binary tree file instead of saving it into the db")
+    parser.add_argument('--import', dest='import_path', metavar='PATH',
+                        help="Save the tree in a binary tree file (see --export) into the db, instead of"
+                             " fetching and classifying facts")
+    parser.add_argument('--log-level', default=LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="Least severe messages logged (DEBUG also logs every classified fact)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="Run under cProfile and save the stats to PATH")
+    args = parser.parse_args()
+    if args.export and (args.import_path or args.incremental or args.stream):
+        parser.error("--export can't be combined with --import, --incremental, or --stream")
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    TOPIC_MODEL_PATH = args.model
+    TOKEN_STEMMER = None if args.stemmer == 'none' else args.stemmer
     cft = Cat_Facts_Tree()
-    cftr = Cat_Facts_Tree_Records()
-    tree = cft.make_cat_facts_tree()
-    cft.save_to_db_clean(tree)
+    with profiled(args.profile):
+        if args.import_path:
+            with Cat_Facts_Tree_File(args.import_path) as tree_file:
+                log.info("Importing nodes=%d from %s", len(tree_file), args.import_path)
+                # Saving the model the file was classified with keeps later
+                # incremental saves (and search) consistent with its rows
+                classifier = None
+                if tree_file.model is not None:
+                    classifier = Cat_Facts_Tree_Classifier.load(tree_file.model, stemmer=tree_file.stemmer)
+                cft.cftr.save_stream_to_db_clean(tree_file.iter_nodes(), args.batch_size, args.quiet, classifier)
+        elif args.incremental:
+            cft.make_cat_facts_tree_incremental(batch_size=args.batch_size, quiet=args.quiet)
+        elif args.stream:
+            cft.make_cat_facts_tree_stream(batch_size=args.batch_size, quiet=args.quiet)
+        else:
+            if args.async_ingest:
+                tree = asyncio.run(cft.make_cat_facts_tree_async(args.concurrency))
+            else:
+                tree = cft.make_cat_facts_tree(args.workers, args.concurrency)
+            if args.export:
+                nodes = write_tree_file(args.export, iter_tree_nodes(tree), cft.get_classifier())
+                log.info("Exported nodes=%d to %s", nodes, args.export)
+            else:
+                cft.save_to_db_clean(tree, args.batch_size, args.quiet)
     # Lines below for testing 
+    # cftr = Cat_Facts_Tree_Records()
     # print(cftr.fetch(["cat", "person"]))
     # vals = [{"depth": 1, "topic": "cat", "fact": "Cats are amazing!"}]
     # cftr.create(vals)
     # print(cftr.fetch(["cat"]))
-    # print(cftr.fetch())
-else:
-    cft = Cat_Facts_Tree()
-    cftr = Cat_Facts_Tree_Records()
\ No newline at end of file
+    # print(cftr.fetch())
\ No newline at end of file
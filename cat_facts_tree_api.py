@@ -1,10 +1,194 @@
 # Rest API for to get / write data for a Cat_Facts_Tree
 # Uses db calls in Cat_Facts_Tree_Records 
-from flask import Flask, jsonify, request
-from cat_facts_tree import Cat_Facts_Tree_Records
+import argparse
+import cProfile
+import logging
+import os
+import select
+import time
+from threading import Event, Lock, Thread
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+import cat_facts_tree
+from cat_facts_tree import Cat_Facts_Tree_Records, Cat_Facts_Forest, Cat_Facts_Tree_Classifier, default_topic_model, model_version, metrics, snapshot_json, DB_NOTIFY_CHANNEL, DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, FETCH_ITERSIZE, LOG_FORMAT, LOG_LEVEL, SEARCH_LIMIT
 
-cftr = Cat_Facts_Tree_Records()
+STREAM_CHUNK_ROWS = 500 # Number of NDJSON lines written per chunk when streaming
+PROFILE_DIR = None # Directory to save a cProfile stats file per request to (see --profile-dir). None to not profile.
+NO_DB_ENDPOINTS = {'metrics_text', 'pool_stats', 'cache_stats'} # Routes that don't check out a db connection
+SNAPSHOT_MODE = False # Serve reads from an in-memory Cat_Facts_Tree_Snapshot instead of the db (see --snapshot)
+SNAPSHOT_ENDPOINTS = {'get_cat_facts', 'get_cat_facts_subtree', 'topic_counts'} # Routes served from the snapshot
+SNAPSHOT_REFRESH = "notify" # "notify" reloads as soon as a write is NOTIFYed, "poll" only polls the version row
+SNAPSHOT_POLL_SECONDS = 5 # How often the version row is checked (also in "notify" mode, in case one is missed)
+
+log = logging.getLogger("cat_facts_tree.api")
+
+cftr = Cat_Facts_Tree_Records(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN)
 app = Flask(__name__)
+app.json.compact = True # Even in debug mode, so jsonify matches snapshot_json (and snapshot responses)
+
+# In-memory forest of every fact, for descendant queries. Loaded on first use and
+# reloaded when the facts table's version changes (writes from any process bump it).
+forest = {'forest': None, 'version': None}
+forest_lock = Lock()
+
+# Classifier for facts written with classify: true, loaded on first use and
+# reloaded when the table is saved with another topics model
+classifier = {'classifier': None}
+classifier_lock = Lock()
+
+def get_classifier():
+    """
+    Returns the classifier for the topics model and stemmer the facts table
+    is classified with (see Cat_Facts_Tree_Records.table_model), so new
+    facts are classified like the saved ones. Without a saved model, it's
+    the one in TOPIC_MODEL_PATH and TOKEN_STEMMER of cat_facts_tree.
+    """
+    with classifier_lock:
+        saved = cftr.table_model(cftr.check_version())
+        if saved is None:
+            cat_topics_model, stemmer = default_topic_model(), cat_facts_tree.TOKEN_STEMMER
+            version = model_version(cat_topics_model, stemmer)
+        else:
+            cat_topics_model, stemmer, version = saved['model'], saved['stemmer'], saved['version']
+        if classifier['classifier'] is None or classifier['classifier'].version != version:
+            classifier['classifier'] = Cat_Facts_Tree_Classifier.load(cat_topics_model, stemmer=stemmer)
+        return classifier['classifier']
+
+# Snapshot of the facts table reads are served from in snapshot mode. Replaced
+# (never changed) by the snapshot watcher when the table's version changes.
+snapshot = {'snapshot': None}
+snapshot_wakeup = Event() # Set after writes through this API, to check the version right away
+
+def load_snapshot():
+    """
+    Reads a new snapshot of the facts table and swaps it in.
+    """
+    start = time.perf_counter()
+    new_snapshot = cftr.read_snapshot(cat_topics_model=default_topic_model())
+    snapshot['snapshot'] = new_snapshot
+    log.info("Loaded snapshot version=%d rows=%d seconds=%.3f", new_snapshot.version,
+             len(new_snapshot.row_json), time.perf_counter() - start)
+    return new_snapshot
+
+def watch_snapshot(refresh: str=SNAPSHOT_REFRESH, poll_seconds: float=SNAPSHOT_POLL_SECONDS):
+    """
+    Keeps the snapshot up to date, forever: waits for a NOTIFY on
+    DB_NOTIFY_CHANNEL (in "notify" mode), a write through this API, or
+    poll_seconds, then reloads the snapshot if the table's version changed.
+    Any number of writes while a snapshot loads only cause one more reload.
+    """
+    listener = None
+    while True:
+        try:
+            if refresh == "notify" and listener is None:
+                listener = cftr.listen()
+                log.info("Listening for writes on channel=%s", DB_NOTIFY_CHANNEL)
+            if listener is not None:
+                readable, _, _ = select.select([listener], [], [], poll_seconds)
+                if readable:
+                    listener.poll()
+                    listener.notifies.clear()
+            else:
+                snapshot_wakeup.wait(poll_seconds)
+            snapshot_wakeup.clear()
+            if cftr.fetch_version() != snapshot['snapshot'].version:
+                load_snapshot()
+        except Exception as err:
+            # Keep serving the last snapshot until the db is back
+            log.warning("Snapshot refresh failed, retrying in %ss: %s", poll_seconds, err)
+            if listener is not None:
+                listener.close()
+                listener = None
+            time.sleep(poll_seconds)
+
+def start_snapshot_mode(refresh: str=SNAPSHOT_REFRESH, poll_seconds: float=SNAPSHOT_POLL_SECONDS):
+    """
+    Loads the first snapshot, and starts the thread that keeps it up to date.
+    """
+    load_snapshot()
+    Thread(target=watch_snapshot, args=(refresh, poll_seconds), daemon=True).start()
+    return
+
+def json_bytes_response(body: bytes):
+    return Response(body, mimetype="application/json")
+
+def get_forest():
+    """
+    Returns the in-memory Cat_Facts_Forest, (re)loading it from the db if
+    the facts table's version changed since it was loaded. The version is
+    checked at most every CACHE_VERSION_CHECK_SECONDS (see
+    Cat_Facts_Tree_Records.check_version).
+    """
+    with forest_lock:
+        version = cftr.check_version()
+        if forest['forest'] is None or forest['version'] != version:
+            forest['forest'] = Cat_Facts_Forest.from_rows(cftr.iter_all())
+            forest['version'] = version
+        return forest['forest']
+
+# Only one profiler can be enabled at a time (Python 3.12+ raises ValueError
+# for a second one), so requests that overlap a profiled one aren't profiled
+profile_lock = Lock()
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    if PROFILE_DIR is not None and profile_lock.acquire(blocking=False):
+        try:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        except Exception:
+            g.pop('profiler', None)
+            profile_lock.release()
+            raise
+
+def stop_profiler():
+    """
+    Disables the current request's profiler, if it has one, and lets the
+    next request be profiled. Returns the profiler.
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+    return profiler
+
+@app.after_request
+def finish_request(response):
+    """
+    Counts the request and records its latency by route (the URL rule, so
+    /api/get_cat_facts/cat and /api/get_cat_facts/person are one series).
+    Streamed responses are timed until their first chunk is ready.
+    """
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe('cat_facts_http_request_seconds', time.perf_counter() - g.request_start,
+                    route=route, method=request.method)
+    metrics.inc('cat_facts_http_requests_total', route=route, method=request.method,
+                status=response.status_code)
+    profiler = stop_profiler()
+    if profiler is not None:
+        path = os.path.join(PROFILE_DIR, "%d-%s.prof" % (time.time_ns(), request.endpoint))
+        profiler.dump_stats(path)
+        log.debug("Saved request profile to %s", path)
+    return response
+
+# Each request gets its own pooled db connection, so concurrent
+# requests (threaded=True) don't share one connection's transaction.
+@app.before_request
+def checkout_db_connection():
+    if request.endpoint in NO_DB_ENDPOINTS:
+        return
+    if request.endpoint in SNAPSHOT_ENDPOINTS and snapshot['snapshot'] is not None:
+        return
+    cftr.checkout()
+
+@app.teardown_request
+def checkin_db_connection(err=None):
+    cftr.checkin()
+
+@app.teardown_request
+def stop_request_profiler(err=None):
+    # finish_request isn't called when a request fails
+    stop_profiler()
 
 @app.route("/api/get_cat_facts/<string:topics>", methods=['GET'])
 def get_cat_facts(topics: str="all"):
@@ -13,32 +197,208 @@ def get_cat_facts(topics: str="all"):
 
     It accepts a string parameter but can parse topics by commas (",").
 
-    To get all cat facts, just request with "all".
+    To get all cat facts, just request with "all". Since that can be
+    the whole table, "all" can also be fetched in pages, with the
+    query params limit and after_id (the next_after_id of the previous
+    page), or streamed as NDJSON (one fact per line) with stream=1.
+
+    With descendants=1, each topic's response also includes every topic
+    under it (like positive_health and negative_health under health),
+    served from an in-memory forest. max_depth limits how many levels
+    below each topic are included.
 
     For a full list of topics, see the main Cat_Facts_Tree class.
+
+    In snapshot mode, the same responses come from the in-memory snapshot.
     """
-    print("hit get cat facts")
+    log.debug("Get cat facts topics=%s", topics)
+    _snapshot = snapshot['snapshot']
+    if _snapshot is not None:
+        return get_cat_facts_from_snapshot(_snapshot, topics)
     res = {}
     if topics == "all":
+        if request.args.get('stream') in ("1", "true"):
+            return Response(stream_with_context(stream_all_facts()), mimetype="application/x-ndjson")
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            after_id = request.args.get('after_id', default=0, type=int)
+            rows, next_after_id = cftr.fetch_page(limit, after_id)
+            return jsonify({'all': rows, 'next_after_id': next_after_id})
         res = cftr.fetch()
     else:
         # To make it easy, we'll pass in multiple topics /
         # keys as a single comma-separated string
         _topics = topics.split(",")
+        if request.args.get('descendants') in ("1", "true"):
+            max_depth = request.args.get('max_depth', type=int)
+            return jsonify(get_forest().fetch(_topics, max_depth))
         res = cftr.fetch(_topics)
     return jsonify(res)
 
+def get_cat_facts_from_snapshot(_snapshot: object, topics: str):
+    """
+    get_cat_facts, served from a snapshot.
+    """
+    if topics == "all":
+        if request.args.get('stream') in ("1", "true"):
+            return Response(_snapshot.iter_ndjson(STREAM_CHUNK_ROWS), mimetype="application/x-ndjson")
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            after_id = request.args.get('after_id', default=0, type=int)
+            return json_bytes_response(_snapshot.fetch_page_json(limit, after_id))
+        return json_bytes_response(_snapshot.all_json)
+    _topics = topics.split(",")
+    if request.args.get('descendants') in ("1", "true"):
+        max_depth = request.args.get('max_depth', type=int)
+        return json_bytes_response(_snapshot.fetch_descendants_json(_topics, max_depth))
+    return json_bytes_response(_snapshot.fetch_json(_topics))
+
+def stream_all_facts():
+    """
+    Yields every cat fact as NDJSON, a chunk of lines at a time. Lines are
+    serialized with snapshot_json, like the snapshot's (see
+    Cat_Facts_Tree_Snapshot.iter_ndjson).
+    """
+    lines = []
+    for row in cftr.iter_all(FETCH_ITERSIZE):
+        lines.append(snapshot_json(row))
+        if len(lines) >= STREAM_CHUNK_ROWS:
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+@app.route("/api/get_cat_facts_subtree/<string:topic>", methods=['GET'])
+def get_cat_facts_subtree(topic: str):
+    """
+    Gets the cat facts of a topic and every topic under it, grouped
+    by topic, in one indexed db query. The max_depth query param limits
+    how many levels below the topic are included.
+    """
+    max_depth = request.args.get('max_depth', type=int)
+    _snapshot = snapshot['snapshot']
+    if _snapshot is not None:
+        return json_bytes_response(_snapshot.fetch_subtree_json(topic, max_depth))
+    return jsonify(cftr.fetch_subtree(topic, max_depth))
+
+@app.route("/api/search", methods=['GET'])
+def search_cat_facts():
+    """
+    Full-text searches cat facts for the words in the q query param
+    (like /api/search?q=whiskers), best matches first. Words are
+    normalized and stemmed the same way facts are classified, so "hunting"
+    finds facts with "hunts".
+
+    At most SEARCH_MAX_CANDIDATES matching facts are ranked. When more
+    match, "approximate" is true in the response: the results are good
+    matches, but better ones may have been left out, so add words or
+    filters to narrow the search.
+
+    Optional query params: topics (comma separated) and depth filter the
+    results, limit is how many come back (SEARCH_LIMIT by default), and
+    match=any finds facts with any of the words instead of all of them.
+    """
+    text = request.args.get('q', '')
+    if not text.strip():
+        return jsonify({'error': "Expected a q query param with words to search for"}), 400
+    topics = request.args.get('topics')
+    if topics is not None:
+        topics = topics.split(",")
+    depth = request.args.get('depth', type=int)
+    limit = request.args.get('limit', default=SEARCH_LIMIT, type=int)
+    match_all = request.args.get('match', 'all') != 'any'
+    results, approximate = cftr.search(text, topics, depth, limit, match_all)
+    return jsonify({'results': results, 'approximate': approximate})
+
+@app.route("/api/topic_counts", methods=['GET'])
+def topic_counts():
+    """
+    Gets the number of facts in each topic, and in each topic
+    including every topic under it.
+    """
+    _snapshot = snapshot['snapshot']
+    if _snapshot is not None:
+        return json_bytes_response(_snapshot.counts_json)
+    _forest = get_forest()
+    return jsonify({'facts': _forest.counts(), 'subtree_facts': _forest.counts(True)})
+
 @app.route("/api/write_new_cat_fact", methods=['POST'])
 def write_new_cat_fact():
     """
     Accepts a POST request with payload for "new_cat_facts", 
     which is a list of dictionaries / objects with the required
-    keys of depth (integer), parents (comma separated string),
-    and fact (string).  
+    keys of depth (integer), topic (string), and fact (string),
+    and optionally parents (comma separated string).
+
+    With "classify": true in the payload, "new_cat_facts" can be
+    raw facts (strings) instead, which are sorted into topics on
+    the server.
+
+    The whole list is saved in one transaction, and the saved facts
+    are returned in the same order, with the IDs the db gave them
+    (null for facts that didn't match any topic).
     """
-    vals = request.get_json()['new_cat_facts']
-    res = cftr.create(vals)
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('new_cat_facts'), list):
+        return jsonify({'error': "Expected a JSON object with a new_cat_facts list"}), 400
+    vals = payload['new_cat_facts']
+    try:
+        if payload.get('classify') is True:
+            res = cftr.create(vals, get_classifier())
+        else:
+            res = cftr.create(vals)
+    except ValueError as err:
+        return jsonify({'error': str(err)}), 400
+    snapshot_wakeup.set()
     return jsonify(res)
 
+@app.route("/api/pool_stats", methods=['GET'])
+def pool_stats():
+    """
+    Gets db connection pool usage: connections in use, requests waiting,
+    utilization, and how long requests waited for a connection.
+    """
+    return jsonify(cftr.pool_stats())
+
+@app.route("/api/cache_stats", methods=['GET'])
+def cache_stats():
+    """
+    Gets topic query cache counters: hits, misses, evictions,
+    expirations, invalidations (writes), and the current size.
+    """
+    return jsonify(cftr.cache.get_stats())
+
+@app.route("/metrics", methods=['GET'])
+def metrics_text():
+    """
+    Gets every counter and latency histogram (stage timings, API requests,
+    fetch retries), plus pool and cache stats, in the Prometheus text format.
+    """
+    gauges = []
+    for key, value in cftr.pool_stats().items():
+        gauges.append(('cat_facts_db_pool_' + key, "Db connection pool " + key.replace('_', ' '), {}, value))
+    for key, value in cftr.cache.get_stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges.append(('cat_facts_cache_' + key, "Topic query cache " + key.replace('_', ' '), {}, value))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve cat facts from PostgreSQL over HTTP.")
+    parser.add_argument('--log-level', default=LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="Least severe messages logged")
+    parser.add_argument('--profile-dir', default=PROFILE_DIR,
+                        help="Profile every request with cProfile, saving one stats file per request here")
+    parser.add_argument('--snapshot', action='store_true', default=SNAPSHOT_MODE,
+                        help="Serve reads from an in-memory snapshot of the facts table, reloaded on writes")
+    parser.add_argument('--snapshot-refresh', default=SNAPSHOT_REFRESH, choices=['notify', 'poll'],
+                        help="Reload the snapshot on NOTIFY from writers, or only by polling the version row")
+    parser.add_argument('--snapshot-poll-seconds', type=float, default=SNAPSHOT_POLL_SECONDS,
+                        help="How often the version row is polled")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    PROFILE_DIR = args.profile_dir
+    if PROFILE_DIR is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+    if args.snapshot:
+        start_snapshot_mode(args.snapshot_refresh, args.snapshot_poll_seconds)
     app.run(host='0.0.0.0', port=8080, threaded=True)
\ No newline at end of file
@@ -0,0 +1,759 @@
+# Benchmarks for the Cat_Facts_Tree classification pipeline
+# Generates synthetic cat facts from the topic model's vocabulary, so
+# it doesn't depend on the Cat Fact API. Persistence and API reads run
+# against a recording stand-in for the db unless --db is given, and
+# every result can be written as JSON (--json) and compared with an
+# earlier run (--compare).
+import argparse
+import asyncio
+import bisect
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlsplit, parse_qs
+import psycopg2.extensions
+from cat_facts_tree import Cat_Facts_Tree, Cat_Facts_Fetcher, Cat_Facts_Tree_Classifier, weighted_topic_vals
+from cat_facts_tree import tokenize, tokenize_facts, normalize_text, iter_batches, iter_tree_nodes, node_to_row
+from cat_facts_tree import Cat_Facts_Tree_File, write_tree_file
+from cat_facts_tree import DB_TABLE_NAME, FACT_COLUMNS, TOKENIZE_BATCH_SIZE
+
+FILLER_WORDS = ['the', 'a', 'of', 'and', 'to', 'in', 'is', 'that', 'their', 'can',
+                'have', 'about', 'more', 'than', 'most', 'which', 'when', 'every']
+
+def make_facts(count: int, words_per_fact: int=12, seed: int=0, skew: float=None):
+    """
+    Makes a list of synthetic facts, mixing topic words and matches
+    from weighted_topic_vals with filler words.
+
+    By default topic words are picked evenly from the whole vocabulary.
+    With skew, a topic is picked first, with the n'th topic of the model
+    1 / n ** skew as likely as the first (0 is even, 1 is Zipf-like, and
+    higher piles most facts into the first few topics), then one of its words.
+    """
+    vocab = []
+    for topic, vals in weighted_topic_vals.items():
+        vocab.append(topic)
+        vocab.extend(vals.get('matches', []))
+    topic_vocabs = [[topic] + vals.get('matches', []) for topic, vals in weighted_topic_vals.items()]
+    topic_weights = None
+    if skew is not None:
+        topic_weights = [1 / (rank + 1) ** skew for rank in range(len(topic_vocabs))]
+    rng = random.Random(seed)
+    facts = []
+    for i in range(count):
+        words = []
+        for j in range(words_per_fact):
+            if rng.random() < 0.15:
+                if topic_weights is None:
+                    words.append(rng.choice(vocab))
+                else:
+                    words.append(rng.choice(rng.choices(topic_vocabs, topic_weights)[0]))
+            else:
+                words.append(rng.choice(FILLER_WORDS))
+        facts.append(" ".join(words).capitalize() + ".")
+    return facts
+
+class Recording_Cursor():
+    """
+    Stands in for a psycopg2 cursor when there's no db. Statements and
+    COPY data are recorded (only their count and size) instead of run,
+    and the reads Cat_Facts_Tree_Records makes (topics, pages, and the
+    whole table) are answered from the connection's in-memory rows.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+        self.connection = conn
+        self.results = []
+        self.rowcount = 0
+        self.itersize = 2000
+        self.description = None
+        return
+
+    def execute(self, query: object, args: object=None):
+        conn = self.conn
+        if isinstance(query, bytes):
+            query = query.decode()
+        conn.statements += 1
+        conn.bytes_sent += len(query)
+        results = []
+        if "Topic = ANY(%s)" in query and "AND Parents = 'none'" not in query:
+            results = sorted([row for topic in args[0] for row in conn.rows_by_topic.get(topic, [])],
+                             key=lambda row: row['id'])
+        elif "WHERE ID > %s ORDER BY ID LIMIT %s" in query:
+            start = bisect.bisect_right(conn.row_ids, args[0])
+            results = conn.rows[start:start + args[1]]
+        elif query.startswith("SELECT " + FACT_COLUMNS + " FROM " + DB_TABLE_NAME) and "WHERE" not in query:
+            results = conn.rows
+        elif query.startswith("SELECT to_regclass"):
+            results = [(None,) * query.count("to_regclass")] # Only the facts table exists
+        elif "RETURNING Version" in query:
+            conn.version += 1
+            results = [(conn.version,)]
+        self.results = results
+        self.rowcount = len(results)
+        return
+
+    def mogrify(self, query: object, args: object):
+        if isinstance(query, bytes):
+            query = query.decode()
+        return (query % tuple([psycopg2.extensions.adapt(arg).getquoted().decode() for arg in args])).encode()
+
+    def copy_expert(self, query: str, buf: object):
+        self.conn.statements += 1
+        self.conn.bytes_sent += len(buf.read())
+        return
+
+    def fetchall(self):
+        return list(self.results)
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def close(self):
+        return
+
+
+class Recording_Connection():
+    """
+    Stands in for a psycopg2 connection (see Recording_Cursor), serving
+    reads from rows (dicts shaped like the facts table's, ordered by id).
+    """
+    def __init__(self, rows: list=None):
+        self.rows = rows or []
+        self.row_ids = [row['id'] for row in self.rows]
+        self.rows_by_topic = {}
+        for row in self.rows:
+            self.rows_by_topic.setdefault(row['topic'], []).append(row)
+        self.statements = 0
+        self.bytes_sent = 0
+        self.version = 0 # See Cat_Facts_Tree_Records.bump_version
+        self.closed = 0
+        self.encoding = 'UTF8'
+        return
+
+    def cursor(self, name: str=None, cursor_factory: object=None):
+        return Recording_Cursor(self)
+
+    def commit(self):
+        return
+
+    def rollback(self):
+        return
+
+
+class Recording_Pool():
+    """
+    Stands in for Cat_Facts_Tree_Records' connection pool, always
+    handing out the same Recording_Connection.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+        return
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn: object, close: bool=False):
+        return
+
+    def closeall(self):
+        return
+
+
+def make_rows(nodes: list):
+    """
+    Turns nodes into rows shaped like the facts table's, as the db would
+    return them, with IDs in order.
+    """
+    rows = []
+    for row_id, node in enumerate(nodes, 1):
+        row = node_to_row(node)
+        rows.append({'id': row_id, 'depth': int(row[0]), 'topic': row[1], 'parents': row[2],
+                     'fact': row[3], 'path': row[4]})
+    return rows
+
+
+class Stub_Cat_Facts_Server():
+    """
+    Local HTTP server that serves a list of facts in the same paginated
+    format as the Cat Fact API (/facts?limit=&page=), waiting latency
+    seconds before each response. Every fail_every'th request gets a 503,
+    to exercise retries.
+    """
+    def __init__(self, facts: list, latency: float=0.0, fail_every: int=0):
+        self.facts = facts
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.fail_every and server.requests % server.fail_every == 0:
+                    self.send_error(503)
+                    return
+                body = json.dumps(server.page(self.path)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                return
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self.httpd.server_address[1]) + "/facts"
+        return
+
+    def page(self, path: str):
+        """
+        Builds the JSON for one page of facts.
+        """
+        query = parse_qs(urlsplit(path).query)
+        limit = int(query.get('limit', ['10'])[0])
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, -(-len(self.facts) // limit))
+        start = (page - 1) * limit
+        next_page_url = None
+        if page < last_page:
+            next_page_url = self.url + "?limit=" + str(limit) + "&page=" + str(page + 1)
+        return {'current_page': page, 'last_page': last_page, 'per_page': limit,
+                'next_page_url': next_page_url, 'total': len(self.facts),
+                'data': [{'fact': fact, 'length': len(fact)} for fact in self.facts[start:start + limit]]}
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
+
+
+def bench_fetch_threads(facts: list, per_page: int, latency: float, worker_counts: list):
+    """
+    Times Cat_Facts_Fetcher against a local stub server for each thread
+    count in worker_counts.
+    """
+    results = []
+    server = Stub_Cat_Facts_Server(facts, latency)
+    url = server.start() + "?limit=" + str(per_page)
+    try:
+        for workers in worker_counts:
+            fetcher = Cat_Facts_Fetcher(url, workers)
+            start = time.perf_counter()
+            count = sum(1 for fact in fetcher.iter_facts())
+            elapsed = time.perf_counter() - start
+            results.append({'workers': workers, 'seconds': elapsed, 'facts': count,
+                            'facts_per_second': count / elapsed})
+    finally:
+        server.stop()
+    return results
+
+def bench_ingest_modes(cft: object, facts: list, per_page: int, latency: float, concurrency: int):
+    """
+    Times fetching and classifying facts from a local stub server, with
+    threads (fetch every page, then classify) and with asyncio (classify
+    each page as it arrives).
+    """
+    results = []
+    server = Stub_Cat_Facts_Server(facts, latency)
+    url = server.start() + "?limit=" + str(per_page)
+    try:
+        start = time.perf_counter()
+        fetcher = Cat_Facts_Fetcher(url, concurrency)
+        tree_dicts = cft.classify_facts(list(fetcher.iter_facts()), verbose=False)
+        results.append({'mode': 'threads', 'seconds': time.perf_counter() - start,
+                        'topics': len(tree_dicts)})
+        start = time.perf_counter()
+        tree_dicts = asyncio.run(cft.make_cat_facts_tree_async(concurrency, url, verbose=False))
+        results.append({'mode': 'asyncio', 'seconds': time.perf_counter() - start,
+                        'topics': len(tree_dicts)})
+    finally:
+        server.stop()
+    for result in results:
+        result['facts_per_second'] = len(facts) / result['seconds']
+    return results
+
+def bench_tokenize(facts: list, repeat: int=3):
+    """
+    Times tokenizing facts one at a time (tokenize) and in batches
+    (tokenize_facts), in tokens per second.
+    """
+    token_count = sum(len(tokens) for tokens in tokenize_facts(facts))
+    results = []
+    start = time.perf_counter()
+    for i in range(repeat):
+        for fact in facts:
+            tokenize(fact)
+    results.append({'mode': 'tokenize', 'seconds': (time.perf_counter() - start) / repeat})
+    start = time.perf_counter()
+    for i in range(repeat):
+        for batch in iter_batches(facts, TOKENIZE_BATCH_SIZE):
+            tokenize_facts(batch)
+    results.append({'mode': 'tokenize_facts', 'seconds': (time.perf_counter() - start) / repeat})
+    for result in results:
+        result['tokens_per_second'] = token_count / result['seconds']
+    return results
+
+def bench_normalize(facts: list, repeat: int=3):
+    """
+    Times normalize_text on every fact, in facts per second.
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        for fact in facts:
+            normalize_text(fact)
+    elapsed = (time.perf_counter() - start) / repeat
+    return [{'mode': 'normalize_text', 'seconds': elapsed, 'facts_per_second': len(facts) / elapsed}]
+
+def bench_classify(cft: object, facts: list, reference_max: int=100000):
+    """
+    Times classifying facts with determine_facts_hierarchy (on at most
+    reference_max facts, since it's much slower), and with the compiled
+    classifier, without and with stemming. Run without DEBUG logging, or
+    the time includes logging every node (see print_tree).
+    """
+    results = []
+    reference_facts = facts[:reference_max]
+    start = time.perf_counter()
+    cft.determine_facts_hierarchy(reference_facts, weighted_topic_vals)
+    elapsed = time.perf_counter() - start
+    results.append({'mode': 'determine_facts_hierarchy', 'facts': len(reference_facts),
+                    'seconds': elapsed, 'facts_per_second': len(reference_facts) / elapsed})
+    for stemmer in (None, "inflections"):
+        classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer=stemmer)
+        start = time.perf_counter()
+        classifier.build_tree(facts)
+        elapsed = time.perf_counter() - start
+        results.append({'mode': 'classifier (' + str(stemmer or "no stemming") + ')', 'facts': len(facts),
+                        'seconds': elapsed, 'facts_per_second': len(facts) / elapsed})
+    return results
+
+def bench_persist(cft: object, facts: list, methods: list=("copy", "values"), db: bool=False):
+    """
+    Times saving classified facts with Cat_Facts_Tree_Records.save_stream_to_db_clean,
+    with each bulk write method. Facts are classified before timing starts.
+    Without db, statements go to a Recording_Connection, so only the
+    client side (building rows and serializing them) is timed.
+    """
+    cftr = cft.cftr
+    classifier = cft.get_classifier()
+    nodes = list(cft.iter_fact_nodes(facts, classifier))
+    results = []
+    for method in methods:
+        if not db:
+            cftr.pool = Recording_Pool(Recording_Connection())
+        start = time.perf_counter()
+        saved = cftr.replace_table(iter(nodes), quiet=True, method=method, classifier=classifier)
+        elapsed = time.perf_counter() - start
+        result = {'method': method, 'db': db, 'rows': saved, 'seconds': elapsed,
+                  'rows_per_second': saved / elapsed}
+        if not db:
+            result['bytes_sent'] = cftr.pool.conn.bytes_sent
+            cftr.pool = None
+        results.append(result)
+    return results
+
+def bench_api_reads(cft: object, facts: list, topics: list, repeat: int=50, db: bool=False,
+                    snapshot: bool=False):
+    """
+    Times GET routes of the API through Flask's test client. With db, the
+    facts table has to already hold the facts (like after bench_persist);
+    otherwise reads are served by a Recording_Connection holding them.
+
+    With snapshot, the routes are served from an in-memory snapshot of the
+    facts (the API's --snapshot mode) instead, and loading it is timed too.
+    """
+    import cat_facts_tree_api as api # Flask is only needed for this benchmark
+    if not db:
+        nodes = list(cft.iter_fact_nodes(facts))
+        api.cftr.pool = Recording_Pool(Recording_Connection(make_rows(nodes)))
+    client = api.app.test_client()
+    results = []
+    if snapshot:
+        start = time.perf_counter()
+        loaded = api.load_snapshot()
+        elapsed = time.perf_counter() - start
+        results.append({'route': 'load snapshot', 'db': db, 'snapshot': True, 'rows': len(loaded.row_json),
+                        'seconds': elapsed, 'rows_per_second': len(loaded.row_json) / elapsed})
+    topics_path = "/api/get_cat_facts/" + ",".join(topics)
+    routes = [
+        ('topics (uncached)', topics_path, True),
+        ('topics (cached)', topics_path, False),
+        ('all, page of 1000', "/api/get_cat_facts/all?limit=1000&after_id=0", False),
+        ('all, streamed', "/api/get_cat_facts/all?stream=1", False),
+        ('topics with descendants', topics_path + "?descendants=1", False),
+        ('topic_counts', "/api/topic_counts", False),
+    ]
+    try:
+        for name, path, clear_cache in routes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                client.get(path) # Warms up the cache, and the forest for descendants and counts
+                body_bytes = 0
+                start = time.perf_counter()
+                for i in range(repeat):
+                    if clear_cache:
+                        api.cftr.cache.clear()
+                    response = client.get(path)
+                    if response.status_code != 200:
+                        raise RuntimeError(path + " failed: " + response.get_data(as_text=True))
+                    body_bytes = len(response.get_data())
+                elapsed = (time.perf_counter() - start) / repeat
+            results.append({'route': name, 'db': db, 'snapshot': snapshot, 'seconds': elapsed,
+                            'requests_per_second': 1 / elapsed, 'response_bytes': body_bytes})
+    finally:
+        api.snapshot['snapshot'] = None
+        if not db:
+            api.cftr.pool = None
+    return results
+
+def compare_reports(old: dict, new: dict):
+    """
+    Matches up the results of two benchmark reports (entries of the same
+    section with the same names and counts) and returns the change in
+    each throughput (*_per_second) value, as new / old.
+    """
+    def identity(result):
+        return tuple(sorted((key, val) for key, val in result.items()
+                            if isinstance(val, (str, int)) and not key.endswith('bytes')))
+    changes = []
+    for section, results in new.items():
+        if section == 'meta' or not isinstance(results, list):
+            continue
+        old_results = {identity(result): result for result in old.get(section, [])}
+        for result in results:
+            old_result = old_results.get(identity(result))
+            if old_result is None:
+                continue
+            for key, val in result.items():
+                if key.endswith('_per_second') and old_result.get(key):
+                    changes.append({'section': section, 'result': dict(identity(result)), 'metric': key,
+                                    'old': old_result[key], 'new': val, 'ratio': val / old_result[key]})
+    return changes
+
+def bench_classify_processes(cft: object, facts: list, max_processes: int):
+    """
+    Times classify_facts_parallel from 1 up to max_processes worker processes.
+    """
+    results = []
+    classifier = cft.get_classifier()
+    for processes in range(1, max_processes + 1):
+        start = time.perf_counter()
+        cft.classify_facts_parallel(facts, classifier, processes, verbose=False)
+        elapsed = time.perf_counter() - start
+        results.append({'processes': processes, 'seconds': elapsed,
+                        'facts_per_second': len(facts) / elapsed})
+    return results
+
+def bench_topic_fetch(cft: object, facts: list, topics: list, repeat: int=20):
+    """
+    Saves the classified facts into the db, then times fetching topics with
+    Cat_Facts_Tree_Records.fetch (one query on the indexed table) against one
+    query per topic on an unindexed copy of the table.
+    """
+    cftr = cft.cftr
+    cftr.save_stream_to_db_clean(cft.iter_fact_nodes(facts), quiet=True)
+    unindexed_table = DB_TABLE_NAME + "_unindexed"
+    with cftr.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DROP TABLE IF EXISTS " + unindexed_table)
+        cur.execute("CREATE TABLE " + unindexed_table + " AS SELECT * FROM " + DB_TABLE_NAME)
+        cur.execute("ANALYZE " + unindexed_table)
+        cur.execute("ANALYZE " + DB_TABLE_NAME)
+        conn.commit()
+        start = time.perf_counter()
+        for i in range(repeat):
+            for topic in topics:
+                cur.execute("SELECT * FROM " + unindexed_table + " WHERE Topic = %s", (topic,))
+                cur.fetchall()
+        before = (time.perf_counter() - start) / repeat
+        cur.execute("DROP TABLE " + unindexed_table)
+        conn.commit()
+        cur.close()
+    start = time.perf_counter()
+    for i in range(repeat):
+        cftr.cache.clear() # Time the indexed query, not the cache
+        cftr.fetch(topics)
+    after = (time.perf_counter() - start) / repeat
+    return {'rows': len(facts), 'topics': topics, 'before_seconds': before, 'after_seconds': after}
+
+def bench_search(cft: object, facts: list, queries: list, repeat: int=20):
+    """
+    Saves the first 1%, 10%, and all of the facts into the db in turn, and
+    times full-text searches (Cat_Facts_Tree_Records.search, uncached) on
+    each, to show how search latency changes with the size of the table.
+    """
+    cftr = cft.cftr
+    results = []
+    for size in sorted({max(1, len(facts) // 100), max(1, len(facts) // 10), len(facts)}):
+        cftr.save_stream_to_db_clean(cft.iter_fact_nodes(facts[:size]), quiet=True)
+        with cftr.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("ANALYZE " + DB_TABLE_NAME)
+            conn.commit()
+            cur.close()
+        for query in queries:
+            matches = 0
+            start = time.perf_counter()
+            for i in range(repeat):
+                cftr.cache.clear()
+                matches = len(cftr.search(query)[0])
+            elapsed = (time.perf_counter() - start) / repeat
+            results.append({'facts': size, 'query': query, 'results': matches, 'seconds': elapsed,
+                            'searches_per_second': 1 / elapsed})
+    return results
+
+def bench_tree_file(cft: object, facts: list, topics: list, path: str, repeat: int=5, db: bool=False):
+    """
+    Writes the classified facts to a binary tree file, then times loading
+    every node, and one fetch of topics, from the file against the db
+    fetch path (Cat_Facts_Tree_Records.fetch, uncached). With db, the facts
+    table is replaced with the facts first; otherwise the db is a
+    Recording_Connection holding them, which already has every row as a
+    dict, so only --db measures what a real fetch costs.
+    """
+    tree_dicts = cft.classify_facts(facts, verbose=False)
+    start = time.perf_counter()
+    nodes = write_tree_file(path, iter_tree_nodes(tree_dicts))
+    write_seconds = time.perf_counter() - start
+    cftr = cft.cftr
+    if db:
+        cftr.save_to_db_clean(tree_dicts, quiet=True)
+    else:
+        cftr.pool = Recording_Pool(Recording_Connection(make_rows(list(iter_tree_nodes(tree_dicts)))))
+
+    def open_file():
+        with Cat_Facts_Tree_File(path) as tree_file:
+            return len(tree_file)
+
+    def load_file():
+        with Cat_Facts_Tree_File(path) as tree_file:
+            return list(tree_file.iter_nodes())
+
+    def fetch_file():
+        with Cat_Facts_Tree_File(path) as tree_file:
+            return {topic: list(tree_file.topic_nodes(topic)) for topic in topics}
+
+    def fetch_db(keys: list=None):
+        cftr.cache.clear()
+        return cftr.fetch(keys)
+
+    results = [{'source': 'tree file', 'operation': 'write', 'nodes': nodes, 'seconds': write_seconds,
+                'nodes_per_second': nodes / write_seconds, 'file_bytes': os.path.getsize(path)}]
+    try:
+        for source, operation, load in [('tree file', 'open', open_file),
+                                        ('tree file', 'load all', load_file),
+                                        ('db', 'load all', fetch_db),
+                                        ('tree file', 'fetch topics', fetch_file),
+                                        ('db', 'fetch topics', lambda: fetch_db(topics))]:
+            start = time.perf_counter()
+            for i in range(repeat):
+                load()
+            elapsed = (time.perf_counter() - start) / repeat
+            results.append({'source': source, 'operation': operation, 'nodes': nodes, 'seconds': elapsed,
+                            'nodes_per_second': nodes / elapsed})
+    finally:
+        if not db:
+            cftr.pool = None
+    return results
+
+def bench_create(cft: object, facts: list, batch_sizes: list, rows: int=10000, classify: bool=False,
+                 max_requests: int=1000):
+    """
+    Times POSTing facts to /api/write_new_cat_fact (through Flask's test
+    client, against the db) batch_size facts per request, starting from an
+    empty facts table. Each batch size writes rows facts, or batch_size *
+    max_requests if that's fewer.
+    With classify, raw facts are sent and classified by the API; otherwise
+    they're classified before timing starts.
+    """
+    from cat_facts_tree_api import app # Flask is only needed for this benchmark
+    client = app.test_client()
+    classifier = cft.get_classifier()
+    cft.cftr.save_stream_to_db_clean(iter([]), quiet=True, classifier=classifier)
+    results = []
+    for batch_size in batch_sizes:
+        count = min(rows, len(facts), batch_size * max_requests)
+        # Numbered per batch size, so every run inserts new facts instead of updating old ones
+        run_facts = [fact + " " + str(batch_size) for fact in facts[:count]]
+        if classify:
+            values = run_facts
+        else:
+            values = [{'depth': node['depth'], 'topic': node['topic'], 'parents': ", ".join(node['parents']),
+                       'fact': node['fact']}
+                      for node in classifier.classify_batch(run_facts) if node is not None]
+        start = time.perf_counter()
+        for batch in iter_batches(values, batch_size):
+            response = client.post("/api/write_new_cat_fact",
+                                   json={'new_cat_facts': batch, 'classify': classify})
+            if response.status_code != 200:
+                raise RuntimeError("write_new_cat_fact failed: " + response.get_data(as_text=True))
+        elapsed = time.perf_counter() - start
+        results.append({'batch_size': batch_size, 'rows': len(values), 'seconds': elapsed,
+                        'rows_per_second': len(values) / elapsed})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark cat facts classification.")
+    parser.add_argument('--facts', type=int, default=200000, help="Number of synthetic facts")
+    parser.add_argument('--words-per-fact', type=int, default=12, help="Words in each synthetic fact")
+    parser.add_argument('--skew', type=float, default=None,
+                        help="Pick topics with Zipf-like skew (0 is even, 1 is Zipf; default picks words evenly)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic facts")
+    parser.add_argument('--max-workers', type=int, default=4, help="Highest worker process count to try")
+    parser.add_argument('--reference-max', type=int, default=100000,
+                        help="Most facts to classify with determine_facts_hierarchy")
+    parser.add_argument('--persist', action='store_true',
+                        help="Also time saving facts, with each bulk write method")
+    parser.add_argument('--api', action='store_true',
+                        help="Also time API reads through Flask's test client")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="With --api, also time the reads served from an in-memory snapshot")
+    parser.add_argument('--db', action='store_true',
+                        help="Run --persist and --api against PostgreSQL instead of a recording stand-in"
+                             " (this replaces the facts table!)")
+    parser.add_argument('--http', action='store_true',
+                        help="Also time fetching facts from a local stub API at different thread counts")
+    parser.add_argument('--http-latency', type=float, default=0.05,
+                        help="Stub API latency per request, in seconds (for --http and --ingest)")
+    parser.add_argument('--http-per-page', type=int, default=1000, help="Facts per stub API page")
+    parser.add_argument('--ingest', action='store_true',
+                        help="Also compare threaded and asyncio ingest against a local stub API")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent stub API requests for --ingest")
+    parser.add_argument('--fetch', action='store_true',
+                        help="Also time topic fetches against the db (this replaces the facts table!)")
+    parser.add_argument('--fetch-topics', default="cat,person,health",
+                        help="Comma separated topics to fetch (for --fetch and --api)")
+    parser.add_argument('--tree-file', metavar='PATH',
+                        help="Also write a binary tree file to PATH, and time loading it against fetching"
+                             " from the db (a recording stand-in, or PostgreSQL with --db)")
+    parser.add_argument('--search', action='store_true',
+                        help="Also time full-text searches on growing facts tables (this replaces the facts table!)")
+    parser.add_argument('--search-queries', default="hunt,cute kitten,people love",
+                        help="Comma separated searches to time (for --search)")
+    parser.add_argument('--create', action='store_true',
+                        help="Also time the write_new_cat_fact API at batch sizes of 1, 100, and 10000"
+                             " (this replaces the facts table!)")
+    parser.add_argument('--create-rows', type=int, default=10000, help="Facts written per batch size")
+    parser.add_argument('--classify', action='store_true',
+                        help="Send raw facts for the API to classify in --create")
+    parser.add_argument('--json', help="Write every result to this file as JSON")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare throughput with")
+    args = parser.parse_args()
+    cft = Cat_Facts_Tree()
+    facts = make_facts(args.facts, args.words_per_fact, args.seed, args.skew)
+    report = {'meta': {'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'facts': args.facts,
+                       'words_per_fact': args.words_per_fact, 'skew': args.skew, 'seed': args.seed,
+                       'db': args.db}}
+    print("\nTokenizing ", len(facts), " synthetic facts\n")
+    report['tokenize'] = bench_tokenize(facts)
+    for result in report['tokenize']:
+        print("\t", result['mode'], ": ", round(result['seconds'], 3), "s (",
+              int(result['tokens_per_second']), " tokens/s)")
+    report['normalize'] = bench_normalize(facts)
+    for result in report['normalize']:
+        print("\t", result['mode'], ": ", round(result['seconds'], 3), "s (",
+              int(result['facts_per_second']), " facts/s)")
+    print("\nClassifying ", len(facts), " synthetic facts\n")
+    report['classify'] = bench_classify(cft, facts, args.reference_max)
+    for result in report['classify']:
+        print("\t", result['mode'], ": ", result['facts'], " facts in ", round(result['seconds'], 3), "s (",
+              int(result['facts_per_second']), " facts/s)")
+    report['classify_processes'] = bench_classify_processes(cft, facts, args.max_workers)
+    for result in report['classify_processes']:
+        print("\t", result['processes'], " processes: ", round(result['seconds'], 3), "s (",
+              int(result['facts_per_second']), " facts/s)")
+    if args.persist:
+        print("\nSaving ", len(facts), " classified facts (", "PostgreSQL" if args.db else "recording stand-in",
+              ")\n")
+        report['persist'] = bench_persist(cft, facts, db=args.db)
+        for result in report['persist']:
+            print("\t", result['method'], ": ", result['rows'], " rows in ", round(result['seconds'], 3), "s (",
+                  int(result['rows_per_second']), " rows/s)")
+    if args.api:
+        sections = [('api', False)]
+        if args.snapshot:
+            sections.append(('api_snapshot', True))
+        for section, snapshot in sections:
+            print("\nReading facts through the API (", "PostgreSQL" if args.db else "recording stand-in",
+                  ", in-memory snapshot" if snapshot else "", ")\n")
+            report[section] = bench_api_reads(cft, facts, args.fetch_topics.split(","), db=args.db,
+                                              snapshot=snapshot)
+            for result in report[section]:
+                if 'rows_per_second' in result:
+                    print("\t", result['route'], ": ", result['rows'], " rows in ", round(result['seconds'], 3),
+                          "s (", int(result['rows_per_second']), " rows/s)")
+                    continue
+                print("\t", result['route'], ": ", round(result['seconds'] * 1000, 3), "ms (",
+                      int(result['requests_per_second']), " requests/s, ", result['response_bytes'], " bytes)")
+    if args.http:
+        print("\nFetching ", len(facts), " facts from a stub API (", args.http_latency, "s latency)\n")
+        report['http'] = bench_fetch_threads(facts, args.http_per_page, args.http_latency, [1, 2, 4, 8, 16])
+        for result in report['http']:
+            print("\t", result['workers'], " threads: ", round(result['seconds'], 3), "s (",
+                  int(result['facts_per_second']), " facts/s)")
+    if args.ingest:
+        print("\nIngesting ", len(facts), " facts from a stub API (", args.http_latency, "s latency, ",
+              args.concurrency, " concurrent requests)\n")
+        report['ingest'] = bench_ingest_modes(cft, facts, args.http_per_page, args.http_latency, args.concurrency)
+        for result in report['ingest']:
+            print("\t", result['mode'], ": ", round(result['seconds'], 3), "s (",
+                  int(result['facts_per_second']), " facts/s)")
+    if args.fetch:
+        result = bench_topic_fetch(cft, facts, args.fetch_topics.split(","))
+        report['fetch'] = [result]
+        print("\nFetching ", result['topics'], " from ", result['rows'], " facts\n")
+        print("\tOne query per topic, no indexes: ", round(result['before_seconds'] * 1000, 2), "ms")
+        print("\tOne query, indexed: ", round(result['after_seconds'] * 1000, 2), "ms")
+    if args.tree_file:
+        print("\nLoading ", len(facts), " classified facts from a tree file and from the db (",
+              "PostgreSQL" if args.db else "recording stand-in", ")\n")
+        report['tree_file'] = bench_tree_file(cft, facts, args.fetch_topics.split(","), args.tree_file, db=args.db)
+        for result in report['tree_file']:
+            print("\t", result['source'], ", ", result['operation'], ": ", round(result['seconds'] * 1000, 3), "ms (",
+                  int(result['nodes_per_second']), " nodes/s)")
+    if args.search:
+        print("\nSearching facts tables of growing size\n")
+        report['search'] = bench_search(cft, facts, args.search_queries.split(","))
+        for result in report['search']:
+            print("\t", result['facts'], " facts, ", repr(result['query']), ": ", round(result['seconds'] * 1000, 3),
+                  "ms (", result['results'], " results)")
+    if args.create:
+        print("\nWriting facts through the API (", "classified by the API" if args.classify else "pre-classified",
+              ")\n")
+        report['create'] = bench_create(cft, facts, [1, 100, 10000], args.create_rows, args.classify)
+        for result in report['create']:
+            print("\t", result['batch_size'], " facts per request: ", result['rows'], " rows in ",
+                  round(result['seconds'], 3), "s (", int(result['rows_per_second']), " rows/s)")
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(report, results_file, indent=2, default=str)
+        print("\nWrote results to ", args.json)
+    if args.compare:
+        with open(args.compare) as results_file:
+            old_report = json.load(results_file)
+        print("\nThroughput compared with ", args.compare, " (", old_report['meta'].get('time'), ")\n")
+        for key in ('facts', 'words_per_fact', 'skew', 'seed', 'db', 'cpu_count'):
+            if old_report['meta'].get(key) != report['meta'][key]:
+                print("\tNote: ", key, " was ", old_report['meta'].get(key), ", now ", report['meta'][key])
+        for change in compare_reports(old_report, report):
+            print("\t", change['section'], " ", change['result'], " ", change['metric'], ": ",
+                  round(change['ratio'], 3), "x")
@@ -0,0 +1,996 @@
+# Tests for cat_facts_tree (run with python -m pytest)
+# Nothing here needs the Cat Fact API or a PostgreSQL server.
+import json
+import random
+import socket
+import threading
+import time
+import psycopg2.extensions
+import psycopg2.extras
+import pytest
+from cat_facts_tree import Cat_Facts_Tree, Cat_Facts_Tree_Classifier, Cat_Facts_Tree_Records, Cat_Facts_Fetcher
+from cat_facts_tree import weighted_topic_vals, stem_inflections, IRREGULAR_FORMS
+from cat_facts_tree import Cat_Facts_Tree_File, Cat_Facts_Tree_Snapshot, write_tree_file, TREE_FILE_HEADER
+from cat_facts_tree import iter_tree_nodes, node_to_row, DB_TABLE_NAME, DB_MODEL_TABLE_NAME, DB_VERSION_TABLE_NAME
+from cat_facts_tree import SEARCH_MAX_CANDIDATES
+
+FILLER_WORDS = ['the', 'a', 'of', 'and', 'to', 'in', 'is', 'that', 'their', 'can',
+                'have', 'about', 'more', 'than', 'most', 'which', 'when', 'every']
+
+def make_corpus(count: int, seed: int=0, cat_topics_model: dict=weighted_topic_vals):
+    """
+    Makes a seeded list of facts mixing topic names and match words from
+    the topics model with filler words, with the capitalization,
+    punctuation and hyphens determine_facts_hierarchy normalizes away.
+    """
+    vocab = []
+    for topic, vals in cat_topics_model.items():
+        vocab.append(topic)
+        vocab.extend(vals.get('matches', []))
+    rng = random.Random(seed)
+    facts = []
+    for i in range(count):
+        words = []
+        for j in range(rng.randint(1, 15)):
+            word = rng.choice(vocab) if rng.random() < 0.2 else rng.choice(FILLER_WORDS)
+            roll = rng.random()
+            if roll < 0.05:
+                word = word.upper()
+            elif roll < 0.1:
+                word += rng.choice([',', ';', '!', '?', "'s"])
+            words.append(word)
+        joiner = '-' if rng.random() < 0.1 else ' '
+        facts.append(joiner.join(words).capitalize() + ".")
+    return facts
+
+
+def reference_tree(facts: list, cat_topics_model: dict=weighted_topic_vals):
+    return Cat_Facts_Tree(cat_topics_model).determine_facts_hierarchy(facts, cat_topics_model)
+
+
+def compiled_tree(facts: list, cat_topics_model: dict=weighted_topic_vals):
+    return Cat_Facts_Tree_Classifier(cat_topics_model, stemmer=None).build_tree(facts)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_classifier_matches_determine_facts_hierarchy(seed):
+    facts = make_corpus(2000, seed)
+    assert compiled_tree(facts) == reference_tree(facts)
+
+
+@pytest.mark.parametrize("fact, topic", [
+    # cute is in the matches of appearance, personality, intelligence and
+    # health; the last of the siblings in the model wins
+    ("Cute cats.", "health"),
+    ("Soft hair on a cat.", "health"),
+    ("Grown kittens are fast.", "appearance"),
+    # The first token that matches anything decides the node
+    ("Adorable people hunt.", "health"),
+    ("People are adorable.", "person"),
+    # A topic name is a match of its own, as a root level node
+    ("Health of a cat is good.", "health"),
+    ("Misc facts about whiskers.", "misc"),
+    ("Activites are fun.", "activites"),
+])
+def test_classifier_tie_breaks(fact, topic):
+    tree_dicts = compiled_tree([fact])
+    assert [key for key in tree_dicts if not key.endswith('_root')] == [topic]
+    assert tree_dicts == reference_tree([fact])
+
+
+def test_topic_name_tokens_are_root_nodes():
+    tree_dicts = compiled_tree(["Health matters.", "Person of interest."])
+    assert tree_dicts == reference_tree(["Health matters.", "Person of interest."])
+    health_node = tree_dicts['health'][-1]
+    assert health_node['depth'] == weighted_topic_vals['health']['weight']
+    assert health_node['parents'] == ['health_root']
+
+
+def test_unmatched_facts_are_dropped():
+    facts = ["Nothing to see here.", "", "The end."]
+    assert compiled_tree(facts) == reference_tree(facts) == {}
+
+
+def test_classifier_matches_other_models():
+    cat_topics_model = {
+        "paws": {"weight": 1, "matches": ["paw", "toe"]},
+        "toes": {"weight": 2, "parents": ["paws"], "matches": ["toe", "claw"]},
+        "claws": {"weight": 2, "parents": ["paws"], "matches": ["claw"]},
+    }
+    facts = make_corpus(500, 3, cat_topics_model)
+    assert compiled_tree(facts, cat_topics_model) == reference_tree(facts, cat_topics_model)
+
+
+@pytest.mark.parametrize("token, stem", [
+    ("cats", "cat"), ("kittens", "kitten"), ("paws", "paw"), ("catches", "catch"),
+    ("hunts", "hunt"), ("hunted", "hunt"), ("hunting", "hunt"), ("running", "run"),
+    ("hopped", "hop"), ("hoped", "hope"), ("kitty", "kitti"), ("kitties", "kitti"),
+    ("grass", "grass"), ("is", "is"), ("fluffier", "fluffier"),
+])
+def test_stem_inflections(token, stem):
+    assert stem_inflections(token) == stem
+
+
+def test_stem_inflections_irregular_forms():
+    for token, stem in IRREGULAR_FORMS.items():
+        assert stem_inflections(token) == stem
+        # The stem is its own stem, so it and its regular forms meet it
+        assert stem_inflections(stem) == stem
+
+
+# Forms the match lists have always had; without a stemmer, they're the only
+# way these tokens match
+BASELINE_MATCHES = [("cats", "cat"), ("kittens", "cat"), ("owners", "person"), ("humans", "person"),
+                    ("running", "activites"), ("hunting", "activites"), ("caught", "activites"),
+                    ("paws", "appearance"), ("loving", "positive_activities")]
+
+
+@pytest.mark.parametrize("token, topic", BASELINE_MATCHES)
+def test_match_lists_keep_the_baseline_forms(token, topic):
+    assert token in weighted_topic_vals[topic]['matches']
+    fact = "The " + token + "."
+    for stemmer in [None, "inflections"]:
+        classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer=stemmer)
+        assert classifier.classify_text(fact) == reference_tree([fact])[topic][0]
+
+
+def test_stemming_keeps_what_every_listed_match_matches():
+    exact = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer=None)
+    stemmed = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    for word in {word for vals in weighted_topic_vals.values() for word in vals.get('matches', [])}:
+        assert stemmed.classify_text(word) == exact.classify_text(word)
+    # And the forms that aren't listed match too
+    assert stemmed.classify_text("Biting.")['topic'] == exact.classify_text("Bites.")['topic'] == 'activites'
+    assert exact.classify_text("Biting.") is None
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 97])
+def test_parallel_classification_matches_one_process(chunk_size):
+    facts = make_corpus(3000, 11)
+    cft = Cat_Facts_Tree()
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    single = cft.classify_facts_parallel(facts, classifier, processes=1, verbose=False)
+    parallel = cft.classify_facts_parallel(facts, classifier, processes=3, chunk_size=chunk_size, verbose=False)
+    # Same topics in the same order, same facts in each, and same parents
+    # (in the same order) on every node
+    assert list(parallel) == list(single)
+    assert parallel == single
+    assert [node['parents'] for node in iter_tree_nodes(parallel)] == \
+        [node['parents'] for node in iter_tree_nodes(single)]
+
+
+def test_merge_trees_keeps_the_first_root_and_topic_order():
+    facts = make_corpus(1000, 12)
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals)
+    chunks = [classifier.build_tree(facts[i:i + 150]) for i in range(0, len(facts), 150)]
+    merged = Cat_Facts_Tree.merge_trees(chunks)
+    whole = classifier.build_tree(facts)
+    assert list(merged) == list(whole)
+    assert merged == whole
+
+
+class Fake_Cursor():
+    """
+    Stands in for a psycopg2 cursor: records every statement (and the
+    rows sent with COPY) on its connection instead of running it. Queries
+    with one of the connection's answers in them return its rows.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+        self.connection = conn
+        self.rowcount = 0
+        self.results = []
+        return
+
+    def execute(self, query: object, args: object=None):
+        if isinstance(query, bytes):
+            query = query.decode()
+        self.conn.statements.append(query)
+        self.rowcount = 0
+        self.results = [(len(self.conn.statements),)] if "RETURNING Version" in query else []
+        for part, rows in self.conn.answers.items():
+            if part in query:
+                self.results = [dict(row) for row in rows]
+        return
+
+    def mogrify(self, query: object, args: object):
+        if isinstance(query, bytes):
+            query = query.decode()
+        return (query % tuple([psycopg2.extensions.adapt(arg).getquoted().decode() for arg in args])).encode()
+
+    def copy_expert(self, query: str, buf: object):
+        if self.conn.fail_on_copy:
+            raise psycopg2.OperationalError("connection lost")
+        self.conn.statements.append(query)
+        self.conn.copied.append(buf.read().splitlines())
+        return
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def fetchall(self):
+        return list(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def close(self):
+        return
+
+
+class Fake_Connection():
+    def __init__(self, fail_on_copy: bool=False, answers: dict=None):
+        self.statements = []
+        self.answers = answers or {}
+        self.copied = [] # Lines of each COPY
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = 0
+        self.encoding = 'UTF8'
+        self.fail_on_copy = fail_on_copy
+        return
+
+    def cursor(self, name: str=None, cursor_factory: object=None):
+        return Fake_Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+        return
+
+    def rollback(self):
+        self.rollbacks += 1
+        return
+
+
+class Fake_Pool():
+    def __init__(self, conn: object):
+        self.conn = conn
+        return
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn: object, close: bool=False):
+        return
+
+
+def fake_records(conn: object):
+    cftr = Cat_Facts_Tree_Records()
+    cftr.pool = Fake_Pool(conn)
+    return cftr
+
+
+class Table_Cursor():
+    """
+    Stands in for a psycopg2 cursor on a Table_Connection, running the
+    statements the incremental save path makes against its in-memory table.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+        self.connection = conn
+        self.results = []
+        self.description = None
+        self.itersize = 2000
+        return
+
+    def execute(self, query: str, args: object=None):
+        conn = self.conn
+        conn.statements.append(query)
+        results = []
+        self.description = None
+        if query.startswith("SELECT to_regclass(%s), to_regclass(%s)"):
+            results = [(DB_TABLE_NAME, None if conn.model is None else DB_MODEL_TABLE_NAME)]
+        elif query.startswith("SELECT to_regclass(%s)"):
+            results = [(DB_VERSION_TABLE_NAME,)]
+        elif query.startswith("SELECT * FROM " + DB_MODEL_TABLE_NAME):
+            results = [(1,) + conn.model]
+            self.description = [('id',), ('version',), ('model',), ('stemmer',)]
+        elif query.startswith("INSERT INTO " + DB_MODEL_TABLE_NAME):
+            conn.model = tuple(args)
+        elif "RETURNING Version" in query:
+            conn.version += 1
+            results = [(conn.version,)]
+        elif query.startswith("SELECT Version FROM"):
+            results = [(conn.version,)]
+        elif query.startswith("SELECT Fingerprint FROM"):
+            results = [(row['fingerprint'],) for row in conn.rows.values() if row['fingerprint'] in args[0]]
+        elif query.startswith("SELECT Topic FROM"):
+            results = [(row['topic'],) for row in conn.rows.values()
+                       if row['topic'] in args[0] and row['parents'] == 'none']
+        elif query.startswith("SELECT ID, Fact, Depth, Topic, Parents FROM"):
+            results = [(row['id'], row['fact'], row['depth'], row['topic'], row['parents'])
+                       for row in conn.rows.values()
+                       if set(row['tokens']) & set(args[0]) and row['parents'] != 'none']
+        elif query.startswith("DELETE FROM " + DB_TABLE_NAME + " WHERE ID = ANY(%s)"):
+            for row_id in args[0]:
+                del conn.rows[row_id]
+        elif query.startswith("DELETE FROM " + DB_TABLE_NAME + " r WHERE r.Parents = 'none'"):
+            fact_topics = {row['topic'] for row in conn.rows.values() if row['parents'] != 'none'}
+            for row in list(conn.rows.values()):
+                if row['parents'] == 'none' and row['topic'] not in fact_topics:
+                    del conn.rows[row['id']]
+        self.results = results
+        return
+
+    def execute_values(self, query: str, argslist: list, fetch: bool=False):
+        conn = self.conn
+        conn.statements.append(query)
+        returned = []
+        if query.startswith("UPDATE " + DB_TABLE_NAME):
+            for row_id, depth, topic, parents, path in argslist:
+                conn.rows[row_id].update(depth=depth, topic=topic, parents=parents, path=path)
+        elif query.startswith("INSERT INTO " + DB_TABLE_NAME + " ("):
+            for row in argslist:
+                returned.append((conn.upsert(row), row[5]))
+        return returned if fetch else None
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def fetchall(self):
+        return list(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def close(self):
+        return
+
+
+class Table_Connection():
+    """
+    Stands in for a psycopg2 connection to a facts table (rows by ID,
+    shaped like the db's) and its saved model (version, model JSON, stemmer).
+    """
+    def __init__(self):
+        self.rows = {}
+        self.next_id = 1
+        self.model = None
+        self.version = 0
+        self.statements = []
+        self.commits = 0
+        self.closed = 0
+        return
+
+    def upsert(self, row: tuple):
+        """
+        Saves a row (see node_to_row) like upsert_rows does, returning its ID.
+        """
+        for saved in self.rows.values():
+            if saved['fingerprint'] == row[5]:
+                row_id = saved['id']
+                break
+        else:
+            row_id = self.next_id
+            self.next_id += 1
+        self.rows[row_id] = {'id': row_id, 'depth': int(row[0]), 'topic': row[1], 'parents': row[2],
+                             'fact': row[3], 'path': row[4], 'fingerprint': row[5], 'tokens': row[6]}
+        return row_id
+
+    def load(self, facts: list, classifier: object):
+        """
+        Fills the table like a full save of facts with classifier would.
+        """
+        for node in classifier.iter_nodes(facts):
+            self.upsert(node_to_row(node, classifier.stem))
+        self.model = (classifier.version, json.dumps(classifier.cat_topics_model), classifier.stemmer)
+        return
+
+    def topics(self):
+        """
+        Returns fact -> topic of every fact row, and the topics with a root row.
+        """
+        facts = {row['fact']: row['topic'] for row in self.rows.values() if row['parents'] != 'none'}
+        roots = {row['topic'] for row in self.rows.values() if row['parents'] == 'none'}
+        return facts, roots
+
+    def cursor(self, name: str=None, cursor_factory: object=None):
+        return Table_Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+        return
+
+    def rollback(self):
+        return
+
+
+@pytest.fixture
+def table_records(monkeypatch):
+    """
+    Records on a Table_Connection, with execute_values run by its cursor.
+    """
+    monkeypatch.setattr(psycopg2.extras, 'execute_values',
+                        lambda cur, query, argslist, template=None, page_size=100, fetch=False:
+                        cur.execute_values(query, argslist, fetch))
+    conn = Table_Connection()
+    return fake_records(conn), conn
+
+
+def test_replace_table_copies_batches_into_a_new_table():
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    generation = cftr.cache.generation
+    tree_dicts = compiled_tree(make_corpus(500))
+    nodes = list(iter_tree_nodes(tree_dicts))
+    assert cftr.save_to_db_clean(tree_dicts, batch_size=100, quiet=True) == len(nodes)
+    # Rows go into the new table in batches, and it only replaces the old
+    # one in the same transaction as the commit
+    new_table = DB_TABLE_NAME + "_new"
+    assert conn.statements[0] == "DROP TABLE IF EXISTS " + new_table
+    assert "CREATE TABLE " + new_table + " (" in conn.statements[1]
+    copies = [query for query in conn.statements if query.startswith("COPY ")]
+    assert len(copies) == len(conn.copied) == -(-len(nodes) // 100)
+    assert all(query.startswith("COPY " + new_table + " (") for query in copies)
+    assert [len(line.split("\t")) for lines in conn.copied for line in lines] == [7] * len(nodes)
+    drop = conn.statements.index("DROP TABLE IF EXISTS " + DB_TABLE_NAME)
+    assert conn.statements[drop + 1] == "ALTER TABLE " + new_table + " RENAME TO " + DB_TABLE_NAME
+    assert drop > conn.statements.index(copies[-1])
+    assert conn.commits == 1
+    assert cftr.cache.generation == generation + 1
+
+
+def test_replace_table_values_method():
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    nodes = list(iter_tree_nodes(compiled_tree(make_corpus(300))))
+    assert cftr.replace_table(nodes, batch_size=50, quiet=True, method="values") == len(nodes)
+    inserts = [query for query in conn.statements if query.startswith("INSERT INTO " + DB_TABLE_NAME + "_new")]
+    assert len(inserts) == -(-len(nodes) // 50)
+    assert conn.copied == []
+    assert conn.commits == 1
+
+
+def test_replace_table_rolls_back_on_failure():
+    conn = Fake_Connection(fail_on_copy=True)
+    cftr = fake_records(conn)
+    generation = cftr.cache.generation
+    with pytest.raises(psycopg2.OperationalError):
+        cftr.save_to_db_clean(compiled_tree(make_corpus(50)), quiet=True)
+    # The old table is never dropped, and the cache is kept
+    assert "DROP TABLE IF EXISTS " + DB_TABLE_NAME not in conn.statements
+    assert conn.commits == 0 and conn.rollbacks >= 1
+    assert cftr.cache.generation == generation
+
+
+def test_replace_table_saves_or_drops_the_model():
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    cftr.replace_table(classifier.iter_nodes(make_corpus(50)), quiet=True, classifier=classifier)
+    assert any(query.startswith("INSERT INTO " + DB_MODEL_TABLE_NAME) for query in conn.statements)
+    assert "DROP TABLE IF EXISTS " + DB_MODEL_TABLE_NAME not in conn.statements
+    # Without the classifier, a saved model can't be trusted to match the rows
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    cftr.replace_table(iter_tree_nodes(compiled_tree(make_corpus(50))), quiet=True)
+    assert "DROP TABLE IF EXISTS " + DB_MODEL_TABLE_NAME in conn.statements
+    assert not any(query.startswith("INSERT INTO " + DB_MODEL_TABLE_NAME) for query in conn.statements)
+
+
+def test_cache_is_cleared_when_the_table_version_changes():
+    cftr = Cat_Facts_Tree_Records(version_check_seconds=0)
+    versions = [3, 3, 4]
+    cftr.fetch_version = lambda: versions.pop(0)
+    assert cftr.check_version() == 3
+    cftr.cache.put(('cat',), {'cat': []}, cftr.cache.generation)
+    # Same version: still cached
+    assert cftr.check_version() == 3
+    assert cftr.cache.get(('cat',)) == {'cat': []}
+    # Another process wrote to the table
+    assert cftr.check_version() == 4
+    assert cftr.cache.get(('cat',)) is None
+    assert cftr.cache.get_stats()['invalidations'] == 1
+
+
+def test_cached_fetches_are_copies():
+    rows = [{'id': 2, 'depth': 1, 'topic': 'cat', 'parents': 'cat_root', 'fact': 'Cats nap.',
+             'path': ['cat']}]
+    conn = Fake_Connection(answers={"WHERE Topic = ANY": rows})
+    cftr = fake_records(conn)
+    cftr.fetch_version = lambda: 1
+    expected = {'cat': json.loads(json.dumps(rows))}
+    first = cftr.fetch(['cat'])
+    assert first == expected
+    first['cat'][0]['fact'] = 'Changed.'
+    first['cat'][0]['path'].append('changed')
+    first['cat'].append({})
+    reads = len(conn.statements)
+    second = cftr.fetch(['cat'])
+    assert len(conn.statements) == reads # From the cache
+    assert second == expected
+    second['cat'].clear()
+    assert cftr.fetch(['cat']) == expected
+
+
+def test_cache_version_is_only_checked_every_interval():
+    cftr = Cat_Facts_Tree_Records(version_check_seconds=60)
+    checks = []
+    cftr.fetch_version = lambda: checks.append(1) or 7
+    assert cftr.check_version() == 7
+    assert cftr.check_version() == 7
+    assert len(checks) == 1
+    # A write through this process checks again on the next read
+    cftr.cache.clear()
+    assert cftr.check_version() == 7
+    assert len(checks) == 2
+
+
+def test_api_forest_reloads_when_the_table_version_changes(monkeypatch):
+    api = pytest.importorskip("cat_facts_tree_api")
+    rows = [{'id': 1, 'depth': 0, 'topic': 'cat', 'parents': 'none', 'fact': 'None'},
+            {'id': 2, 'depth': 1, 'topic': 'cat', 'parents': 'cat_root', 'fact': 'Cats nap.'}]
+    versions = [1, 1, 2]
+    monkeypatch.setattr(api, 'forest', {'forest': None, 'version': None})
+    monkeypatch.setattr(api.cftr, 'check_version', lambda: versions.pop(0))
+    monkeypatch.setattr(api.cftr, 'iter_all', lambda: iter(rows))
+    first = api.get_forest()
+    assert api.get_forest() is first
+    rows.append({'id': 3, 'depth': 1, 'topic': 'cat', 'parents': 'cat_root', 'fact': 'Cats purr.'})
+    # Written by another process: only the version row tells
+    second = api.get_forest()
+    assert second is not first
+    assert second.count('cat') == first.count('cat') + 1
+
+
+@pytest.mark.parametrize("stemmer, lexeme", [(None, "'hunting'"), ("inflections", "'hunt'")])
+def test_search_stems_with_the_tables_stemmer(monkeypatch, stemmer, lexeme):
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    monkeypatch.setattr(cftr, 'fetch_version', lambda: 1)
+    monkeypatch.setattr(cftr, 'load_model', lambda cur: {'version': '', 'model': {}, 'stemmer': stemmer})
+    assert cftr.search("Hunting") == ([], False)
+    assert conn.statements[-1].count("Search @@ %(tsquery)s::tsquery") == 1
+    assert cftr.cache.get_stats()['size'] == 1
+    assert next(iter(cftr.cache.entries))[1] == lexeme
+
+
+def test_search_flags_results_past_the_candidate_cap(monkeypatch):
+    row = {'id': 1, 'depth': 2, 'topic': 'activites', 'parents': 'cat_root, cat', 'fact': 'Cats hunt.',
+           'rank': 0.1}
+    conn = Fake_Connection(answers={"Search @@": [dict(row, candidates=SEARCH_MAX_CANDIDATES)]})
+    cftr = fake_records(conn)
+    monkeypatch.setattr(cftr, 'fetch_version', lambda: 1)
+    monkeypatch.setattr(cftr, 'load_model', lambda cur: None)
+    assert cftr.search("hunt") == ([row], False)
+    conn.answers["Search @@"] = [dict(row, candidates=SEARCH_MAX_CANDIDATES + 1)]
+    assert cftr.search("hunt kitten", match_all=False) == ([row], True)
+
+
+def test_fetcher_only_fetches_a_few_pages_ahead():
+    bench = pytest.importorskip("cat_facts_tree_bench")
+    facts = ["Fact number " + str(i) + "." for i in range(200)]
+    server = bench.Stub_Cat_Facts_Server(facts)
+    url = server.start() + "?limit=5" # 40 pages
+    try:
+        fetcher = Cat_Facts_Fetcher(url, workers=2)
+        fetched = fetcher.iter_facts()
+        # The first page, then the first fact of whichever page came in next
+        first = [next(fetched) for i in range(6)]
+        time.sleep(0.5)
+        # Both pages, a full results queue, and a page in flight per worker
+        assert server.requests <= 2 + 2 * 2 + 2
+        assert sorted(first + list(fetched)) == sorted(facts)
+        assert fetcher.stats['pages'] == 40
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize("payload", [
+    {'new_cat_facts': [{'depth': None, 'topic': 'cat', 'fact': 'Cats nap.'}]},
+    {'new_cat_facts': [{'depth': 'deep', 'topic': 'cat', 'fact': 'Cats nap.'}]},
+    {'new_cat_facts': [{'depth': 1, 'topic': 'cat', 'parents': 5, 'fact': 'Cats nap.'}]},
+    {'new_cat_facts': [{'depth': 1, 'topic': 'cat', 'parents': [5], 'fact': 'Cats nap.'}]},
+    {'new_cat_facts': [{'depth': 1, 'topic': ['cat'], 'fact': 'Cats nap.'}]},
+    {'new_cat_facts': [{'depth': 1, 'topic': 'cat', 'fact': 5}]},
+    {'new_cat_facts': [{'depth': 1, 'topic': 'cat'}]},
+    {'new_cat_facts': [5]},
+    {'new_cat_facts': [{'fact': 5}], 'classify': True},
+    {'new_cat_facts': [None], 'classify': True},
+])
+def test_write_new_cat_fact_rejects_malformed_facts(monkeypatch, payload):
+    api = pytest.importorskip("cat_facts_tree_api")
+    conn = Fake_Connection()
+    monkeypatch.setattr(api.cftr, 'pool', Fake_Pool(conn))
+    monkeypatch.setattr(api.cftr, 'check_version', lambda: 1)
+    monkeypatch.setattr(api.cftr, 'table_model', lambda version: None)
+    response = api.app.test_client().post("/api/write_new_cat_fact", json=payload)
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith("Cat fact 0 ")
+    assert conn.commits == 0
+
+
+@pytest.mark.parametrize("stemmer, tokens", [(None, ['hunting', 'kittens']), ("inflections", ['hunt', 'kitten'])])
+def test_create_folds_tokens_with_the_tables_stemmer(monkeypatch, stemmer, tokens):
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    monkeypatch.setattr(cftr, 'load_model', lambda cur: {'version': '', 'model': {}, 'stemmer': stemmer})
+    written = []
+    monkeypatch.setattr(cftr, 'upsert_rows', lambda cur, rows, returning:
+                        written.extend(rows) or [(index, row[5]) for index, row in enumerate(rows)])
+    saved = cftr.create([{'depth': 1, 'topic': 'activites', 'parents': 'cat_root', 'fact': 'Hunting kittens.'}])
+    assert saved[0]['topic'] == 'activites'
+    assert [row[6] for row in written if row[3] == 'Hunting kittens.'] == [tokens]
+
+
+def test_api_classifies_with_the_tables_model(monkeypatch):
+    api = pytest.importorskip("cat_facts_tree_api")
+    cat_topics_model = json.loads(json.dumps(weighted_topic_vals))
+    cat_topics_model['people'] = {'weight': 1, 'parents': ['people_root'],
+                                  'matches': cat_topics_model['person'].pop('matches')}
+    saved = Cat_Facts_Tree_Classifier(cat_topics_model, stemmer="inflections")
+    models = [{'version': saved.version, 'model': cat_topics_model, 'stemmer': "inflections"}]
+    monkeypatch.setattr(api, 'classifier', {'classifier': None})
+    monkeypatch.setattr(api.cftr, 'check_version', lambda: 1)
+    monkeypatch.setattr(api.cftr, 'table_model', lambda version: models[-1])
+    first = api.get_classifier()
+    assert first.version == saved.version and first.stemmer == "inflections"
+    assert first.classify_text("Humans love cats.")['topic'] == 'people'
+    assert api.get_classifier() is first
+    # No saved model: the configured one
+    models.append(None)
+    monkeypatch.setattr(api.cat_facts_tree, 'TOKEN_STEMMER', None)
+    default = api.get_classifier()
+    assert default.version == Cat_Facts_Tree_Classifier(api.default_topic_model(), stemmer=None).version
+
+
+def test_classifier_load_round_trips_through_the_model_cache(tmp_path):
+    compiled = Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path), "inflections")
+    cache_files = list(tmp_path.iterdir())
+    assert len(cache_files) == 1 and cache_files[0].suffix == ".json"
+    loaded = Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path), "inflections")
+    assert loaded.index == compiled.index
+    facts = make_corpus(500, 4)
+    assert loaded.build_tree(facts) == compiled.build_tree(facts)
+
+
+def test_classifier_load_takes_parents_order_from_the_model(tmp_path):
+    compiled = Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path))
+    cache_file = next(tmp_path.iterdir())
+    data = json.loads(cache_file.read_text())
+    # The order a set() gives depends on the order items went in, so the
+    # order saved in the file can't be trusted
+    for match in data['matches']:
+        match[2].reverse()
+    cache_file.write_text(json.dumps(data))
+    loaded = Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path))
+    assert loaded.index == compiled.index
+    assert [list(match[2]) for match in loaded.index.values()] == [list(match[2]) for match in compiled.index.values()]
+
+
+@pytest.mark.parametrize("contents", [
+    '{"matches": [["cat", 1, ["person_root", "person"]]], "tokens": {"cat": 0}}',
+    "[1, 2, 3]",
+    "not json",
+    '{"matches": [["cat", 1]], "tokens": {"cat": 0}}',
+    '{"matches": [["cat", 1, ["cat_root"]]], "tokens": {"cat": 1}}',
+    '{"matches": [["cat", 1, [null]]], "tokens": {"cat": 0}}',
+])
+def test_classifier_load_compiles_over_malformed_cache_files(tmp_path, contents):
+    Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path))
+    cache_file = next(tmp_path.iterdir())
+    cache_file.write_text(contents)
+    loaded = Cat_Facts_Tree_Classifier.load(weighted_topic_vals, str(tmp_path))
+    assert loaded.index == Cat_Facts_Tree_Classifier(weighted_topic_vals).index
+
+
+def test_reads_leave_out_internal_columns(monkeypatch):
+    conn = Fake_Connection()
+    cftr = fake_records(conn)
+    monkeypatch.setattr(cftr, 'fetch_version', lambda: 1)
+    cftr.fetch(['cat'])
+    cftr.fetch_subtree('cat')
+    cftr.fetch_page(10)
+    list(cftr.iter_all())
+    reads = [query for query in conn.statements if query.startswith("SELECT ID")]
+    assert len(reads) == 4
+    for query in reads:
+        columns = query[len("SELECT "):query.index(" FROM ")]
+        assert columns == "ID, Depth, Topic, Parents, Fact, Path"
+
+
+def expected_topics(facts: list, classifier: object):
+    """
+    Returns fact -> topic, and the topics with a root row, of a full save
+    of facts with classifier.
+    """
+    nodes = list(classifier.iter_nodes(facts))
+    return ({node['fact']: node['topic'] for node in nodes if node['parents'] is not None},
+            {node['topic'] for node in nodes if node['parents'] is None})
+
+
+@pytest.mark.parametrize("saved_stemmer", [None, "inflections"])
+def test_save_incremental_rebuilds_without_a_matching_model(monkeypatch, table_records, saved_stemmer):
+    cftr, conn = table_records
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer=None)
+    if saved_stemmer is not None:
+        # A different stemmer changes every row's Tokens
+        conn.load(make_corpus(20), Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer=saved_stemmer))
+    else:
+        conn.model = None
+    rebuilt = []
+    monkeypatch.setattr(cftr, 'replace_table', lambda nodes, batch_size, quiet, classifier:
+                        rebuilt.append(classifier) or len(list(nodes)))
+    stats = cftr.save_incremental(make_corpus(100), classifier, quiet=True)
+    assert rebuilt == [classifier]
+    assert stats['saved'] == len(list(classifier.iter_nodes(make_corpus(100))))
+
+
+def test_save_incremental_skips_saved_facts(table_records):
+    cftr, conn = table_records
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    old_facts = list(dict.fromkeys(make_corpus(300, 5)))
+    conn.load(old_facts, classifier)
+    version = conn.version
+    new_facts = [fact for fact in dict.fromkeys(make_corpus(300, 6)) if fact not in set(old_facts)]
+    matched = [fact for fact in new_facts if classifier.classify_text(fact) is not None]
+    facts = old_facts[:100] + new_facts + matched[:10] # Repeats, of saved and new facts
+    stats = cftr.save_incremental(facts, classifier, batch_size=64, quiet=True)
+    # Facts that don't match any topic aren't saved, so they're classified again every time
+    saved = {fact for fact in old_facts if classifier.classify_text(fact) is not None}
+    skipped = len([fact for fact in old_facts[:100] if fact in saved]) + 10
+    assert stats == {'skipped': skipped, 'saved': len(matched), 'reclassified': 0, 'removed': 0}
+    assert conn.topics() == expected_topics(old_facts + new_facts, classifier)
+    assert conn.version == version + 1 and conn.commits == 1
+    # Nothing new: nothing written, and the version is left alone
+    stats = cftr.save_incremental(facts, classifier, quiet=True)
+    assert stats == {'skipped': skipped + len(matched), 'saved': 0, 'reclassified': 0, 'removed': 0}
+    assert conn.version == version + 1
+
+
+def test_save_incremental_reclassifies_facts_a_model_change_affects(table_records):
+    cftr, conn = table_records
+    old = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    # Without the word person, every person fact comes from its matches
+    facts = [fact for fact in dict.fromkeys(make_corpus(500, 7)) if 'person' not in fact.lower()]
+    conn.load(facts, old)
+    cat_topics_model = json.loads(json.dumps(weighted_topic_vals))
+    # person's matches move to a new root topic (so person's root row goes), and
+    # activites loses its matches, so its facts match other topics or nothing
+    cat_topics_model['people'] = {'weight': 1, 'parents': ['people_root'],
+                                  'matches': cat_topics_model['person'].pop('matches')}
+    del cat_topics_model['activites']['matches']
+    new = Cat_Facts_Tree_Classifier(cat_topics_model, stemmer="inflections")
+    changed = new.changed_tokens(old)
+    assert 'human' in changed and 'hunt' in changed and 'cute' not in changed
+    untouched = {row['id']: dict(row) for row in conn.rows.values() if not set(row['tokens']) & changed}
+    saved = len([row for row in conn.rows.values() if row['parents'] != 'none'])
+    stats = cftr.save_incremental(facts, new, batch_size=50, quiet=True)
+    assert stats['reclassified'] > 0 and stats['removed'] > 0
+    # Facts that only matched through the removed matches are gone, and aren't saved again
+    assert stats['skipped'] == saved - stats['removed'] and stats['saved'] == 0
+    # Same as classifying everything again with the new model, roots included
+    facts_topics, roots = conn.topics()
+    assert (facts_topics, roots) == expected_topics(facts, new)
+    assert 'people' in roots and 'person' not in roots
+    # Rows without a changed token are never rewritten
+    assert all(conn.rows[row_id] == row for row_id, row in untouched.items() if row_id in conn.rows)
+    assert conn.model[0] == new.version and conn.model[2] == "inflections"
+    # Saved with the new model: running again changes nothing
+    assert cftr.save_incremental(facts, new, quiet=True) == {'skipped': saved - stats['removed'], 'saved': 0,
+                                                             'reclassified': 0, 'removed': 0}
+
+
+@pytest.mark.parametrize("with_classifier", [True, False])
+def test_tree_file_round_trips_nodes(tmp_path, with_classifier):
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals, stemmer="inflections")
+    tree_dicts = classifier.build_tree(make_corpus(1000, 8) + ["Caf\u00e9 cats are cute \u2014 and curious."])
+    nodes = list(iter_tree_nodes(tree_dicts))
+    path = str(tmp_path / "tree.cft")
+    assert write_tree_file(path, nodes, classifier if with_classifier else None) == len(nodes)
+    with Cat_Facts_Tree_File(path) as tree_file:
+        assert len(tree_file) == len(nodes)
+        loaded = list(tree_file.iter_nodes())
+        # Parents keep their order, so rows (and their paths) come out the same
+        assert [node_to_row(node, classifier.stem) for node in loaded] == \
+            [node_to_row(node, classifier.stem) for node in nodes]
+        assert [node['parents'] for node in loaded] == \
+            [None if node['parents'] is None else list(node['parents']) for node in nodes]
+        assert [tree_file.node(index) for index in range(len(nodes))] == loaded
+        assert list(tree_file.to_tree_dicts()) == list(tree_dicts)
+        assert list(tree_file.topic_nodes('cat')) == [node for node in loaded if node['topic'] == 'cat']
+        assert list(tree_file.topic_nodes('no such topic')) == []
+        if with_classifier:
+            assert (tree_file.model, tree_file.stemmer) == (weighted_topic_vals, "inflections")
+            assert Cat_Facts_Tree_Classifier(tree_file.model, stemmer=tree_file.stemmer).version == classifier.version
+        else:
+            assert tree_file.model is None and tree_file.stemmer is None
+
+
+@pytest.mark.parametrize("damage, message", [
+    (lambda data: data[:10], "too short"),
+    (lambda data: data[:TREE_FILE_HEADER.size + 16], "truncated"),
+    (lambda data: data[:-1], "truncated"),
+    (lambda data: b"NOTATREE" + data[8:], "not a cat facts tree file"),
+    (lambda data: data[:8] + b"\x63\x00" + data[10:], "format 99"),
+])
+def test_tree_file_rejects_damaged_files(tmp_path, damage, message):
+    path = tmp_path / "tree.cft"
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals)
+    write_tree_file(str(path), classifier.iter_nodes(make_corpus(200)), classifier)
+    path.write_bytes(damage(path.read_bytes()))
+    with pytest.raises(ValueError, match=message):
+        Cat_Facts_Tree_File(str(path))
+
+
+def snapshot_rows(facts: list):
+    """
+    Rows (like the db returns them) of a full save of facts.
+    """
+    classifier = Cat_Facts_Tree_Classifier(weighted_topic_vals)
+    rows = []
+    for row_id, node in enumerate(classifier.iter_nodes(facts), 1):
+        depth, topic, parents, fact, path = node_to_row(node, classifier.stem)[:5]
+        rows.append({'id': row_id, 'depth': int(depth), 'topic': topic, 'parents': parents, 'fact': fact,
+                     'path': path})
+    return rows
+
+
+def rows_records(monkeypatch, records: object, rows: list):
+    """
+    Serves records' reads from rows, the way the db would.
+    """
+    def fetch(keys: list=None):
+        if keys is None:
+            return {'all': list(rows)}
+        results = {each: [] for each in keys}
+        for row in rows:
+            if row['topic'] in results:
+                results[row['topic']].append(row)
+        return results
+
+    def fetch_page(limit: int, after_id: int=0):
+        page = [row for row in rows if row['id'] > after_id][:limit]
+        return page, page[-1]['id'] if len(page) == limit else None
+
+    def fetch_subtree(topic: str, max_depth: int=None):
+        results = {}
+        for row in rows:
+            if topic in row['path'] and (max_depth is None
+                                         or len(row['path']) - 1 - row['path'].index(topic) <= max_depth):
+                results.setdefault(row['topic'], []).append(row)
+        return results
+
+    monkeypatch.setattr(records, 'fetch', fetch)
+    monkeypatch.setattr(records, 'fetch_page', fetch_page)
+    monkeypatch.setattr(records, 'fetch_subtree', fetch_subtree)
+    monkeypatch.setattr(records, 'iter_all', lambda itersize=None: iter(rows))
+    monkeypatch.setattr(records, 'check_version', lambda: 1)
+    return
+
+
+def test_snapshot_responses_match_the_db_routes(monkeypatch):
+    api = pytest.importorskip("cat_facts_tree_api")
+    rows = snapshot_rows(make_corpus(600, 9) + ["Caf\u00e9 cats are cute \u2014 and curious."])
+    rows_records(monkeypatch, api.cftr, rows)
+    monkeypatch.setattr(api.cftr, 'pool', Fake_Pool(Fake_Connection()))
+    monkeypatch.setattr(api, 'forest', {'forest': None, 'version': None})
+    monkeypatch.setattr(api, 'snapshot', {'snapshot': None})
+    monkeypatch.setattr(api, 'STREAM_CHUNK_ROWS', 7)
+    urls = ["/api/get_cat_facts/cat", "/api/get_cat_facts/health,cat,nothing", "/api/get_cat_facts/all",
+            "/api/get_cat_facts/all?limit=50", "/api/get_cat_facts/all?limit=50&after_id=120",
+            "/api/get_cat_facts/all?stream=1", "/api/get_cat_facts/health?descendants=1",
+            "/api/get_cat_facts/cat,person?descendants=1&max_depth=1", "/api/get_cat_facts_subtree/cat",
+            "/api/get_cat_facts_subtree/health?max_depth=0", "/api/get_cat_facts_subtree/nothing",
+            "/api/topic_counts"]
+    client = api.app.test_client()
+    from_db = [client.get(url) for url in urls]
+    api.snapshot['snapshot'] = Cat_Facts_Tree_Snapshot(rows, 1, api.default_topic_model())
+    from_snapshot = [client.get(url) for url in urls]
+    for url, db_response, snapshot_response in zip(urls, from_db, from_snapshot):
+        assert db_response.status_code == snapshot_response.status_code == 200, url
+        assert db_response.mimetype == snapshot_response.mimetype, url
+        assert db_response.get_data() == snapshot_response.get_data(), url
+    lines = from_snapshot[urls.index("/api/get_cat_facts/all?stream=1")].get_data().splitlines()
+    assert [json.loads(line) for line in lines] == rows
+
+
+class Fake_Listener():
+    """
+    Stands in for the LISTEN connection of Cat_Facts_Tree_Records.listen:
+    readable (for select) after notify().
+    """
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.notifies = []
+        return
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def notify(self):
+        self.writer.send(b"x")
+        return
+
+    def poll(self):
+        self.reader.recv(1024)
+        self.notifies.append("notify")
+        return
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+        return
+
+
+class Stop_Watching(BaseException):
+    pass
+
+
+def wait_for(condition: object, timeout: float=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.mark.parametrize("refresh", ["notify", "poll"])
+def test_watch_snapshot_reloads_when_the_version_changes(monkeypatch, refresh):
+    api = pytest.importorskip("cat_facts_tree_api")
+    rows = snapshot_rows(make_corpus(100, 10))
+    state = {'version': 1, 'stop': False, 'checks': 0}
+    listener = Fake_Listener()
+
+    def fetch_version():
+        if state['stop']:
+            raise Stop_Watching()
+        state['checks'] += 1
+        return state['version']
+
+    monkeypatch.setattr(api.cftr, 'fetch_version', fetch_version)
+    monkeypatch.setattr(api.cftr, 'listen', lambda: listener)
+    monkeypatch.setattr(api.cftr, 'read_snapshot', lambda cat_topics_model=None:
+                        Cat_Facts_Tree_Snapshot(rows[:state['version'] * 10], state['version'], cat_topics_model))
+    monkeypatch.setattr(api, 'snapshot', {'snapshot': api.cftr.read_snapshot()})
+    first = api.snapshot['snapshot']
+    # Polling is slow enough that only a notify (or a write through this API) wakes it up in time
+    def watch():
+        try:
+            api.watch_snapshot(refresh, 30)
+        except Stop_Watching:
+            pass
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    wake = listener.notify if refresh == "notify" else api.snapshot_wakeup.set
+    try:
+        # Woken up with nothing written: the snapshot is kept
+        wake()
+        assert wait_for(lambda: state['checks'] == 1)
+        assert api.snapshot['snapshot'] is first
+        state['version'] = 2
+        wake()
+        assert wait_for(lambda: api.snapshot['snapshot'].version == 2)
+        assert len(api.snapshot['snapshot'].row_json) == 20
+    finally:
+        state['stop'] = True
+        wake()
+        watcher.join(5)
+        listener.close()
+    assert not watcher.is_alive()
+
+
+
+def test_api_profiles_one_request_at_a_time(monkeypatch, tmp_path):
+    api = pytest.importorskip("cat_facts_tree_api")
+    monkeypatch.setattr(api, 'PROFILE_DIR', str(tmp_path))
+    client = api.app.test_client()
+    assert client.get("/api/cache_stats").status_code == 200
+    assert len(list(tmp_path.iterdir())) == 1
+    # Another request is being profiled: this one is served, but not profiled
+    assert api.profile_lock.acquire(blocking=False)
+    try:
+        assert client.get("/api/cache_stats").status_code == 200
+    finally:
+        api.profile_lock.release()
+    assert len(list(tmp_path.iterdir())) == 1
+    # Failed requests are profiled too, and let the next one be profiled
+    monkeypatch.setattr(api.cftr, 'pool', Fake_Pool(Fake_Connection()))
+    monkeypatch.setattr(api, 'snapshot', {'snapshot': None})
+    monkeypatch.setattr(api.cftr, 'fetch', lambda keys=None: 1 / 0)
+    assert client.get("/api/get_cat_facts/cat").status_code == 500
+    assert not api.profile_lock.locked()
+    assert client.get("/api/cache_stats").status_code == 200
+    assert len(list(tmp_path.iterdir())) == 3